@@ -1,14 +1,15 @@
 {{ config(materialized='table') }}
 
-with journeys as (
+with journeys_per_customer_daily as (
     select *
     -- use source function to access the source datasets
-    from {{ source('data_lake_converted', 'journeys') }}
+    -- the daily rollup of the conversion has one row per customer and day instead of one per journey
+    from {{ source('data_lake_converted', 'journeys_per_customer_daily') }}
 )
 
 select
     customer_id,
-    count(*) as journeys,
+    sum(journeys) as journeys,
     sum(amount_cents) as amount_cents
-from journeys
+from journeys_per_customer_daily
 group by customer_id
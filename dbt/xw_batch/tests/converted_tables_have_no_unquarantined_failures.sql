@@ -0,0 +1,13 @@
+-- Rows which failed a not_null or cast check in the conversion and were converted anyway (not quarantined). Replaces
+-- the not_null tests of the converted columns, which had to scan the whole tables.
+select
+    table_name,
+    _created_at,
+    column_name,
+    check_name,
+    sum(failures) as failures
+from {{ source('data_lake_converted', 'data_quality') }}
+where check_name in ('not_null', 'cast')
+    and failures > 0
+    and not quarantined
+group by 1, 2, 3, 4
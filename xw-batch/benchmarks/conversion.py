@@ -0,0 +1,205 @@
+"""
+# Benchmark of the parquet conversion
+
+Generates synthetic journeys (see benchmarks/journeys_data.py) and times the conversion of the journeys on a local
+SparkSession (see the local backend of glue/scripts/convert_to_parquet.py), stage by stage:
+
+- `transform`: business_logic.convert.journeys.transform of the (cached) source
+- `add_column_partition_date`: the same plus the partition column
+- `etl`: the whole conversion, from reading the gzip files to the registered parquet table
+
+Reports rows/s, the shuffle bytes and (for the whole conversion) the output files per run as json, so that the results
+of two versions can be diffed:
+
+```bash
+python -m benchmarks.conversion --rows 10000000 --files 200 --heavy-customer-share 0.2 --output conversion.json
+```
+
+Needs java and pyspark. The generated data is kept below --root and reused by later runs with the same data options.
+"""
+import argparse
+import dataclasses
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import typing
+import urllib.request
+
+from benchmarks import journeys_data
+from benchmarks.copy_job import git_revision
+
+GLUE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "glue")
+SOURCE_URI = "s3://benchmark/raw/scoofy/journeys/"
+TARGET_URI = "s3://benchmark/converted/journeys/"
+DATABASE_NAME = "benchmark"
+TABLE_NAME = "journeys"
+
+
+def _spark_rest_api(spark_session, path: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    context = spark_session.sparkContext
+    url = f"{context.uiWebUrl}/api/v1/applications/{context.applicationId}/{path}"
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def shuffle_bytes(spark_session, job_group: str) -> int:
+    """The shuffle bytes written by the jobs of the job group, according to the Spark UI"""
+    stage_ids = {
+        stage_id
+        for job in _spark_rest_api(spark_session, "jobs")
+        if job.get("jobGroup") == job_group
+        for stage_id in job["stageIds"]
+    }
+    return sum(
+        stage["shuffleWriteBytes"]
+        for stage in _spark_rest_api(spark_session, "stages")
+        # Skipped stages (their output was reused) have no attempt which shuffled anything
+        if stage["stageId"] in stage_ids and stage["status"] == "COMPLETE"
+    )
+
+
+def _timed(spark_session, job_group: str, run: typing.Callable[[], None]) -> typing.Dict[str, typing.Any]:
+    spark_session.sparkContext.setJobGroup(job_group, job_group)
+    started = time.monotonic()
+    run()
+    seconds = time.monotonic() - started
+    # The Spark UI is updated asynchronously
+    time.sleep(1)
+    return {"seconds": round(seconds, 3), "shuffle_bytes": shuffle_bytes(spark_session, job_group)}
+
+
+def run_benchmark(
+    *,
+    spec: journeys_data.JourneysSpec,
+    root: str,
+    repeats: int = 1,
+    target_file_size_mb: int = 128,
+) -> typing.Dict[str, typing.Any]:
+    """Runs the stages of the conversion repeats times on the journeys of the spec and returns the report"""
+    # Only needed for this benchmark, so not imported at the top
+    sys.path.insert(0, GLUE_DIR)
+    from business_logic.convert import journeys  # type: ignore
+    from pyspark.sql import functions as F
+
+    from glue.scripts import convert_to_parquet
+
+    backend = convert_to_parquet.LocalBackend(root, catalog_implementation=convert_to_parquet.LOCAL_CATALOG_IN_MEMORY)
+    source_bytes = journeys_data.generate(spec, backend.path(SOURCE_URI))
+    spark_session = backend.spark_session
+    spark_version = spark_session.version
+    spark_session.sql(f"CREATE DATABASE IF NOT EXISTS `{DATABASE_NAME}`")
+    args = {
+        **convert_to_parquet.LOCAL_JOB_ARGUMENT_DEFAULTS,
+        "SOURCE_BUCKET_URI": SOURCE_URI,
+        "TARGET_BUCKET_URI": TARGET_URI,
+        "TARGET_DB_NAME": DATABASE_NAME,
+        "TARGET_TABLE_NAME": TABLE_NAME,
+        # The malformed records are part of the benchmark, not a reason to fail it
+        "MALFORMED_RECORDS_POLICY": convert_to_parquet.MALFORMED_RECORDS_DROP,
+        "TARGET_FILE_SIZE_MB": str(target_file_size_mb),
+    }
+
+    try:
+        source = backend.extract(SOURCE_URI, data_format="json", compression="gzip", schema=journeys.SOURCE_SCHEMA)
+        # Read once, so that the first two stages only time the transformations
+        rows = source.count()
+
+        def transform() -> None:
+            journeys.transform(source, spark_session).write.format("noop").mode("overwrite").save()
+
+        def add_column_partition_date() -> None:
+            df = journeys.transform(source, spark_session)
+            df = convert_to_parquet.add_column_partition_date(df, source_partition_variable="start_dt")
+            df.write.format("noop").mode("overwrite").save()
+
+        stages = {"transform": transform, "add_column_partition_date": add_column_partition_date}
+        runs = []
+        for repeat in range(repeats):
+            for stage, run in stages.items():
+                result = _timed(spark_session, f"{stage}-{repeat}", run)
+                runs.append(
+                    {"stage": stage, "repeat": repeat, "rows_per_second": round(rows / result["seconds"]), **result}
+                )
+        # The conversion reads the source itself
+        spark_session.catalog.clearCache()
+
+        for repeat in range(repeats):
+            # Every run converts into an empty table
+            spark_session.sql(f"DROP TABLE IF EXISTS `{DATABASE_NAME}`.`{TABLE_NAME}`")
+            shutil.rmtree(backend.path(TARGET_URI), ignore_errors=True)
+            started = datetime.datetime.now(datetime.timezone.utc)
+            result = _timed(spark_session, f"etl-{repeat}", lambda: convert_to_parquet.etl(args, backend))
+            output_files = [
+                size
+                for path, size, last_modified in backend.output_files(TARGET_URI)
+                if last_modified >= started and not os.path.basename(path).startswith(("_", "."))
+            ]
+            partitions = spark_session.table(f"`{DATABASE_NAME}`.`{TABLE_NAME}`").select(
+                F.countDistinct(convert_to_parquet.PARTITION_COLUMN)
+            )
+            runs.append(
+                {
+                    "stage": "etl",
+                    "repeat": repeat,
+                    "rows_per_second": round(rows / result["seconds"]),
+                    **result,
+                    "output_files": len(output_files),
+                    "output_bytes": sum(output_files),
+                    "output_partitions": partitions.first()[0],
+                }
+            )
+    finally:
+        spark_session.stop()
+
+    return {
+        "parameters": {
+            "spec": dataclasses.asdict(spec),
+            "source_bytes": source_bytes,
+            "source_rows": rows,
+            "repeats": repeats,
+            "target_file_size_mb": target_file_size_mb,
+        },
+        "environment": {
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "spark": spark_version,
+        },
+        "runs": runs,
+    }
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0].lstrip("# "))
+    journeys_data.add_spec_arguments(parser)
+    parser.add_argument("--repeats", type=int, default=1, help="runs of every stage")
+    parser.add_argument("--target-file-size-mb", type=int, default=128)
+    parser.add_argument("--root", default=".local/benchmark", help="directory with the generated data and the output")
+    parser.add_argument("--output", default="conversion_benchmark.json", help="where the json report is written to")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        spec=journeys_data.spec_from_arguments(args),
+        root=args.root,
+        repeats=args.repeats,
+        target_file_size_mb=args.target_file_size_mb,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    for run in report["runs"]:
+        print(
+            f"{run['stage']:>25}: {run['rows_per_second']:>10} rows/s, {run['seconds']:>8} s, "
+            f"{run['shuffle_bytes']} shuffle bytes"
+            + (f", {run['output_files']} files" if "output_files" in run else "")
+        )
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+# Benchmark of the copy job
+
+Seeds a local s3 (a moto server) with gzip json objects and runs the copy lambda (sync_bucket_uri) for every
+concurrency setting, each run in a fresh process and into a fresh target prefix. Reports objects/s, MB/s, the peak RSS
+and the number of s3 requests (incl. retries) per run as json, so that the results of two versions can be diffed:
+
+```bash
+python -m benchmarks.copy_job --objects 2000 --object-size 65536 --concurrency 8 32 64 --output copy_job.json
+```
+
+The local s3 has no network latency and never throttles, so the numbers are only comparable with other runs on the
+same machine, not with the copy job in AWS.
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+import boto3
+
+from lambdas.copyjob_for_s3_data import copyjob_for_s3_data, s3_copy
+
+SOURCE_BUCKET = "benchmark-source"
+TARGET_BUCKET = "benchmark-target"
+SOURCE_PREFIX = "raw/scoofy/journeys/"
+# moto needs some credentials, but never checks them
+_AWS_ENVIRONMENT = {
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "AWS_DEFAULT_REGION": "eu-central-1",
+}
+
+
+class _LambdaContext:
+    def get_remaining_time_in_millis(self) -> int:
+        return 15 * 60 * 1000
+
+
+def journey_lines(rng: random.Random, size: int) -> bytes:
+    """Json lines which look like the scoofy journeys, about size bytes uncompressed"""
+    lines = []
+    total = 0
+    while total < size:
+        start = 1664582400 + rng.randrange(30 * 24 * 3600)
+        line = json.dumps(
+            {
+                "journey_id": f"{rng.getrandbits(64):016x}",
+                "customer_id": rng.randrange(100000),
+                "scooter_id": rng.randrange(5000),
+                "start_dt": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start)),
+                "end_dt": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start + rng.randrange(60, 3600))),
+                "amount_cents": rng.randrange(100, 5000),
+            }
+        ).encode("utf-8")
+        lines.append(line)
+        total += len(line) + 1
+    return b"\n".join(lines) + b"\n"
+
+
+def seed_source(client, *, objects: int, object_size: int, seed: int = 42) -> int:
+    """Puts gzip json objects into the source bucket and returns their total (compressed) size"""
+
+    def put(index: int) -> int:
+        body = gzip.compress(journey_lines(random.Random(seed + index), object_size))
+        client.put_object(Bucket=SOURCE_BUCKET, Key=f"{SOURCE_PREFIX}{index:08}.json.gz", Body=body)
+        return len(body)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        return sum(executor.map(put, range(objects)))
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_copy_job(endpoint_url: str, target_prefix: str, max_concurrency: int, results: multiprocessing.Queue) -> None:
+    """Runs the copy lambda once, in its own process so that the peak RSS is the one of this run"""
+    os.environ.update(_AWS_ENVIRONMENT)
+    os.environ.update(
+        {
+            "AWS_ENDPOINT_URL_S3": endpoint_url,
+            "SOURCE_BUCKET_URI": f"s3://{SOURCE_BUCKET}/{SOURCE_PREFIX}",
+            "TARGET_BUCKET_URI": f"s3://{TARGET_BUCKET}/{target_prefix}",
+            "CHECKPOINT_URI": f"s3://{TARGET_BUCKET}/_copyjob_state/{target_prefix}checkpoint.json",
+            "MAX_CONCURRENCY": str(max_concurrency),
+        }
+    )
+
+    requests: typing.Counter[str] = collections.Counter()
+    requests_lock = threading.Lock()
+    create_s3_client = s3_copy.create_s3_client
+
+    def count_request(event_name: str, **kwargs) -> None:
+        with requests_lock:
+            requests[event_name.rsplit(".", 1)[-1]] += 1
+
+    def create_counting_s3_client(*args, **kwargs):
+        client = create_s3_client(*args, **kwargs)
+        # before-send is emitted for every http request, so retries are counted, too
+        client.meta.events.register("before-send.s3", count_request)
+        return client
+
+    s3_copy.create_s3_client = create_counting_s3_client
+
+    baseline_rss_mb = _peak_rss_mb()
+    output = io.StringIO()
+    started = time.monotonic()
+    with contextlib.redirect_stdout(output):
+        copyjob_for_s3_data.sync_bucket_uri({}, _LambdaContext())
+    seconds = time.monotonic() - started
+    # The metrics which the lambda logs are the most reliable source of what was copied
+    metrics = next(json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"'))
+    results.put(
+        {
+            "seconds": round(seconds, 3),
+            "objects": metrics["ObjectsCopied"],
+            "bytes": metrics["BytesCopied"],
+            "objects_per_second": round(metrics["ObjectsCopied"] / seconds, 1),
+            "mb_per_second": round(metrics["BytesCopied"] / 1024 / 1024 / seconds, 2),
+            "copy_latency_p50_ms": round(metrics["CopyLatencyP50"], 1),
+            "copy_latency_p99_ms": round(metrics["CopyLatencyP99"], 1),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "baseline_rss_mb": round(baseline_rss_mb, 1),
+            "s3_requests": sum(requests.values()),
+            "s3_requests_by_operation": dict(sorted(requests.items())),
+        }
+    )
+
+
+def git_revision() -> typing.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    *,
+    objects: int,
+    object_size: int,
+    concurrencies: typing.List[int],
+    repeats: int = 1,
+) -> typing.Dict[str, typing.Any]:
+    """Runs the whole benchmark matrix against a fresh local s3 and returns the report"""
+    # Imported here, as it's only a dev dependency
+    from moto.server import ThreadedMotoServer
+
+    os.environ.update(_AWS_ENVIRONMENT)
+    # Otherwise every request is logged
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        endpoint_url = f"http://{host}:{port}"
+        client = boto3.client("s3", endpoint_url=endpoint_url)
+        for bucket in (SOURCE_BUCKET, TARGET_BUCKET):
+            client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "eu-central-1"})
+        source_bytes = seed_source(client, objects=objects, object_size=object_size)
+
+        # spawn instead of fork: every run starts from a clean process (and the moto threads are not forked)
+        processes = multiprocessing.get_context("spawn")
+        runs = []
+        for max_concurrency in concurrencies:
+            for repeat in range(repeats):
+                results = processes.Queue()
+                process = processes.Process(
+                    target=_run_copy_job,
+                    args=(endpoint_url, f"run-{max_concurrency}-{repeat}/", max_concurrency, results),
+                )
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f"Copy job run with concurrency {max_concurrency} failed, see its output above")
+                result = results.get()
+                runs.append({"max_concurrency": max_concurrency, "repeat": repeat, **result})
+    finally:
+        server.stop()
+
+    return {
+        "parameters": {
+            "objects": objects,
+            "object_size": object_size,
+            "source_bytes": source_bytes,
+            "concurrencies": concurrencies,
+            "repeats": repeats,
+        },
+        "environment": {
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "boto3": boto3.__version__,
+        },
+        "runs": runs,
+    }
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0].lstrip("# "))
+    parser.add_argument("--objects", type=int, default=1000, help="number of source objects")
+    parser.add_argument("--object-size", type=int, default=64 * 1024, help="uncompressed bytes per source object")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64], help="MAX_CONCURRENCY per run")
+    parser.add_argument("--repeats", type=int, default=1, help="runs per concurrency setting")
+    parser.add_argument("--output", default="copy_job_benchmark.json", help="where the json report is written to")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        objects=args.objects,
+        object_size=args.object_size,
+        concurrencies=args.concurrency,
+        repeats=args.repeats,
+    )
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    for run in report["runs"]:
+        print(
+            f"concurrency {run['max_concurrency']:>4}: {run['objects_per_second']:>8} objects/s, "
+            f"{run['mb_per_second']:>7} MB/s, {run['peak_rss_mb']:>7} MB peak RSS, {run['s3_requests']} requests"
+        )
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
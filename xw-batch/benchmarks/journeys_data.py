@@ -0,0 +1,160 @@
+"""
+# Synthetic scoofy journeys
+
+Writes gzip json lines which look like the raw scoofy journeys, in the layout of the raw bucket (one directory per day):
+
+```bash
+python -m benchmarks.journeys_data --rows 10000000 --files 200 --output .local/raw/scoofy/journeys/
+```
+
+The data can be shaped to what makes the conversion slow: a few heavy customers with many journeys (skew), journeys
+which arrive days after they started (late data, which touches older partitions) and malformed records. The same
+spec always results in the same data.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import gzip
+import json
+import os
+import random
+import typing
+
+SPEC_FILE = "_spec.json"
+
+
+@dataclasses.dataclass(frozen=True)
+class JourneysSpec:
+    rows: int = 1_000_000
+    files: int = 100
+    # Journeys are spread over this many days, the files of a day are in its own directory
+    days: int = 30
+    first_day: str = "2022-10-01"
+    customers: int = 100_000
+    scooters: int = 5000
+    # The share of all journeys which belong to the few heavy customers
+    heavy_customers: int = 10
+    heavy_customer_share: float = 0.0
+    # The share of the journeys which started up to late_days before the day of their file
+    late_share: float = 0.0
+    late_days: int = 7
+    # The share of lines which are not valid json
+    malformed_share: float = 0.0
+    seed: int = 42
+
+    def rows_of_file(self, index: int) -> int:
+        return self.rows // self.files + (1 if index < self.rows % self.files else 0)
+
+    def day_of_file(self, index: int) -> datetime.date:
+        return datetime.date.fromisoformat(self.first_day) + datetime.timedelta(days=index * self.days // self.files)
+
+
+def file_key(spec: JourneysSpec, index: int) -> str:
+    return f"{spec.day_of_file(index):%Y/%m/%d}/journeys-{index:06}.json.gz"
+
+
+def journey_lines(spec: JourneysSpec, index: int) -> typing.Iterator[str]:
+    """The lines of the file with the index, without the newlines"""
+    rng = random.Random(f"{spec.seed}-{index}")
+    day = datetime.datetime.combine(spec.day_of_file(index), datetime.time())
+    for row in range(spec.rows_of_file(index)):
+        if rng.random() < spec.malformed_share:
+            # A line which was cut off
+            yield f'{{"journey_id": "{index:06}-{row:09}", "customer_id": "'
+            continue
+        if rng.random() < spec.heavy_customer_share:
+            customer = rng.randrange(spec.heavy_customers)
+        else:
+            customer = rng.randrange(spec.customers)
+        start = day + datetime.timedelta(seconds=rng.randrange(24 * 3600))
+        if rng.random() < spec.late_share:
+            start -= datetime.timedelta(days=rng.randint(1, spec.late_days))
+        end = start + datetime.timedelta(seconds=rng.randrange(60, 3600))
+        # Formatted by hand, as json.dumps is the slowest part for big data sets
+        yield (
+            f'{{"journey_id": "{index:06}-{row:09}", "customer_id": "{customer}", '
+            f'"scooter_id": "{rng.randrange(spec.scooters)}", "start_dt": "{start:%Y-%m-%dT%H:%M:%S}", '
+            f'"end_dt": "{end:%Y-%m-%dT%H:%M:%S}", "amount_cents": {rng.randrange(100, 5000)}}}'
+        )
+
+
+def write_file(spec: JourneysSpec, index: int, output: str) -> int:
+    """Writes the file with the index below output and returns its size"""
+    path = os.path.join(output, file_key(spec, index))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # mtime=0 keeps the files byte for byte the same
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as f:
+        for line in journey_lines(spec, index):
+            f.write(line.encode("utf-8") + b"\n")
+    return os.path.getsize(path)
+
+
+def generate(spec: JourneysSpec, output: str, *, processes: typing.Optional[int] = None) -> int:
+    """Writes the journeys of the spec below output and returns their total (compressed) size
+
+    Nothing is written if output already has the data of the same spec.
+    """
+    spec_path = os.path.join(output, SPEC_FILE)
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            existing = json.load(f)
+        if existing["spec"] == dataclasses.asdict(spec):
+            return existing["bytes"]
+        raise ValueError(f"{output} has journeys of another spec, remove it first")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        total = sum(executor.map(write_file, [spec] * spec.files, range(spec.files), [output] * spec.files))
+    # Starts with an underscore, so Spark does not read it as data
+    with open(spec_path, "w") as f:
+        json.dump({"spec": dataclasses.asdict(spec), "bytes": total}, f, indent=2, sort_keys=True)
+    return total
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = JourneysSpec()
+    parser.add_argument("--rows", type=int, default=defaults.rows, help="number of journeys (incl. malformed ones)")
+    parser.add_argument("--files", type=int, default=defaults.files, help="number of gzip files")
+    parser.add_argument("--days", type=int, default=defaults.days, help="days the files are spread over")
+    parser.add_argument("--customers", type=int, default=defaults.customers)
+    parser.add_argument(
+        "--heavy-customer-share",
+        type=float,
+        default=defaults.heavy_customer_share,
+        help=f"share of the journeys of the {defaults.heavy_customers} heavy customers",
+    )
+    parser.add_argument(
+        "--late-share",
+        type=float,
+        default=defaults.late_share,
+        help=f"share of the journeys which started up to {defaults.late_days} days before their file",
+    )
+    parser.add_argument("--malformed-share", type=float, default=defaults.malformed_share)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def spec_from_arguments(args: argparse.Namespace) -> JourneysSpec:
+    return JourneysSpec(
+        rows=args.rows,
+        files=args.files,
+        days=args.days,
+        customers=args.customers,
+        heavy_customer_share=args.heavy_customer_share,
+        late_share=args.late_share,
+        malformed_share=args.malformed_share,
+        seed=args.seed,
+    )
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0].lstrip("# "))
+    add_spec_arguments(parser)
+    parser.add_argument("--output", required=True, help="directory the files are written to")
+    args = parser.parse_args(argv)
+
+    total = generate(spec_from_arguments(args), args.output)
+    print(f"Wrote {args.files} files with {total} bytes to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
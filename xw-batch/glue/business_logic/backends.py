@@ -0,0 +1,289 @@
+"""Where the conversion runs: in a Glue job (GlueBackend) or on a local SparkSession (LocalBackend)
+
+Both read the source, append to the target table (LOAD_MODE append), write objects like the run reports and list the
+written files. The other load modes only need their spark_session and path(). Used by glue/scripts/convert_to_parquet.py
+and the benchmarks.
+"""
+import datetime
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import boto3
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql import types as T
+
+from .load import PARTITION_COLUMN
+
+if TYPE_CHECKING:
+    # Every awsglue line has to be ignored as we cannot install this from pypi :-(
+    from awsglue import DynamicFrame  # type: ignore
+    from awsglue.context import GlueContext  # type: ignore
+
+# The local catalogs, "hive" keeps the tables in a metastore (derby) below the root dir, "in-memory" only in the session
+LOCAL_CATALOG_HIVE = "hive"
+LOCAL_CATALOG_IN_MEMORY = "in-memory"
+
+# Where the local reader puts the records which do not match the schema
+CORRUPT_RECORD_COLUMN = "_corrupt_record"
+
+# A written file: key (or path), size in bytes and when it was last modified
+OutputFile = Tuple[str, int, datetime.datetime]
+
+
+def split_s3_uri(uri: str) -> Tuple[str, str]:
+    """The bucket and the key (or prefix) of a s3 uri like s3://bucket/some/key"""
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not a s3 uri: {uri}")
+    bucket, _, key = uri[len("s3://") :].partition("/")  # noqa: E203
+    return bucket, key
+
+
+class GlueBackend:
+    """Runs the conversion in a Glue job, see extract() and load()."""
+
+    def __init__(self, glue_context: "GlueContext", transformation_ctx_suffix: str = ""):
+        self.glue_context = glue_context
+        self.spark_session: SparkSession = glue_context.spark_session
+        # The bookmarks are kept per job and transformation_ctx, so every table of a job needs its own (a job which
+        # converts several tables is a new job anyway, which starts without the bookmarks of the single table jobs)
+        self.transformation_ctx_suffix = transformation_ctx_suffix
+        self._source: Optional["DynamicFrame"] = None
+        self._df: Optional[DataFrame] = None
+
+    def for_table(self, table_name: str) -> "GlueBackend":
+        return GlueBackend(self.glue_context, transformation_ctx_suffix=f"_{table_name}")
+
+    def path(self, uri: str) -> str:
+        return uri
+
+    def extract(
+        self, source_bucket_uri: str, data_format: str, compression: str, schema: Optional[T.StructType] = None
+    ) -> DataFrame:
+        self._source = extract(
+            self.glue_context,
+            source_bucket_uri,
+            data_format,
+            compression,
+            schema=schema,
+            transformation_ctx=f"load_from_s3{self.transformation_ctx_suffix}",
+        )
+        # Cached, so that the malformed records can be counted before the load without reading the source twice
+        self._df = self._source.toDF().persist(StorageLevel.MEMORY_AND_DISK)
+        return self._df
+
+    def malformed_records(self) -> int:
+        # Counted while the records are read, which the count fills the cache with
+        self._df.count()
+        return self._source.errorsCount()
+
+    def append(
+        self,
+        df: DataFrame,
+        target_bucket_uri: str,
+        database_name: str,
+        table_name: str,
+        file_format: str,
+        compression: str,
+        register_partitions: bool = True,
+        partition_columns: Sequence[str] = (PARTITION_COLUMN,),
+    ) -> None:
+        from awsglue import DynamicFrame  # type: ignore
+
+        if register_partitions:
+            sink = self.glue_context.getSink(
+                path=target_bucket_uri,
+                connection_type="s3",
+                updateBehavior="UPDATE_IN_DATABASE",
+                partitionKeys=list(partition_columns),
+                compression=compression,
+                enableUpdateCatalog=True,
+                transformation_ctx=f"load_into_s3{self.transformation_ctx_suffix}",
+            )
+            sink.setCatalogInfo(
+                catalogDatabase=database_name,
+                catalogTableName=table_name,
+            )
+        else:
+            # Only writes the files, the table (with partition projection) is defined by the stack
+            sink = self.glue_context.getSink(
+                path=target_bucket_uri,
+                connection_type="s3",
+                partitionKeys=list(partition_columns),
+                compression=compression,
+                transformation_ctx=f"load_into_s3{self.transformation_ctx_suffix}",
+            )
+        sink.setFormat(file_format)
+        sink.writeFrame(DynamicFrame.fromDF(df, self.glue_context, table_name))
+
+    def put_object(self, uri: str, body: str) -> None:
+        bucket, key = split_s3_uri(uri)
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+
+    def output_files(self, target_bucket_uri: str, partitions: Optional[Sequence[str]] = None) -> Iterator[OutputFile]:
+        """The files of the partitions (paths below the table) or of the whole table."""
+        bucket, prefix = split_s3_uri(target_bucket_uri)
+        paginator = boto3.client("s3").get_paginator("list_objects_v2")
+        for partition in partitions if partitions is not None else [""]:
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix.rstrip('/')}/{partition}"):
+                for item in page.get("Contents", []):
+                    yield item["Key"], item["Size"], item["LastModified"]
+
+
+class LocalBackend:
+    """Runs the conversion on a local SparkSession, s3 uris are mapped to directories below root.
+
+    There are no bookmarks, so every run reads all source files. The tables are registered in the catalog of the
+    session, which by default is a hive metastore below root, so that a later run (e.g. with overwrite_partitions) sees
+    the tables of the earlier ones. Pass a spark_session to plug in another catalog.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        catalog_implementation: str = LOCAL_CATALOG_HIVE,
+        spark_session: Optional[SparkSession] = None,
+    ):
+        self.root = os.path.abspath(root)
+        self.spark_session = spark_session or self.create_spark_session(self.root, catalog_implementation)
+        self._malformed: Optional[DataFrame] = None
+
+    def for_table(self, table_name: str) -> "LocalBackend":
+        return LocalBackend(self.root, spark_session=self.spark_session)
+
+    @staticmethod
+    def create_spark_session(root: str, catalog_implementation: str) -> SparkSession:
+        builder = (
+            SparkSession.builder.master("local[*]")
+            .appName("convert_to_parquet")
+            .config("spark.sql.catalogImplementation", catalog_implementation)
+            .config("spark.sql.warehouse.dir", os.path.join(root, "_warehouse"))
+            # Glue runs in UTC, which matters for the partition dates
+            .config("spark.sql.session.timeZone", "UTC")
+            # Otherwise derby.log ends up in the current directory
+            .config("spark.driver.extraJavaOptions", f"-Dderby.system.home={root}")
+        )
+        if catalog_implementation == LOCAL_CATALOG_HIVE:
+            metastore = os.path.join(root, "_metastore_db")
+            builder = builder.config(
+                "spark.hadoop.javax.jdo.option.ConnectionURL", f"jdbc:derby:;databaseName={metastore};create=true"
+            )
+        return builder.getOrCreate()
+
+    def path(self, uri: str) -> str:
+        if not uri.startswith("s3://"):
+            return uri
+        return os.path.join(self.root, uri.replace("s3://", "", 1))
+
+    def extract(
+        self, source_bucket_uri: str, data_format: str, compression: str, schema: Optional[T.StructType] = None
+    ) -> DataFrame:
+        """Reads the source like extract() does (the compression is detected by Spark from the file extensions)."""
+        reader = (
+            self.spark_session.read.format(data_format)
+            .option("recursiveFileLookup", True)
+            .option("mode", "PERMISSIVE")
+            .option("columnNameOfCorruptRecord", CORRUPT_RECORD_COLUMN)
+        )
+        if schema is not None:
+            reader = reader.schema(with_corrupt_record_column(schema))
+        # Spark refuses to query only the corrupt record column of files, but it can be queried from the cache
+        raw = reader.load(self.path(source_bucket_uri)).cache()
+        if CORRUPT_RECORD_COLUMN not in raw.columns:
+            # An inferred schema only has the column if there are malformed records
+            self._malformed = None
+            return raw
+        corrupt = F.col(CORRUPT_RECORD_COLUMN)
+        self._malformed = raw.where(corrupt.isNotNull())
+        return raw.where(corrupt.isNull()).drop(CORRUPT_RECORD_COLUMN)
+
+    def malformed_records(self) -> int:
+        return 0 if self._malformed is None else self._malformed.count()
+
+    def append(
+        self,
+        df: DataFrame,
+        target_bucket_uri: str,
+        database_name: str,
+        table_name: str,
+        file_format: str,
+        compression: str,
+        register_partitions: bool = True,
+        partition_columns: Sequence[str] = (PARTITION_COLUMN,),
+    ) -> None:
+        # glueparquet only exists in Glue, it writes plain parquet files
+        writer = df.write.mode("append").format("parquet").option("compression", compression)
+        if register_partitions:
+            writer.option("path", self.path(target_bucket_uri)).partitionBy(*partition_columns).saveAsTable(
+                f"`{database_name}`.`{table_name}`"
+            )
+        else:
+            writer.partitionBy(*partition_columns).save(self.path(target_bucket_uri))
+
+    def put_object(self, uri: str, body: str) -> None:
+        path = self.path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(body)
+
+    def output_files(self, target_bucket_uri: str, partitions: Optional[Sequence[str]] = None) -> Iterator[OutputFile]:
+        for partition in partitions if partitions is not None else [""]:
+            for directory, _, files in os.walk(os.path.join(self.path(target_bucket_uri), partition)):
+                for file in files:
+                    path = os.path.join(directory, file)
+                    stat = os.stat(path)
+                    yield path, stat.st_size, datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+
+
+Backend = Union[GlueBackend, LocalBackend]
+
+
+def with_corrupt_record_column(schema: T.StructType) -> T.StructType:
+    return T.StructType(schema.fields + [T.StructField(CORRUPT_RECORD_COLUMN, T.StringType())])
+
+
+def to_glue_schema(schema: T.StructType) -> str:
+    """Converts a Spark schema into the json schema format of the glue readers."""
+    from awsglue import gluetypes  # type: ignore
+
+    def convert(data_type: T.DataType):
+        if isinstance(data_type, T.StructType):
+            return gluetypes.StructType([gluetypes.Field(field.name, convert(field.dataType)) for field in data_type])
+        if isinstance(data_type, T.ArrayType):
+            return gluetypes.ArrayType(convert(data_type.elementType))
+        # The simple types have the same names in both
+        return getattr(gluetypes, type(data_type).__name__)()
+
+    return json.dumps(convert(schema).jsonValue())
+
+
+def extract(
+    glue_context: "GlueContext",
+    source_bucket_uri: str,
+    data_format: str,
+    compression: str,
+    schema: Optional[T.StructType] = None,
+    transformation_ctx: str = "load_from_s3",
+) -> "DynamicFrame":
+    """Extract data from S3 and return it as a DynamicFrame (which also knows about the malformed records).
+
+    Without a schema, the schema is inferred from all records. With a schema, the inference pass is skipped and only
+    the columns of the schema are read.
+    """
+    format_options: Dict[str, Any] = {"multiline": False}
+    if schema is not None:
+        # withSchema only works with the (vectorized) SIMD reader
+        format_options = {**format_options, "optimizePerformance": True, "withSchema": to_glue_schema(schema)}
+    return glue_context.create_dynamic_frame.from_options(
+        format_options=format_options,
+        connection_type="s3",
+        format=data_format,
+        connection_options={
+            "paths": [source_bucket_uri],
+            "recurse": True,
+            "compression": compression,
+        },
+        transformation_ctx=transformation_ctx,
+    )
@@ -1,6 +1,44 @@
 from pyspark.sql import DataFrame, SparkSession
 from pyspark.sql import functions as F
-from pyspark.sql.types import IntegerType, StringType, TimestampType
+from pyspark.sql.types import (
+    IntegerType,
+    StringType,
+    StructField,
+    StructType,
+    TimestampType,
+)
+
+from .. import tables
+
+# Everything is read as a string, see the source_columns of the table registry (which also defines the raw table)
+SOURCE_SCHEMA = StructType(
+    [StructField(column, StringType()) for column in tables.get_table("journeys").source_columns]
+)
+
+# A journey which is loaded more than once (e.g. on a retry) is only kept once
+DEDUPLICATION_KEYS = ["journey_id"]
+
+# Rows without one of these (or whose value cannot be cast) are quarantined, see check_quality() in ../quality.py
+NOT_NULL_COLUMNS = ["journey_id", "customer_id", "scooter_id", "start_dt", "end_dt", "amount_cents"]
+
+# Size of a row in the snappy compressed parquet files, used to size the output files
+ESTIMATED_BYTES_PER_ROW = 40
+
+# Most queries filter on a customer or a scooter: the rows of every file are sorted by customer (so row groups can be
+# skipped via their min/max statistics) and both get bloom filters for lookups of single ids. The bloom filters need
+# Glue 4.0, which the stack only uses for Iceberg tables, the Glue 3.0 jobs only sort.
+SORT_COLUMNS = ["customer_id", "start_dt"]
+BLOOM_FILTER_COLUMNS = ["customer_id", "scooter_id"]
+
+
+def rollup(df: DataFrame) -> DataFrame:
+    """The journeys per customer and day (_created_at) of the converted journeys, see rollup_name in the registry"""
+    return df.groupBy("customer_id", "_created_at").agg(
+        F.count(F.lit(1)).alias("journeys"),
+        F.sum("amount_cents").cast("long").alias("amount_cents"),
+        F.min("start_dt").alias("first_start_dt"),
+        F.max("end_dt").alias("last_end_dt"),
+    )
 
 
 def transform(df: DataFrame, spark_session: SparkSession) -> DataFrame:
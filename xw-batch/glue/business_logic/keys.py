@@ -0,0 +1,94 @@
+"""The integer surrogate keys of string ids, which are the same in every table and run, see add_surrogate_keys()"""
+import threading
+from typing import List, Tuple
+
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+
+from .load import table_exists
+
+# The tables which map the string ids of a key mapping to their integer keys, see add_surrogate_keys()
+KEY_MAPPING_TABLE_PREFIX = "key_mapping_"
+# New keys are assigned by one table at a time, as tables which are converted concurrently can share a mapping. The
+# lock only works within the Spark session, the stack makes sure that only one job writes a mapping.
+_KEY_MAPPING_LOCK = threading.Lock()
+
+
+def parse_surrogate_keys(value: str) -> List[Tuple[str, str]]:
+    """The (id column, key mapping) pairs of a SURROGATE_KEYS argument like customer_id:customer,scooter_id:scooter"""
+    pairs = []
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        column, separator, mapping = pair.strip().partition(":")
+        if not separator or not column or not mapping:
+            raise ValueError(f"Expected <id column>:<key mapping> in SURROGATE_KEYS, got {pair}")
+        pairs.append((column, mapping))
+    return pairs
+
+
+def update_key_mapping(
+    ids: DataFrame, spark_session: SparkSession, key_mapping_uri: str, database_name: str, mapping: str
+) -> DataFrame:
+    """The keys of the ids (a column id), after new ids were given the next free keys of the key mapping.
+
+    The keys of a mapping are consecutive longs starting at 1 and never change, so the key of an id is the same in
+    every table and run. The mapping is appended to the table key_mapping_<mapping> (below key_mapping_uri), which can
+    be joined to get the ids of keys back.
+    """
+    table = f"`{database_name}`.`{KEY_MAPPING_TABLE_PREFIX}{mapping}`"
+    with _KEY_MAPPING_LOCK:
+        if table_exists(spark_session, database_name, f"{KEY_MAPPING_TABLE_PREFIX}{mapping}"):
+            existing = spark_session.table(table)
+            last_key = existing.agg(F.max("key")).first()[0] or 0
+            new_ids = ids.join(existing, "id", "left_anti")
+        else:
+            last_key = 0
+            new_ids = ids
+        # Numbers the new ids without moving all of them into one task, like a window over all rows would
+        new_keys = spark_session.createDataFrame(
+            new_ids.rdd.zipWithIndex().map(lambda pair: (pair[0]["id"], last_key + 1 + pair[1])),
+            "id string, key long",
+        ).localCheckpoint(eager=True)
+        added = new_keys.count()
+        if added:
+            (
+                new_keys.coalesce(1)
+                .write.mode("append")
+                .format("parquet")
+                .option("path", f"{key_mapping_uri.rstrip('/')}/{mapping}")
+                .saveAsTable(table)
+            )
+            print(f"Added {added} new keys after key {last_key} to the {mapping} key mapping")
+        # Read again, with the new keys
+        return spark_session.table(table).join(ids, "id", "left_semi")
+
+
+def add_surrogate_keys(
+    df: DataFrame,
+    spark_session: SparkSession,
+    surrogate_keys: List[Tuple[str, str]],
+    key_mapping_uri: str,
+    database_name: str,
+) -> DataFrame:
+    """Adds the integer key (<mapping>_key) of each id column of surrogate_keys, see update_key_mapping().
+
+    Grouping and joining on the keys (8 bytes) instead of the string ids needs less memory and shuffles less data.
+    Rows without an id get no key.
+    """
+    for column, mapping in surrogate_keys:
+        # Materialized, so that the batch is not read again for every step of the mapping update
+        ids = (
+            df.select(F.col(column).cast("string").alias("id"))
+            .where(F.col("id").isNotNull())
+            .distinct()
+            .localCheckpoint(eager=True)
+        )
+        keys = update_key_mapping(ids, spark_session, key_mapping_uri, database_name, mapping)
+        key_column = f"{mapping}_key"
+        df = df.join(
+            keys.withColumnRenamed("id", "_id").withColumnRenamed("key", key_column),
+            F.col(column).cast("string") == F.col("_id"),
+            "left",
+        ).drop("_id")
+    return df
@@ -0,0 +1,450 @@
+"""How the converted data is loaded into its table (the LOAD_MODEs) and laid out in files
+
+Used by glue/scripts/convert_to_parquet.py, which runs the loads.
+"""
+import math
+import operator
+from functools import reduce
+from typing import Dict, List, Optional, Sequence
+
+from pyspark.sql import Column, DataFrame, SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql.utils import AnalysisException
+
+# How the converted data is loaded into the target table
+LOAD_MODE_APPEND = "append"
+LOAD_MODE_OVERWRITE_PARTITIONS = "overwrite_partitions"
+# MERGE into an Iceberg table, needs Glue 4.0 with --datalake-formats iceberg and --ICEBERG_WAREHOUSE_URI, see
+# load_iceberg_merge()
+LOAD_MODE_ICEBERG_MERGE = "iceberg_merge"
+# The Spark catalog of the Iceberg tables (the Glue data catalog), see iceberg_spark_conf() of the conversion
+ICEBERG_CATALOG = "glue_catalog"
+
+PARTITION_COLUMN = "_created_at"
+# The partition columns of the PARTITION_SCHEMEs, the same as in business_logic/tables.py (which also has the layouts)
+PARTITION_SCHEME_DATE = "date"
+PARTITION_SCHEME_DATE_HOUR = "date_hour"
+PARTITION_SCHEME_YEAR_MONTH_DAY = "year_month_day"
+PARTITION_SCHEMES = {
+    PARTITION_SCHEME_DATE: [PARTITION_COLUMN],
+    PARTITION_SCHEME_DATE_HOUR: [PARTITION_COLUMN, "_created_hour"],
+    PARTITION_SCHEME_YEAR_MONTH_DAY: ["_created_year", "_created_month", "_created_day"],
+}
+
+# Used to size the output files of tables which do not declare an ESTIMATED_BYTES_PER_ROW
+DEFAULT_ESTIMATED_BYTES_PER_ROW = 100
+
+
+def load(
+    df_clean: DataFrame,
+    backend,
+    target_bucket_uri: str,
+    database_name: str,
+    table_name: str,
+    file_format: str,
+    compression: str,
+    target_file_size: Optional[int] = None,
+    bytes_per_row: int = DEFAULT_ESTIMATED_BYTES_PER_ROW,
+    sort_columns: Optional[List[str]] = None,
+    register_partitions: bool = True,
+    partition_columns: Sequence[str] = (PARTITION_COLUMN,),
+) -> None:
+    """Load data from a Spark DataFrame to S3 with the backend (GlueBackend or LocalBackend) of the conversion script.
+
+    Without register_partitions, only the files are written: the table must already exist with partition projection.
+    """
+    if target_file_size:
+        df_clean = size_output_files(
+            df_clean,
+            target_file_size=target_file_size,
+            bytes_per_row=bytes_per_row,
+            partition_columns=partition_columns,
+        )
+    df_clean = cluster(df_clean, sort_columns or [], partition_columns=partition_columns)
+    backend.append(
+        df_clean,
+        target_bucket_uri=target_bucket_uri,
+        database_name=database_name,
+        table_name=table_name,
+        file_format=file_format,
+        compression=compression,
+        register_partitions=register_partitions,
+        partition_columns=partition_columns,
+    )
+
+    return None
+
+
+def load_overwrite_partitions(
+    df_clean: DataFrame,
+    spark_session: SparkSession,
+    target_bucket_uri: str,
+    database_name: str,
+    table_name: str,
+    compression: str,
+    deduplication_keys: List[str],
+    target_file_size: Optional[int] = None,
+    bytes_per_row: int = DEFAULT_ESTIMATED_BYTES_PER_ROW,
+    sort_columns: Optional[List[str]] = None,
+    bloom_filter_columns: Optional[List[str]] = None,
+    register_partitions: bool = True,
+    partition_columns: Sequence[str] = (PARTITION_COLUMN,),
+) -> None:
+    """Load data from a Spark DataFrame to S3, replacing only the partitions which are in the data.
+
+    The new rows are merged with the rows already in these partitions and de-duplicated on deduplication_keys (new rows
+    win), so loading the same data again (a retry, a reset bookmark) does not duplicate it.
+
+    Without register_partitions, the partitions are read from and written to target_bucket_uri directly, without the
+    catalog: the table must already exist with partition projection (which has no partitions in the catalog).
+    """
+    # Otherwise an overwrite replaces the whole table
+    spark_session.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    allow_hive_dynamic_partitions(spark_session)
+    table = f"`{database_name}`.`{table_name}`"
+
+    writer_options = {
+        "compression": compression,
+        **parquet_bloom_filter_options(bloom_filter_columns or [], spark_version=spark_session.version),
+    }
+
+    def laid_out(df: DataFrame) -> DataFrame:
+        if target_file_size:
+            df = size_output_files(
+                df, target_file_size=target_file_size, bytes_per_row=bytes_per_row, partition_columns=partition_columns
+            )
+        return cluster(df, sort_columns or [], partition_columns=partition_columns)
+
+    if not register_partitions:
+        if path_exists(spark_session, target_bucket_uri):
+            existing = (
+                spark_session.read.schema(df_clean.schema)
+                .option("basePath", target_bucket_uri)
+                .parquet(target_bucket_uri)
+                .where(touched_partitions(df_clean, partition_columns))
+            )
+            # Materialized for the same reason as below
+            merged = merge(df_clean, existing, deduplication_keys).localCheckpoint(eager=True)
+        else:
+            merged = deduplicate(df_clean, deduplication_keys)
+        (
+            laid_out(merged)
+            .write.mode("overwrite")
+            .options(**writer_options)
+            .partitionBy(*partition_columns)
+            .parquet(target_bucket_uri)
+        )
+        return None
+
+    if not table_exists(spark_session, database_name, table_name):
+        (
+            laid_out(deduplicate(df_clean, deduplication_keys))
+            .write.format("parquet")
+            .options(**writer_options)
+            .option("path", target_bucket_uri)
+            .partitionBy(*partition_columns)
+            .saveAsTable(table)
+        )
+        return None
+
+    # Otherwise insertInto would drop them below
+    add_new_columns(spark_session, table, df_clean)
+    existing = spark_session.table(table).where(touched_partitions(df_clean, partition_columns))
+    merged = merge(df_clean, existing, deduplication_keys)
+
+    # The partitions are read and overwritten by the same job, so the merged rows have to be materialized before the
+    # overwrite deletes the old files (Spark refuses to overwrite a path it reads from otherwise)
+    merged = laid_out(merged.localCheckpoint(eager=True))
+    # insertInto matches the columns by position, not by name
+    merged.select(spark_session.table(table).columns).write.options(**writer_options).insertInto(table, overwrite=True)
+
+    return None
+
+
+def allow_hive_dynamic_partitions(spark_session: SparkSession) -> None:
+    """Lets insertInto overwrite the partitions in the data of a Hive SerDe table (e.g. one created by the Glue sink).
+
+    Spark writes into such tables with InsertIntoHiveTable unless it can convert the insert into a parquet data
+    source insert, and Hive refuses inserts with only dynamic partition values in its default strict mode.
+    """
+    spark_session.conf.set("hive.exec.dynamic.partition", "true")
+    spark_session.conf.set("hive.exec.dynamic.partition.mode", "nonstrict")
+
+
+def load_iceberg_merge(
+    df_clean: DataFrame,
+    spark_session: SparkSession,
+    target_bucket_uri: str,
+    database_name: str,
+    table_name: str,
+    compression: str,
+    deduplication_keys: List[str],
+    partition_source_column: str,
+    target_file_size: int,
+    sort_columns: Optional[List[str]] = None,
+    bloom_filter_columns: Optional[List[str]] = None,
+    partition_scheme: str = PARTITION_SCHEME_DATE,
+) -> None:
+    """Merges the data into an Iceberg table on the deduplication keys (rows with a known key are updated).
+
+    The table is created by the first load, partitioned by the days (or with the date_hour partition scheme the hours)
+    of partition_source_column (hidden partitioning: the partition columns of the scheme stay columns for the readers,
+    and the year_month_day scheme is partitioned by days like the date scheme). Like overwrite_partitions, only the
+    rows in the days of the new data are merged with. Every load is a single commit, so readers never see a
+    half-written load. The small files of many commits are compacted by maintain_iceberg_tables.py.
+    """
+    table = f"{ICEBERG_CATALOG}.`{database_name}`.`{table_name}`"
+    df_clean = deduplicate(df_clean, deduplication_keys)
+
+    if not table_exists(spark_session, database_name, table_name, catalog=ICEBERG_CATALOG):
+        writer = (
+            df_clean.limit(0)
+            .writeTo(table)
+            .using("iceberg")
+            .partitionedBy(
+                F.hours(partition_source_column)
+                if partition_scheme == PARTITION_SCHEME_DATE_HOUR
+                else F.days(partition_source_column)
+            )
+            .tableProperty("location", target_bucket_uri)
+            .tableProperty("format-version", "2")
+            .tableProperty("write.parquet.compression-codec", compression)
+            .tableProperty("write.target-file-size-bytes", str(target_file_size))
+            # One task (and so one file) per partition instead of one per partition and Spark partition
+            .tableProperty("write.distribution-mode", "hash")
+        )
+        for column in bloom_filter_columns or []:
+            writer = writer.tableProperty(f"write.parquet.bloom-filter-enabled.column.{column}", "true")
+        writer.create()
+        if sort_columns:
+            spark_session.sql(f"ALTER TABLE {table} WRITE ORDERED BY {', '.join(f'`{c}`' for c in sort_columns)}")
+    else:
+        # UPDATE SET * and INSERT * need all columns of the new rows in the table
+        add_new_columns(spark_session, table, df_clean)
+
+    if not deduplication_keys:
+        df_clean.writeTo(table).append()
+        return None
+
+    days = df_clean.select(
+        F.min(PARTITION_COLUMN).alias("first"), F.date_add(F.max(PARTITION_COLUMN), 1).alias("last")
+    ).first()
+    if days["first"] is None:
+        return None
+    # Tables which are converted concurrently need their own view
+    view = f"_merge_{table_name}"
+    df_clean.createOrReplaceTempView(view)
+    on = " AND ".join(f"target.`{key}` = source.`{key}`" for key in deduplication_keys)
+    spark_session.sql(
+        f"""
+        MERGE INTO {table} target
+        USING {view} source
+        ON {on}
+            AND target.`{partition_source_column}` >= TIMESTAMP '{days["first"]}'
+            AND target.`{partition_source_column}` < TIMESTAMP '{days["last"]}'
+        WHEN MATCHED THEN UPDATE SET *
+        WHEN NOT MATCHED THEN INSERT *
+        """
+    )
+    spark_session.catalog.dropTempView(view)
+    return None
+
+
+def read_converted_days(
+    df: DataFrame,
+    spark_session: SparkSession,
+    target_bucket_uri: str,
+    database_name: str,
+    table_name: str,
+    load_mode: str,
+    register_partitions: bool = True,
+    partition_columns: Sequence[str] = (PARTITION_COLUMN,),
+    all_days: bool = False,
+) -> DataFrame:
+    """The converted rows of the days which df has rows for, read back from the target table after the load.
+
+    Only the partitions of these days are read (all hours of a day with the date_hour partition scheme), which also
+    have the rows of earlier runs. With all_days, all converted rows are read instead.
+    """
+    if load_mode == LOAD_MODE_ICEBERG_MERGE:
+        converted = spark_session.table(f"{ICEBERG_CATALOG}.`{database_name}`.`{table_name}`")
+        return converted if all_days else converted.where(touched_partitions(df, [PARTITION_COLUMN]))
+    if register_partitions:
+        table = f"`{database_name}`.`{table_name}`"
+        # The session might not know the partitions of the load yet
+        spark_session.catalog.refreshTable(table)
+        converted = spark_session.table(table)
+    else:
+        converted = spark_session.read.option("basePath", target_bucket_uri).parquet(target_bucket_uri)
+    if all_days:
+        return converted
+    return converted.where(
+        touched_partitions(df, [column for column in partition_columns if column != "_created_hour"])
+    )
+
+
+def load_rollup(
+    rollup: DataFrame,
+    spark_session: SparkSession,
+    rollup_bucket_uri: str,
+    database_name: str,
+    rollup_table_name: str,
+    compression: str,
+    register_partitions: bool = True,
+) -> None:
+    """Replaces the days (_created_at partitions) of the rollup table which are in rollup, with a file per day."""
+    spark_session.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    allow_hive_dynamic_partitions(spark_session)
+    table = f"`{database_name}`.`{rollup_table_name}`"
+    rollup = rollup.repartition(PARTITION_COLUMN)
+    if not register_partitions:
+        (
+            rollup.write.mode("overwrite")
+            .option("compression", compression)
+            .partitionBy(PARTITION_COLUMN)
+            .parquet(rollup_bucket_uri)
+        )
+    elif not table_exists(spark_session, database_name, rollup_table_name):
+        (
+            rollup.write.format("parquet")
+            .option("compression", compression)
+            .option("path", rollup_bucket_uri)
+            .partitionBy(PARTITION_COLUMN)
+            .saveAsTable(table)
+        )
+    else:
+        # insertInto matches the columns by position, not by name
+        rollup.select(spark_session.table(table).columns).write.option("compression", compression).insertInto(
+            table, overwrite=True
+        )
+    return None
+
+
+def touched_partitions(df: DataFrame, partition_columns: Sequence[str] = (PARTITION_COLUMN,)) -> Column:
+    """A filter on the partitions which df has rows for, which only the files of these partitions are read with."""
+    touched = df.select(*partition_columns).distinct().collect()
+    if len(partition_columns) == 1:
+        return F.col(partition_columns[0]).isin([row[0] for row in touched])
+    return reduce(
+        operator.or_,
+        [reduce(operator.and_, [F.col(column) == row[column] for column in partition_columns]) for row in touched],
+        F.lit(False),
+    )
+
+
+def partition_paths(df: DataFrame, partition_columns: Sequence[str] = (PARTITION_COLUMN,)) -> List[str]:
+    """The paths of the partitions which df has rows for below the table, e.g. _created_at=2022-01-31/."""
+    touched = df.select(*partition_columns).distinct().collect()
+    return sorted("".join(f"{column}={row[column]}/" for column in partition_columns) for row in touched)
+
+
+def merge(df_new: DataFrame, existing: DataFrame, deduplication_keys: List[str]) -> DataFrame:
+    """The new and the existing rows, de-duplicated on deduplication_keys.
+
+    A column which only one of them has (e.g. after surrogate keys were turned on or off) is null in the other's rows.
+    """
+    # New rows come first, so they win over the existing ones
+    merged = df_new.withColumn("_load_order", F.lit(0)).unionByName(
+        existing.withColumn("_load_order", F.lit(1)), allowMissingColumns=True
+    )
+    return deduplicate(merged, deduplication_keys, order_by=F.col("_load_order")).drop("_load_order")
+
+
+def add_new_columns(spark_session: SparkSession, table: str, df: DataFrame) -> None:
+    """Adds the columns of df which the table does not have yet, e.g. the keys of newly enabled surrogate keys.
+
+    The existing rows get null in the new columns, the converted days have to be converted again to fill them.
+    """
+    existing = set(spark_session.table(table).columns)
+    new_fields = [field for field in df.schema.fields if field.name not in existing]
+    if not new_fields:
+        return None
+    print(f"Adding the new columns {', '.join(field.name for field in new_fields)} to {table}")
+    columns = ", ".join(f"`{field.name}` {field.dataType.simpleString()}" for field in new_fields)
+    spark_session.sql(f"ALTER TABLE {table} ADD COLUMNS ({columns})")
+    return None
+
+
+def deduplicate(df: DataFrame, keys: List[str], order_by=None) -> DataFrame:
+    """Keeps one row per key, the first one according to order_by (or any one without order_by)."""
+    if not keys:
+        return df
+    if order_by is None:
+        return df.dropDuplicates(keys)
+    window = Window.partitionBy(*keys).orderBy(order_by)
+    return df.withColumn("_row_number", F.row_number().over(window)).where("_row_number = 1").drop("_row_number")
+
+
+def table_exists(
+    spark_session: SparkSession, database_name: str, table_name: str, catalog: Optional[str] = None
+) -> bool:
+    """Catalog.tableExists(table, database) is only in Spark >= 3.3, Glue 3.0 has Spark 3.1.
+
+    With a catalog (e.g. the ICEBERG_CATALOG), the table is looked up in it instead of the session catalog. Spark 3.3
+    only looks up tableExists(name) in the session catalog, so it cannot be used for such tables either.
+    """
+    name = f"`{database_name}`.`{table_name}`"
+    try:
+        spark_session.table(f"{catalog}.{name}" if catalog else name)
+    except AnalysisException:
+        return False
+    return True
+
+
+def path_exists(spark_session: SparkSession, path: str) -> bool:
+    jvm = spark_session.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark_session.sparkContext._jsc.hadoopConfiguration()).exists(hadoop_path)
+
+
+def size_output_files(
+    df: DataFrame, target_file_size: int, bytes_per_row: int, partition_columns: Sequence[str] = (PARTITION_COLUMN,)
+) -> DataFrame:
+    """Repartitions the data, so that every partition is written as a few files of about target_file_size bytes.
+
+    Without this, every Spark partition writes a file into every table partition it has rows for, which results in many
+    tiny files. The size of the files is estimated from the rows per table partition.
+    """
+    partition = F.concat_ws("/", *[F.col(column).cast("string") for column in partition_columns])
+    rows_per_partition = {
+        row["_partition"]: row["count"] for row in df.groupBy(partition.alias("_partition")).count().collect()
+    }
+    if not rows_per_partition:
+        return df
+    files_per_partition = {
+        partition: max(1, math.ceil(rows * bytes_per_row / target_file_size))
+        for partition, rows in rows_per_partition.items()
+    }
+    files = F.create_map(*[F.lit(value) for item in files_per_partition.items() for value in item])
+    return (
+        # Spreads the rows of a table partition evenly over its files
+        df.withColumn("_file", F.pmod(F.xxhash64(*df.columns), files[partition]))
+        .repartition(sum(files_per_partition.values()), *partition_columns, "_file")
+        .drop("_file")
+    )
+
+
+def cluster(
+    df: DataFrame, sort_columns: List[str], partition_columns: Sequence[str] = (PARTITION_COLUMN,)
+) -> DataFrame:
+    """Sorts the rows within every file, so that the min/max statistics of its row groups and pages are selective.
+
+    Athena can then skip most row groups when filtering on the sort columns. Only parquet >= 1.11 (Glue 4.0, not Glue
+    3.0 with parquet 1.10) also writes the page indexes, with which Athena can skip most pages as well.
+    """
+    if not sort_columns:
+        return df
+    return df.sortWithinPartitions(*partition_columns, *sort_columns)
+
+
+def parquet_bloom_filter_options(columns: List[str], spark_version: str) -> Dict[str, str]:
+    """Parquet writer options for bloom filters, which let point lookups skip row groups on unsorted columns.
+
+    Only parquet >= 1.12 (Spark >= 3.2, so Glue 4.0) writes bloom filters. Glue 3.0 (Spark 3.1 with parquet 1.10) would
+    ignore the options, so there are none for older Spark versions.
+    """
+    major, minor = (int(part) for part in spark_version.split(".")[:2])
+    if columns and (major, minor) < (3, 2):
+        print(f"No bloom filters on {', '.join(columns)}, Spark {spark_version} has no parquet writer for them")
+        return {}
+    return {f"parquet.bloom.filter.enabled#{column}": "true" for column in columns}
@@ -0,0 +1,200 @@
+"""The metrics of a conversion run: wall time and Spark stage metrics per phase, and the written files
+
+They are sent to CloudWatch and saved as a run report, see publish_run_metrics().
+"""
+import contextlib
+import datetime
+import json
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+import boto3
+from py4j.protocol import Py4JError
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+from .backends import Backend, OutputFile
+from .load import ICEBERG_CATALOG
+
+# Metrics of the Spark stages (see spark.status.api.v1.StageData) which are collected per phase of a run
+STAGE_METRICS = {
+    "inputRecords": "input_rows",
+    "inputBytes": "input_bytes",
+    "outputRecords": "output_rows",
+    "outputBytes": "output_bytes",
+    "shuffleReadBytes": "shuffle_read_bytes",
+    "shuffleWriteBytes": "shuffle_write_bytes",
+    "memoryBytesSpilled": "memory_spilled_bytes",
+    "diskBytesSpilled": "disk_spilled_bytes",
+    "executorRunTime": "executor_run_millis",
+    "jvmGcTime": "gc_millis",
+}
+# The units of the metrics in CloudWatch
+METRIC_UNITS = {
+    "seconds": "Seconds",
+    "input_rows": "Count",
+    "input_bytes": "Bytes",
+    "output_rows": "Count",
+    "output_bytes": "Bytes",
+    "shuffle_read_bytes": "Bytes",
+    "shuffle_write_bytes": "Bytes",
+    "memory_spilled_bytes": "Bytes",
+    "disk_spilled_bytes": "Bytes",
+    "executor_run_millis": "Milliseconds",
+    "gc_millis": "Milliseconds",
+    "output_files": "Count",
+}
+
+
+def log_output_files(files: Iterator[OutputFile], written_since: datetime.datetime) -> Tuple[int, int]:
+    """Logs the files and bytes per table partition which were written by this run and returns the totals."""
+    files_per_partition: Dict[str, List[int]] = {}
+    for key, size, last_modified in files:
+        # e.g. _created_at=2022-01-31/_created_hour=13 with the date_hour partition scheme
+        partition = "/".join(part for part in key.split("/") if "=" in part)
+        if partition and last_modified >= written_since:
+            files_per_partition.setdefault(partition, []).append(size)
+    for partition, sizes in sorted(files_per_partition.items()):
+        print(f"Wrote {len(sizes)} files with {sum(sizes)} bytes into {partition}")
+    all_sizes = [size for sizes in files_per_partition.values() for size in sizes]
+    print(f"Wrote {len(all_sizes)} files with {sum(all_sizes)} bytes into {len(files_per_partition)} partitions")
+    return len(all_sizes), sum(all_sizes)
+
+
+def log_iceberg_commits(
+    spark_session: SparkSession, database_name: str, table_name: str, committed_since: datetime.datetime
+) -> Tuple[int, int]:
+    """Logs the files and bytes which the commits of this run added to the Iceberg table and returns the totals.
+
+    Iceberg keeps these numbers in the summary of every snapshot, so no files have to be listed.
+    """
+    snapshots = spark_session.table(f"{ICEBERG_CATALOG}.`{database_name}`.`{table_name}`.snapshots")
+    files = size = 0
+    for row in snapshots.where(F.col("committed_at") >= F.lit(committed_since)).collect():
+        files += int(row["summary"].get("added-data-files", 0))
+        size += int(row["summary"].get("added-files-size", 0))
+    print(f"Wrote {files} files with {size} bytes into {database_name}.{table_name}")
+    return files, size
+
+
+def next_stage_id(spark_session: SparkSession) -> int:
+    """The id of the next Spark stage, the ids are given to the stages in the order they are submitted."""
+    return spark_session.sparkContext._jsc.sc().dagScheduler().nextStageId().get()
+
+
+def completed_stages(spark_session: SparkSession, stage_ids: range) -> List[Dict[str, Any]]:
+    """The metrics of the stages with stage_ids which completed, from the status store behind the Spark UI.
+
+    The stages are looked up by id, instead of listing all stages of the application which the store keeps.
+    """
+    context = spark_session.sparkContext._jsc.sc()
+    # The status store is updated by a listener, which might not know about the last stages yet
+    context.listenerBus().waitUntilEmpty(10_000)
+    store = context.statusStore()
+    completed = []
+    for stage_id in stage_ids:
+        try:
+            stage = store.lastStageAttempt(stage_id)
+        except Py4JError:
+            # Stages which were never submitted (e.g. skipped, as their shuffle output already existed) are not stored
+            continue
+        if stage.status().toString() != "COMPLETE":
+            continue
+        metrics = {"stage_id": stage.stageId(), "attempt_id": stage.attemptId(), "name": stage.name()}
+        for field, metric in STAGE_METRICS.items():
+            try:
+                metrics[metric] = getattr(stage, field)()
+            except Py4JError:
+                # e.g. jvmGcTime is not in all Spark versions
+                metrics[metric] = 0
+        completed.append(metrics)
+    return completed
+
+
+class RunMetrics:
+    """Collects the wall time and the Spark stage metrics per phase (e.g. extract, check_quality, load) of a run.
+
+    The stages of a phase are the ones which were submitted while the phase ran. When several tables are converted at
+    the same time (see etl_tables()), the phases of one table also get the stages which the others submitted meanwhile.
+    """
+
+    def __init__(self, spark_session: SparkSession, table_name: str):
+        self.spark_session = spark_session
+        self.table_name = table_name
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.phases: Dict[str, Dict[str, Any]] = {}
+        self.output_files = 0
+        self.output_bytes = 0
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measures the code in the with block as the phase, a phase which runs more than once is added up.
+
+        Spark is lazy, so a phase only gets the stages of the actions in the block (e.g. a write), and the stages of
+        the transformations which these actions run.
+        """
+        first_stage_id = next_stage_id(self.spark_session)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            stages = completed_stages(self.spark_session, range(first_stage_id, next_stage_id(self.spark_session)))
+            phase = self.phases.setdefault(
+                name, {"seconds": 0.0, **{metric: 0 for metric in STAGE_METRICS.values()}, "stages": []}
+            )
+            phase["seconds"] += seconds
+            for stage in stages:
+                for metric in STAGE_METRICS.values():
+                    phase[metric] += stage[metric]
+            phase["stages"].extend(stages)
+
+    def report(self, status: str) -> Dict[str, Any]:
+        return {
+            "table": self.table_name,
+            "started": self.started.isoformat(),
+            "status": status,
+            "output_files": self.output_files,
+            "output_bytes": self.output_bytes,
+            "phases": self.phases,
+        }
+
+    def metric_data(self) -> List[Any]:
+        """The totals of the phases as CloudWatch metric data, with the table and the phase as dimensions."""
+        data = [
+            {
+                "MetricName": "output_files",
+                "Dimensions": [{"Name": "Table", "Value": self.table_name}],
+                "Value": self.output_files,
+                "Unit": METRIC_UNITS["output_files"],
+            }
+        ]
+        for name, phase in self.phases.items():
+            for metric in ("seconds", *STAGE_METRICS.values()):
+                data.append(
+                    {
+                        "MetricName": metric,
+                        "Dimensions": [{"Name": "Table", "Value": self.table_name}, {"Name": "Phase", "Value": name}],
+                        "Value": phase[metric],
+                        "Unit": METRIC_UNITS[metric],
+                    }
+                )
+        return data
+
+
+def publish_run_metrics(metrics: RunMetrics, status: str, args: Dict[str, str], backend: Backend) -> None:
+    """Sends the metrics to CloudWatch (in METRICS_NAMESPACE) and saves the run report (below RUN_REPORT_URI).
+
+    Empty arguments turn either off, e.g. for local runs.
+    """
+    if args["RUN_REPORT_URI"]:
+        uri = f"{args['RUN_REPORT_URI'].rstrip('/')}/{metrics.table_name}/{metrics.started:%Y-%m-%dT%H%M%S.%f}.json"
+        backend.put_object(uri, json.dumps(metrics.report(status), indent=2, sort_keys=True))
+        print(f"Run report saved to {uri}")
+    if args["METRICS_NAMESPACE"]:
+        cloudwatch = boto3.client("cloudwatch")
+        data = metrics.metric_data()
+        while data:
+            # The maximum per request
+            cloudwatch.put_metric_data(Namespace=args["METRICS_NAMESPACE"], MetricData=data[:20])
+            data = data[20:]
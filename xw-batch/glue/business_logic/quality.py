@@ -0,0 +1,121 @@
+"""The data quality checks of the conversion, see check_quality()"""
+import datetime
+import operator
+from functools import reduce
+from typing import Dict, Tuple
+
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame
+from pyspark.sql import functions as F
+from pyspark.sql import types as T
+
+from .load import PARTITION_COLUMN
+
+# The table with the data quality summaries of all converted tables, see check_quality()
+QUALITY_TABLE_NAME = "data_quality"
+QUALITY_CHECK_NOT_NULL = "not_null"
+QUALITY_CHECK_CAST = "cast"
+QUALITY_CHECK_DUPLICATE_KEYS = "duplicate_keys"
+
+
+def check_quality(
+    source: DataFrame,
+    args: Dict[str, str],
+    backend,
+    table_definition,
+    started: datetime.datetime,
+) -> Tuple[DataFrame, DataFrame]:
+    """Checks the source rows of a run in a single aggregation.
+
+    The checks are per column of the transformed data which is also in the source:
+    - cast: the source value is not null, but its cast to the type of the transformed column is
+    - not_null: the transformed value is null, for the NOT_NULL_COLUMNS of the table and the partition column
+    - duplicate_keys: rows with the DEDUPLICATION_KEYS of another row of the run (only reported, the load
+      de-duplicates), rows with a null key are not duplicates of each other (a null NOT_NULL_COLUMNS key fails not_null)
+
+    The failures per partition are appended to the data_quality table below QUALITY_BUCKET_URI, so that they can be
+    tested instead of the whole converted table. With a QUARANTINE_BUCKET_URI, the source rows which fail a cast or
+    not_null check are written there (as json, with the failed checks) instead of being converted.
+
+    The backend is the GlueBackend or LocalBackend of the conversion script. Returns the rows to convert and the
+    checked rows, which are cached until they are unpersisted after the load.
+    """
+    spark_session = backend.spark_session
+    table_name = args["TARGET_TABLE_NAME"]
+    quarantine_uri = args.get("QUARANTINE_BUCKET_URI")
+    # Only planned, for the types of the transformed columns
+    target_types = {field.name: field.dataType for field in table_definition.transform(source, spark_session).schema}
+    not_null_columns = getattr(table_definition, "NOT_NULL_COLUMNS", [])
+    keys = getattr(table_definition, "DEDUPLICATION_KEYS", [])
+
+    # (column, check, failed)
+    checks = []
+    for column, data_type in target_types.items():
+        if column not in source.columns:
+            continue
+        value = F.col(column)
+        if data_type != source.schema[column].dataType:
+            checks.append((column, QUALITY_CHECK_CAST, value.isNotNull() & value.cast(data_type).isNull()))
+        if column in not_null_columns:
+            checks.append((column, QUALITY_CHECK_NOT_NULL, value.cast(data_type).isNull()))
+    partition_var = args["SOURCE_PARTITION_VAR"]
+    # The same as add_column_partition_date() of the transformed column
+    partition = F.to_date(F.col(partition_var).cast(target_types.get(partition_var, T.StringType())))
+    checks.append((PARTITION_COLUMN, QUALITY_CHECK_NOT_NULL, partition.isNull()))
+
+    checked = source.select(
+        "*",
+        partition.alias("_partition"),
+        *[failed.alias(f"_check_{index}") for index, (_, _, failed) in enumerate(checks)],
+    ).persist(StorageLevel.MEMORY_AND_DISK)
+    aggregations = [F.count(F.lit(1)).alias("_rows")] + [
+        F.sum(F.col(f"_check_{index}").cast("long")).alias(f"_check_{index}") for index in range(len(checks))
+    ]
+    if keys:
+        # countDistinct skips the rows with a null key, so they are not counted on the other side either
+        with_keys = reduce(operator.and_, [F.col(key).isNotNull() for key in keys])
+        duplicate_keys = F.count(F.when(with_keys, True)) - F.countDistinct(*keys)
+        aggregations.append(duplicate_keys.alias("_duplicate_keys"))
+    summary = []
+    for row in checked.groupBy("_partition").agg(*aggregations).collect():
+        failures = [(column, check, row[f"_check_{index}"]) for index, (column, check, _) in enumerate(checks)]
+        if keys:
+            failures.append((",".join(keys), QUALITY_CHECK_DUPLICATE_KEYS, row["_duplicate_keys"]))
+        for column, check, count in failures:
+            if count:
+                print(f"{count} of {row['_rows']} rows of {row['_partition']} failed the {check} check of {column}")
+            summary.append(
+                (table_name, started, row["_partition"], column, check, count, row["_rows"], bool(quarantine_uri))
+            )
+
+    if args["QUALITY_BUCKET_URI"]:
+        (
+            spark_session.createDataFrame(
+                summary,
+                "table_name string, run_started timestamp, _created_at date, column_name string, check_name string, "
+                "failures long, rows long, quarantined boolean",
+            )
+            .coalesce(1)
+            .write.mode("append")
+            .format("parquet")
+            .option("path", backend.path(args["QUALITY_BUCKET_URI"]))
+            .partitionBy("table_name")
+            .saveAsTable(f"`{args['TARGET_DB_NAME']}`.`{QUALITY_TABLE_NAME}`")
+        )
+
+    if not quarantine_uri:
+        # From the cache, instead of reading the source again
+        return checked.select(*source.columns), checked
+    failed_checks = F.concat_ws(
+        ",",
+        *[
+            F.when(F.col(f"_check_{index}"), F.lit(f"{check}:{column}"))
+            for index, (column, check, _) in enumerate(checks)
+        ],
+    )
+    checked_rows = checked.withColumn("_failed_checks", failed_checks)
+    quarantined = checked_rows.where(F.col("_failed_checks") != "").select(*source.columns, "_failed_checks")
+    quarantined.write.mode("append").json(
+        backend.path(f"{quarantine_uri.rstrip('/')}/{table_name}/{started:%Y-%m-%dT%H%M%S.%f}/"), compression="gzip"
+    )
+    return checked_rows.where(F.col("_failed_checks") == "").select(*source.columns), checked
@@ -0,0 +1,187 @@
+"""The registry of the tables which are converted to parquet
+
+Used by the stack (to create the jobs and the raw tables) and by the conversion script, so it must not import pyspark.
+What happens to the data of a table (its transform(), de-duplication keys and clustering) is declared in
+business_logic/convert/<name>.py.
+"""
+import dataclasses
+import importlib
+import types
+from typing import Dict, List, Optional, Tuple
+
+# A failing table fails the job, after the other tables of the same job are converted. As the bookmarks are not moved,
+# the next run converts the data of all tables again, which is why several tables cannot be converted with LOAD_MODE
+# append (only with overwrite_partitions, the stack default, or iceberg_merge).
+FAILURE_POLICY_FAIL = "fail"
+# A failing table is only logged and the job succeeds. The bookmarks are not moved either (they are per job, not per
+# table), so the next run converts the data of the skipped table (and of all others) again.
+FAILURE_POLICY_SKIP = "skip"
+
+# How the converted data is partitioned, all partitions are derived from the source_partition_var. _created_at (the
+# date) is a column in all schemes, but only a partition in the first two.
+# _created_at=2022-01-31/
+PARTITION_SCHEME_DATE = "date"
+# _created_at=2022-01-31/_created_hour=13/, for tables which are queried by the hour
+PARTITION_SCHEME_DATE_HOUR = "date_hour"
+# _created_year=2022/_created_month=1/_created_day=31/
+PARTITION_SCHEME_YEAR_MONTH_DAY = "year_month_day"
+# The partition columns of the schemes as athena types, the same as add_column_partition_date() of the conversion adds
+PARTITION_SCHEMES = {
+    PARTITION_SCHEME_DATE: (("_created_at", "date"),),
+    PARTITION_SCHEME_DATE_HOUR: (("_created_at", "date"), ("_created_hour", "int")),
+    PARTITION_SCHEME_YEAR_MONTH_DAY: (("_created_year", "int"), ("_created_month", "int"), ("_created_day", "int")),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerSizing:
+    """The Glue workers of a run which converts up to max_input_mb of pending source data (None for any size)"""
+
+    max_input_mb: Optional[int]
+    worker_type: str
+    workers: int
+
+
+# An hourly run fits on the minimum of workers, a backfill of days or weeks gets bigger and more workers. Tune it with
+# the measured input and the chosen sizing of past runs, which are saved next to the run reports.
+DEFAULT_SIZING: Tuple[WorkerSizing, ...] = (
+    WorkerSizing(max_input_mb=1024, worker_type="G.1X", workers=2),
+    WorkerSizing(max_input_mb=10 * 1024, worker_type="G.1X", workers=10),
+    WorkerSizing(max_input_mb=None, worker_type="G.2X", workers=20),
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class ConvertedTable:
+    # Also the name of the converted table and its module in business_logic/convert/
+    name: str
+    # Where the raw data is, below the raw bucket
+    source_path: str
+    # The columns of the raw data which are converted. All are read as strings and only cast in transform(), so that a
+    # change of the json types in the source does not break the conversion. Also the columns of the raw table.
+    source_columns: Tuple[str, ...] = ()
+    source_format: str = "json"
+    source_compression: str = "gzip"
+    # The column which the _created_at partition is derived from
+    source_partition_var: str = "start_dt"
+    # The date layout of the directories below source_path (e.g. "yyyy/MM/dd"), which the raw table projects as its dt
+    # partition. None for data which is not laid out by date, the raw table then has no partitions.
+    source_partition_format: Optional[str] = None
+    # Every run writes files of about this size into each partition (instead of many tiny files)
+    target_file_size_mb: int = 128
+    failure_policy: str = FAILURE_POLICY_FAIL
+    # The columns of the converted table (without the partition columns) as athena types and its first partition, for
+    # the stack to define the table with partition projection. Must match what transform() returns.
+    columns: Tuple[Tuple[str, str], ...] = ()
+    first_partition: str = "2022-01-01"
+    # One of PARTITION_SCHEMES. Changing it changes the layout of the converted files, so the table has to be converted
+    # again from scratch (and its catalog table deleted, unless the stack defines it).
+    partition_scheme: str = PARTITION_SCHEME_DATE
+    # The string ids which get an integer key next to them when the stack turns on surrogate keys: (id column, name of
+    # the key mapping), the key column is <mapping>_key. Tables which share a mapping (e.g. of customers) get the same
+    # key for the same id, but must not be converted by separate jobs at the same time.
+    surrogate_keys: Tuple[Tuple[str, str], ...] = ()
+    # The table which the conversion writes the rollup() (see business_logic/convert/<name>.py) of the converted rows
+    # into, partitioned by day (_created_at), and its columns without _created_at (for partition projection)
+    rollup_name: Optional[str] = None
+    rollup_columns: Tuple[Tuple[str, str], ...] = ()
+    # Picked by the pending input of a run, the first one which fits. Only for tables with their own job.
+    sizing: Tuple[WorkerSizing, ...] = DEFAULT_SIZING
+
+    def __post_init__(self):
+        if self.failure_policy not in (FAILURE_POLICY_FAIL, FAILURE_POLICY_SKIP):
+            raise ValueError(f"Unknown failure policy of table {self.name}: {self.failure_policy}")
+        if self.partition_scheme not in PARTITION_SCHEMES:
+            raise ValueError(f"Unknown partition scheme of table {self.name}: {self.partition_scheme}")
+        if len({mapping for _, mapping in self.surrogate_keys}) != len(self.surrogate_keys):
+            raise ValueError(f"Every surrogate key of table {self.name} needs its own key mapping")
+        if not self.sizing or self.sizing[-1].max_input_mb is not None:
+            raise ValueError(f"The last sizing of table {self.name} must have no max_input_mb (fits any input)")
+
+    @property
+    def partition_columns(self) -> Tuple[Tuple[str, str], ...]:
+        return PARTITION_SCHEMES[self.partition_scheme]
+
+    @property
+    def data_columns(self) -> Tuple[Tuple[str, str], ...]:
+        """The columns of the converted files, incl. _created_at if it is not a partition"""
+        partitions = {name for name, _ in self.partition_columns}
+        return self.columns + tuple(
+            column for column in PARTITION_SCHEMES[PARTITION_SCHEME_DATE] if column[0] not in partitions
+        )
+
+    @property
+    def surrogate_key_columns(self) -> Tuple[Tuple[str, str], ...]:
+        """The columns of the surrogate keys as athena types, which the converted files have with surrogate keys"""
+        return tuple((f"{mapping}_key", "bigint") for _, mapping in self.surrogate_keys)
+
+    @property
+    def surrogate_keys_argument(self) -> str:
+        """The SURROGATE_KEYS argument of the conversion, e.g. customer_id:customer,scooter_id:scooter"""
+        return ",".join(f"{column}:{mapping}" for column, mapping in self.surrogate_keys)
+
+    @property
+    def loaded_at_expression(self) -> str:
+        """The (athena) timestamp up to which the table is loaded, as the loaded_at_field of its dbt source"""
+        if self.partition_scheme == PARTITION_SCHEME_DATE_HOUR:
+            return "date_add('hour', _created_hour, cast(_created_at as timestamp))"
+        return "cast(_created_at as timestamp)"
+
+    @property
+    def recent_partitions_filter(self) -> str:
+        """An (athena) filter on the partition columns for the data since yesterday, e.g. for the dbt freshness check"""
+        if self.partition_scheme == PARTITION_SCHEME_YEAR_MONTH_DAY:
+            return (
+                "_created_year * 10000 + _created_month * 100 + _created_day"
+                + " >= year(current_date - interval '1' day) * 10000 + month(current_date - interval '1' day) * 100"
+                + " + day(current_date - interval '1' day)"
+            )
+        return "_created_at >= current_date - interval '1' day"
+
+    def definition(self) -> types.ModuleType:
+        """The module with the transform() etc. of this table, needs pyspark"""
+        return importlib.import_module(f"{__package__}.convert.{self.name}")
+
+
+TABLES: List[ConvertedTable] = [
+    ConvertedTable(
+        "journeys",
+        source_path="/raw/scoofy/journeys/",
+        source_columns=("journey_id", "customer_id", "scooter_id", "start_dt", "end_dt", "amount_cents"),
+        columns=(
+            ("journey_id", "string"),
+            ("customer_id", "string"),
+            ("scooter_id", "string"),
+            ("start_dt", "timestamp"),
+            ("end_dt", "timestamp"),
+            ("amount_cents", "int"),
+        ),
+        # Grouped and joined by in dbt
+        surrogate_keys=(("customer_id", "customer"), ("scooter_id", "scooter")),
+        # What agg_journey_per_customer of dbt sums up, instead of all journeys
+        rollup_name="journeys_per_customer_daily",
+        rollup_columns=(
+            ("customer_id", "string"),
+            ("journeys", "bigint"),
+            ("amount_cents", "bigint"),
+            ("first_start_dt", "timestamp"),
+            ("last_end_dt", "timestamp"),
+        ),
+    ),
+]
+
+
+def key_mapping_tables(tables: List[ConvertedTable]) -> Dict[str, List[str]]:
+    """The names of the tables which add new ids to a key mapping, per key mapping"""
+    mappings: Dict[str, List[str]] = {}
+    for table in tables:
+        for _, mapping in table.surrogate_keys:
+            mappings.setdefault(mapping, []).append(table.name)
+    return mappings
+
+
+def get_table(name: str) -> ConvertedTable:
+    for table in TABLES:
+        if table.name == name:
+            return table
+    raise ValueError(f"Unknown table {name}, add it to business_logic/tables.py")
@@ -1,142 +1,598 @@
+"""
+Converts the raw json data of a table into a partitioned parquet table.
+
+In a Glue job, the data is read with bookmarks and the table is registered in the Glue data catalog. The same conversion
+also runs on a local SparkSession (e.g. to profile or benchmark it), without awsglue:
+
+```bash
+python glue/scripts/convert_to_parquet.py --local --root /tmp/xw --SOURCE_BUCKET_URI s3://raw/scoofy/journeys/ \
+    --TARGET_BUCKET_URI s3://raw/converted/journeys/ --TARGET_DB_NAME converted --TARGET_TABLE_NAME journeys
+```
+
+Locally, s3 uris are directories below --root (s3://raw/x is <root>/raw/x) and the tables are registered in a local
+catalog, see LocalBackend.
+
+With --TABLE_NAMES (and --RAW_BUCKET_URI instead of the source and target arguments), several tables of the registry
+in business_logic/tables.py are converted concurrently in the same Spark session, see etl_tables(). With
+--STREAMING_TRIGGER and --CHECKPOINT_URI, the new files of a table are converted as a structured stream, see
+etl_stream().
+
+The script only orchestrates the conversion. Where it runs (Glue or local) is in business_logic/backends.py, the load
+modes, quality checks, surrogate keys and run metrics are in load.py, quality.py, keys.py and metrics.py next to it.
+"""
+import argparse
+import concurrent.futures
+import datetime
 import importlib
+import os
 import sys
-from typing import Dict
-
-# Every awsglue line has to be ignored as we cannot install this from pypi :-(
-from awsglue import DynamicFrame  # type: ignore
-from awsglue.context import GlueContext  # type: ignore
-from awsglue.job import Job  # type: ignore
+import traceback
+from typing import Any, Dict, List, Optional
 
-# from awsglue.transforms import *  # type: ignore
-from awsglue.utils import getResolvedOptions  # type: ignore
-from pyspark.context import SparkContext
 from pyspark.sql import DataFrame
 from pyspark.sql import functions as F
 
+# In Glue, business_logic comes from the extra python files, locally from the glue folder next to the scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from business_logic.backends import (  # type: ignore  # noqa: E402
+    CORRUPT_RECORD_COLUMN,
+    LOCAL_CATALOG_HIVE,
+    LOCAL_CATALOG_IN_MEMORY,
+    Backend,
+    GlueBackend,
+    LocalBackend,
+    with_corrupt_record_column,
+)
+from business_logic.keys import (  # type: ignore  # noqa: E402
+    add_surrogate_keys,
+    parse_surrogate_keys,
+)
+from business_logic.load import (  # type: ignore  # noqa: E402
+    DEFAULT_ESTIMATED_BYTES_PER_ROW,
+    ICEBERG_CATALOG,
+    LOAD_MODE_APPEND,
+    LOAD_MODE_ICEBERG_MERGE,
+    LOAD_MODE_OVERWRITE_PARTITIONS,
+    PARTITION_COLUMN,
+    PARTITION_SCHEME_DATE,
+    PARTITION_SCHEMES,
+    load,
+    load_iceberg_merge,
+    load_overwrite_partitions,
+    load_rollup,
+    partition_paths,
+    path_exists,
+    read_converted_days,
+    table_exists,
+)
+from business_logic.metrics import (  # type: ignore  # noqa: E402
+    RunMetrics,
+    log_iceberg_commits,
+    log_output_files,
+    publish_run_metrics,
+)
+from business_logic.quality import check_quality  # type: ignore  # noqa: E402
 
-def extract(
-    glue_context: GlueContext,
-    source_bucket_uri: str,
-    data_format: str,
-    compression: str,
-) -> DataFrame:
-    """Extract data from S3 and return it as a Spark DataFrame."""
-    return glue_context.create_dynamic_frame.from_options(
-        format_options={"multiline": False},
-        connection_type="s3",
-        format=data_format,
-        connection_options={
-            "paths": [source_bucket_uri],
-            "recurse": True,
-            "compression": compression,
-        },
-        transformation_ctx="load_from_s3",
-    ).toDF()
-
-
-def load(
-    df_clean: DataFrame,
-    glue_context: GlueContext,
-    target_bucket_uri: str,
-    database_name: str,
-    table_name: str,
-    file_format: str,
-    compression: str,
-) -> None:
-    """Load data from a Spark DataFrame to S3."""
-    df_clean_dynamic = DynamicFrame.fromDF(df_clean, glue_context, table_name)
-
-    sink = glue_context.getSink(
-        path=target_bucket_uri,
-        connection_type="s3",
-        updateBehavior="UPDATE_IN_DATABASE",
-        partitionKeys=["_created_at"],
-        compression=compression,
-        enableUpdateCatalog=True,
-        transformation_ctx="load_into_s3",
-    )
-    sink.setCatalogInfo(
-        catalogDatabase=database_name,
-        catalogTableName=table_name,
-    )
-    sink.setFormat(file_format)
-    sink.writeFrame(df_clean_dynamic)
+# How the partition columns are derived from the SOURCE_PARTITION_VAR
+PARTITION_COLUMN_FUNCTIONS = {
+    PARTITION_COLUMN: F.to_date,
+    "_created_hour": F.hour,
+    "_created_year": F.year,
+    "_created_month": F.month,
+    "_created_day": F.dayofmonth,
+}
+
+# What happens with source records which do not match the source schema
+MALFORMED_RECORDS_FAIL = "fail"
+MALFORMED_RECORDS_DROP = "drop"
+
+# When a streaming conversion (see etl_stream()) stops: after all new files are converted in one micro batch ("once") or
+# in several ones ("available_now"). Any other value is a processing time interval of a stream which keeps running.
+STREAMING_TRIGGER_ONCE = "once"
+STREAMING_TRIGGER_AVAILABLE_NOW = "available_now"
 
+
+def check_malformed_records(malformed_records: int, policy: str) -> None:
+    """Fails on malformed source records (which are not part of the converted data) if the policy says so.
+
+    Runs before the load, so a failed run leaves the target untouched. Failing the job also means that the bookmark is
+    not moved, so the next run reads the same data again.
+    """
+    if not malformed_records:
+        return None
+    if policy == MALFORMED_RECORDS_FAIL:
+        raise ValueError(f"Found {malformed_records} malformed source records, see the error records in the job logs")
+    if policy != MALFORMED_RECORDS_DROP:
+        raise ValueError(f"Unknown malformed records policy: {policy}")
+    print(f"Dropped {malformed_records} malformed source records")
     return None
 
 
 # transform
-def add_column_partition_date(df: DataFrame, source_partition_variable: str):
-    """Adds a column to the dataframe which acts as a date partition."""
-    return df.withColumn("_created_at", F.to_date(F.col(source_partition_variable)))
 
 
-def etl(args: Dict[str, str], glue_context: GlueContext) -> None:
+def add_column_partition_date(
+    df: DataFrame, source_partition_variable: str, partition_scheme: str = PARTITION_SCHEME_DATE
+) -> DataFrame:
+    """Adds the partition columns of the partition scheme to the dataframe, and always the date as _created_at."""
+    if partition_scheme not in PARTITION_SCHEMES:
+        raise ValueError(f"Unknown partition scheme: {partition_scheme}")
+    for column in dict.fromkeys([PARTITION_COLUMN, *PARTITION_SCHEMES[partition_scheme]]):
+        df = df.withColumn(column, PARTITION_COLUMN_FUNCTIONS[column](F.col(source_partition_variable)))
+    return df
+
+
+def etl(args: Dict[str, str], backend: Backend) -> None:
     """Extract, transform and load data by orchestrating the corresponding functions."""
-    # source
-    source_bucket_uri = args["SOURCE_BUCKET_URI"]
-    source_compression_type = args["SOURCE_COMPRESSION_TYPE"]
+    # get schema definition
+    table_definition = importlib.import_module(f"business_logic.convert.{args['TARGET_TABLE_NAME']}")
+    metrics = RunMetrics(backend.spark_session, args["TARGET_TABLE_NAME"])
+    status = "failed"
+    try:
+        with metrics.phase("extract"):
+            source = backend.extract(
+                data_format=args["SOURCE_FORMAT"],
+                source_bucket_uri=args["SOURCE_BUCKET_URI"],
+                compression=args["SOURCE_COMPRESSION_TYPE"],
+                # Tables without a SOURCE_SCHEMA get their schema inferred
+                schema=getattr(table_definition, "SOURCE_SCHEMA", None),
+            )
+            check_malformed_records(backend.malformed_records(), args["MALFORMED_RECORDS_POLICY"])
+        transform_and_load(source, args, backend, table_definition, metrics)
+        source.unpersist()
+        status = "succeeded"
+    finally:
+        publish_run_metrics(metrics, status, args, backend)
+
+
+def transform_and_load(
+    source: DataFrame, args: Dict[str, str], backend: Backend, table_definition, metrics: RunMetrics
+) -> None:
+    """Transforms the source data with the business logic of the table and loads it into the target table."""
     source_partition_var = args["SOURCE_PARTITION_VAR"]
-    source_format = args["SOURCE_FORMAT"]
     # destination
     target_bucket_uri = args["TARGET_BUCKET_URI"]
     target_db_name = args["TARGET_DB_NAME"]
     target_table_name = args["TARGET_TABLE_NAME"]
     target_compression_type = args["TARGET_COMPRESSION_TYPE"]
     target_format = args["TARGET_FORMAT"]
+    load_mode = args["LOAD_MODE"]
+    target_file_size = int(args["TARGET_FILE_SIZE_MB"]) * 1024 * 1024
+    register_partitions = args["REGISTER_PARTITIONS"] == "true"
+    partition_scheme = args["PARTITION_SCHEME"]
 
-    df = extract(
-        glue_context=glue_context,
-        data_format=source_format,
-        source_bucket_uri=source_bucket_uri,
-        compression=source_compression_type,
-    )
+    checked = None
+    if args["QUALITY_BUCKET_URI"] or args.get("QUARANTINE_BUCKET_URI"):
+        with metrics.phase("check_quality"):
+            source, checked = check_quality(source, args, backend, table_definition, started=metrics.started)
 
-    # transform
-    # get schema definition
-    table_definition = importlib.import_module(f"business_logic.convert.{target_table_name}")
+    # transform, which is not a phase of its own: Spark only plans it here, and runs it as part of the load
+    df = table_definition.transform(source, backend.spark_session)
+    df = add_column_partition_date(
+        df=df, source_partition_variable=source_partition_var, partition_scheme=partition_scheme
+    )
+    partitioned = df
 
-    df = table_definition.transform(df, glue_context.spark_session)
-    df = add_column_partition_date(df=df, source_partition_variable=source_partition_var)
+    if args.get("KEY_MAPPING_URI") and args.get("SURROGATE_KEYS"):
+        with metrics.phase("surrogate_keys"):
+            df = add_surrogate_keys(
+                df,
+                spark_session=backend.spark_session,
+                surrogate_keys=parse_surrogate_keys(args["SURROGATE_KEYS"]),
+                key_mapping_uri=backend.path(args["KEY_MAPPING_URI"]),
+                database_name=target_db_name,
+            )
 
     # load
-    load(
-        df_clean=df,
-        glue_context=glue_context,
-        target_bucket_uri=target_bucket_uri,
-        file_format=target_format,
-        database_name=target_db_name,
-        table_name=target_table_name,
-        compression=target_compression_type,
+    # The estimate can be adjusted with the bytes per row of the files which are logged below
+    bytes_per_row = getattr(table_definition, "ESTIMATED_BYTES_PER_ROW", DEFAULT_ESTIMATED_BYTES_PER_ROW)
+    sort_columns = getattr(table_definition, "SORT_COLUMNS", [])
+    load_started = datetime.datetime.now(datetime.timezone.utc)
+    with metrics.phase("load"):
+        if load_mode == LOAD_MODE_OVERWRITE_PARTITIONS:
+            load_overwrite_partitions(
+                df_clean=df,
+                spark_session=backend.spark_session,
+                target_bucket_uri=backend.path(target_bucket_uri),
+                database_name=target_db_name,
+                table_name=target_table_name,
+                compression=target_compression_type,
+                # e.g. journey_id for journeys, rows are only de-duplicated if the table defines a key
+                deduplication_keys=getattr(table_definition, "DEDUPLICATION_KEYS", []),
+                target_file_size=target_file_size,
+                bytes_per_row=bytes_per_row,
+                sort_columns=sort_columns,
+                bloom_filter_columns=getattr(table_definition, "BLOOM_FILTER_COLUMNS", []),
+                register_partitions=register_partitions,
+                partition_columns=PARTITION_SCHEMES[partition_scheme],
+            )
+        elif load_mode == LOAD_MODE_ICEBERG_MERGE:
+            load_iceberg_merge(
+                df_clean=df,
+                spark_session=backend.spark_session,
+                target_bucket_uri=target_bucket_uri,
+                database_name=target_db_name,
+                table_name=target_table_name,
+                compression=target_compression_type,
+                deduplication_keys=getattr(table_definition, "DEDUPLICATION_KEYS", []),
+                partition_source_column=source_partition_var,
+                target_file_size=target_file_size,
+                sort_columns=sort_columns,
+                bloom_filter_columns=getattr(table_definition, "BLOOM_FILTER_COLUMNS", []),
+                partition_scheme=partition_scheme,
+            )
+        elif load_mode == LOAD_MODE_APPEND:
+            load(
+                df_clean=df,
+                backend=backend,
+                target_bucket_uri=target_bucket_uri,
+                file_format=target_format,
+                database_name=target_db_name,
+                table_name=target_table_name,
+                compression=target_compression_type,
+                target_file_size=target_file_size,
+                bytes_per_row=bytes_per_row,
+                # The glue parquet writer has no bloom filters
+                sort_columns=sort_columns,
+                register_partitions=register_partitions,
+                partition_columns=PARTITION_SCHEMES[partition_scheme],
+            )
+        else:
+            raise ValueError(f"Unknown load mode: {load_mode}")
+    if load_mode == LOAD_MODE_ICEBERG_MERGE:
+        files, size = log_iceberg_commits(
+            backend.spark_session, target_db_name, target_table_name, committed_since=load_started
+        )
+    else:
+        # Only the partitions of the run are listed, not the whole table
+        partitions = partition_paths(partitioned, PARTITION_SCHEMES[partition_scheme])
+        files, size = log_output_files(backend.output_files(target_bucket_uri, partitions), written_since=load_started)
+    metrics.output_files += files
+    metrics.output_bytes += size
+
+    rollup_table_name = args.get("ROLLUP_TABLE_NAME")
+    if rollup_table_name:
+        # Aggregated from the converted table instead of the new rows, which would count a journey which is loaded
+        # again (e.g. on a retry) twice and miss the rows of earlier runs in the same days
+        with metrics.phase("rollup"):
+            # Next to the converted table
+            rollup_bucket_uri = backend.path(f"{target_bucket_uri.rstrip('/').rsplit('/', 1)[0]}/{rollup_table_name}")
+            if register_partitions:
+                rollup_exists = table_exists(backend.spark_session, target_db_name, rollup_table_name)
+            else:
+                rollup_exists = path_exists(backend.spark_session, rollup_bucket_uri)
+            converted = read_converted_days(
+                # The days of the new rows, without the surrogate keys (which would join the key mappings again)
+                partitioned,
+                spark_session=backend.spark_session,
+                target_bucket_uri=backend.path(target_bucket_uri),
+                database_name=target_db_name,
+                table_name=target_table_name,
+                load_mode=load_mode,
+                register_partitions=register_partitions,
+                partition_columns=PARTITION_SCHEMES[partition_scheme],
+                # The first rollup is seeded with all days converted so far, which the bookmarks won't convert again
+                all_days=not rollup_exists,
+            )
+            load_rollup(
+                table_definition.rollup(converted),
+                spark_session=backend.spark_session,
+                rollup_bucket_uri=rollup_bucket_uri,
+                database_name=target_db_name,
+                rollup_table_name=rollup_table_name,
+                compression=target_compression_type,
+                register_partitions=register_partitions,
+            )
+    if checked is not None:
+        checked.unpersist()
+
+
+def stream_trigger(trigger: str) -> Dict[str, Any]:
+    """The arguments of DataStreamWriter.trigger() for a STREAMING_TRIGGER."""
+    if trigger == STREAMING_TRIGGER_ONCE:
+        return {"once": True}
+    if trigger == STREAMING_TRIGGER_AVAILABLE_NOW:
+        # Only in Spark >= 3.3 (Glue 4.0)
+        return {"availableNow": True}
+    # e.g. "5 minutes" for a job which keeps running
+    return {"processingTime": trigger}
+
+
+def etl_stream(args: Dict[str, str], backend: Backend) -> None:
+    """Converts the source files which are new since the last run as a structured stream, instead of with bookmarks.
+
+    The files which are already converted are tracked in the checkpoint at CHECKPOINT_URI. Every micro batch is merged
+    into the partitions it touches (like LOAD_MODE overwrite_partitions), so a micro batch which is processed again
+    after a failure is not duplicated. Appending could duplicate it, so there is no LOAD_MODE for streams.
+    """
+    table_definition = importlib.import_module(f"business_logic.convert.{args['TARGET_TABLE_NAME']}")
+    schema = getattr(table_definition, "SOURCE_SCHEMA", None)
+    if schema is None:
+        raise ValueError(f"Streaming needs a SOURCE_SCHEMA in business_logic/convert/{args['TARGET_TABLE_NAME']}.py")
+    malformed_records_policy = args["MALFORMED_RECORDS_POLICY"]
+    batch_args = {**args, "LOAD_MODE": LOAD_MODE_OVERWRITE_PARTITIONS}
+
+    reader = (
+        backend.spark_session.readStream.format(args["SOURCE_FORMAT"])
+        .schema(with_corrupt_record_column(schema))
+        .option("recursiveFileLookup", True)
+        .option("mode", "PERMISSIVE")
+        .option("columnNameOfCorruptRecord", CORRUPT_RECORD_COLUMN)
     )
+    if int(args["MAX_FILES_PER_TRIGGER"]):
+        # Bounds the size of the micro batches, e.g. for the first run over all existing files
+        reader = reader.option("maxFilesPerTrigger", int(args["MAX_FILES_PER_TRIGGER"]))
+    source = reader.load(backend.path(args["SOURCE_BUCKET_URI"]))
 
+    def load_batch(batch: DataFrame, batch_id: int) -> None:
+        print(f"Converting micro batch {batch_id}")
+        # Every micro batch is a run of its own, so that the metrics of a stream which keeps running are published
+        metrics = RunMetrics(backend.spark_session, args["TARGET_TABLE_NAME"])
+        status = "failed"
+        try:
+            corrupt = F.col(CORRUPT_RECORD_COLUMN)
+            with metrics.phase("extract"):
+                # Spark refuses to query only the corrupt record column of files, but it can be queried from the cache
+                batch = batch.cache()
+                # Fails the stream before the micro batch is loaded or committed to the checkpoint
+                check_malformed_records(batch.where(corrupt.isNotNull()).count(), malformed_records_policy)
+            transform_and_load(
+                batch.where(corrupt.isNull()).drop(CORRUPT_RECORD_COLUMN),
+                batch_args,
+                backend,
+                table_definition,
+                metrics,
+            )
+            batch.unpersist()
+            status = "succeeded"
+        finally:
+            publish_run_metrics(metrics, status, args, backend)
 
-def main():
-    args = getResolvedOptions(
-        sys.argv,
-        [
-            "JOB_NAME",
-            "SOURCE_BUCKET_URI",
-            "SOURCE_PARTITION_VAR",
-            "SOURCE_FORMAT",
-            "SOURCE_COMPRESSION_TYPE",
-            "TARGET_BUCKET_URI",
-            "TARGET_DB_NAME",
-            "TARGET_TABLE_NAME",
-            "TARGET_COMPRESSION_TYPE",
-            "TARGET_FORMAT",
-        ],
+    query = (
+        source.writeStream.foreachBatch(load_batch)
+        .option("checkpointLocation", backend.path(args["CHECKPOINT_URI"]))
+        .trigger(**stream_trigger(args["STREAMING_TRIGGER"]))
+        .start()
     )
+    query.awaitTermination()
+
+
+def table_job_arguments(table, args: Dict[str, str]) -> Dict[str, str]:
+    """The arguments of a single table conversion of the registered table, see etl_tables()."""
+    raw_bucket_uri = args["RAW_BUCKET_URI"].rstrip("/")
+    return {
+        **args,
+        "SOURCE_BUCKET_URI": f"{raw_bucket_uri}{table.source_path}",
+        "SOURCE_FORMAT": table.source_format,
+        "SOURCE_COMPRESSION_TYPE": table.source_compression,
+        "SOURCE_PARTITION_VAR": table.source_partition_var,
+        "TARGET_BUCKET_URI": f"{raw_bucket_uri}/converted/{table.name}",
+        "TARGET_TABLE_NAME": table.name,
+        "TARGET_FILE_SIZE_MB": str(table.target_file_size_mb),
+        "PARTITION_SCHEME": table.partition_scheme,
+        **({"SURROGATE_KEYS": table.surrogate_keys_argument} if "KEY_MAPPING_URI" in args else {}),
+        **({"ROLLUP_TABLE_NAME": table.rollup_name} if table.rollup_name else {}),
+    }
+
+
+def etl_tables(args: Dict[str, str], backend: Backend) -> List[str]:
+    """Converts the tables in TABLE_NAMES concurrently in the same Spark session.
+
+    Startup costs are paid once per job instead of once per table, and the tables share the workers: while one table
+    waits (e.g. for s3 or a shuffle with a few big partitions), the tasks of the others run. A failing table does not
+    stop the others, its failure policy in the registry decides if the job fails in the end. Returns the tables which
+    failed and were skipped.
+
+    The bookmarks of all tables are moved together, or not at all (if a table failed or was skipped), in which case
+    the next run converts the data of every table again. Only the idempotent load modes can do that, not append.
+    """
+    from business_logic import tables  # type: ignore
+
+    if args["LOAD_MODE"] == LOAD_MODE_APPEND:
+        raise ValueError(
+            "LOAD_MODE append cannot convert several tables, the tables which did not fail would get the rows of a "
+            "failed run twice"
+        )
+    registered_tables = [tables.get_table(name.strip()) for name in args["TABLE_NAMES"].split(",") if name.strip()]
+    failed = []
+    skipped = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(args["MAX_CONCURRENT_TABLES"])) as executor:
+        futures = {
+            executor.submit(etl, table_job_arguments(table, args), backend.for_table(table.name)): table
+            for table in registered_tables
+        }
+        for future in concurrent.futures.as_completed(futures):
+            table = futures[future]
+            try:
+                future.result()
+            except Exception:
+                print(f"Converting {table.name} failed (failure policy {table.failure_policy}):")
+                traceback.print_exc()
+                if table.failure_policy == tables.FAILURE_POLICY_FAIL:
+                    failed.append(table.name)
+                else:
+                    skipped.append(table.name)
+                continue
+            print(f"Converted {table.name}")
+    if failed:
+        raise RuntimeError(f"Converting {', '.join(sorted(failed))} failed, see the errors above")
+    return sorted(skipped)
+
+
+JOB_ARGUMENTS = [
+    "SOURCE_BUCKET_URI",
+    "SOURCE_PARTITION_VAR",
+    "SOURCE_FORMAT",
+    "SOURCE_COMPRESSION_TYPE",
+    "TARGET_BUCKET_URI",
+    "TARGET_DB_NAME",
+    "TARGET_TABLE_NAME",
+    "TARGET_COMPRESSION_TYPE",
+    "TARGET_FORMAT",
+    "LOAD_MODE",
+    "MALFORMED_RECORDS_POLICY",
+    "TARGET_FILE_SIZE_MB",
+    # How the converted data is partitioned, see PARTITION_SCHEMES
+    "PARTITION_SCHEME",
+    # false: only write the files of the partitions, for tables which the stack defines with partition projection
+    "REGISTER_PARTITIONS",
+    # Empty to not send metrics or save a run report, see publish_run_metrics()
+    "METRICS_NAMESPACE",
+    "RUN_REPORT_URI",
+    # Empty to not check the quality, see business_logic/quality.py
+    "QUALITY_BUCKET_URI",
+]
+
+# The defaults of a local run, the same as the ones of the Glue job in the stack
+LOCAL_JOB_ARGUMENT_DEFAULTS = {
+    "SOURCE_PARTITION_VAR": "start_dt",
+    "SOURCE_FORMAT": "json",
+    "SOURCE_COMPRESSION_TYPE": "gzip",
+    "TARGET_COMPRESSION_TYPE": "snappy",
+    "TARGET_FORMAT": "glueparquet",
+    "LOAD_MODE": LOAD_MODE_OVERWRITE_PARTITIONS,
+    "MALFORMED_RECORDS_POLICY": MALFORMED_RECORDS_FAIL,
+    "TARGET_FILE_SIZE_MB": "128",
+    "PARTITION_SCHEME": PARTITION_SCHEME_DATE,
+    "REGISTER_PARTITIONS": "true",
+    "METRICS_NAMESPACE": "",
+    "RUN_REPORT_URI": "",
+    "QUALITY_BUCKET_URI": "",
+}
+
+# The arguments of a job which converts several tables, the rest of the JOB_ARGUMENTS comes from the table registry
+BATCH_JOB_ARGUMENTS = [
+    "TABLE_NAMES",
+    "RAW_BUCKET_URI",
+    "TARGET_DB_NAME",
+    "TARGET_COMPRESSION_TYPE",
+    "TARGET_FORMAT",
+    "LOAD_MODE",
+    "MALFORMED_RECORDS_POLICY",
+    "MAX_CONCURRENT_TABLES",
+    "REGISTER_PARTITIONS",
+    "METRICS_NAMESPACE",
+    "RUN_REPORT_URI",
+    "QUALITY_BUCKET_URI",
+]
+
+LOCAL_BATCH_JOB_ARGUMENT_DEFAULTS = {**LOCAL_JOB_ARGUMENT_DEFAULTS, "MAX_CONCURRENT_TABLES": "4"}
+
+# The arguments of a streaming conversion of a table, see etl_stream()
+STREAM_JOB_ARGUMENTS = [
+    *(name for name in JOB_ARGUMENTS if name != "LOAD_MODE"),
+    "STREAMING_TRIGGER",
+    "CHECKPOINT_URI",
+    # 0 for no limit
+    "MAX_FILES_PER_TRIGGER",
+]
+
+LOCAL_STREAM_JOB_ARGUMENT_DEFAULTS = {**LOCAL_JOB_ARGUMENT_DEFAULTS, "MAX_FILES_PER_TRIGGER": "0"}
 
-    sc = SparkContext()
+
+# The arguments which are only passed to some jobs
+OPTIONAL_JOB_ARGUMENTS = [
+    # Only for LOAD_MODE iceberg_merge, see iceberg_spark_conf()
+    "ICEBERG_WAREHOUSE_URI",
+    # Where the key mappings of the SURROGATE_KEYS are, see business_logic/keys.py. A job of several tables gets the
+    # surrogate keys of each table from the registry.
+    "KEY_MAPPING_URI",
+    "SURROGATE_KEYS",
+    # The daily rollup of a table with a rollup() (next to the converted table), see load_rollup() in
+    # business_logic/load.py. A job of several tables gets the rollups of the tables from the registry.
+    "ROLLUP_TABLE_NAME",
+    # Where the rows which fail the quality checks go instead of being converted, see business_logic/quality.py.
+    # Without it, these rows are converted (and only counted in the summary below QUALITY_BUCKET_URI).
+    "QUARANTINE_BUCKET_URI",
+]
+
+
+def job_arguments(argv: List[str]) -> List[str]:
+    """The arguments of the kind of conversion which the arguments in argv ask for."""
+    optional = [name for name in OPTIONAL_JOB_ARGUMENTS if f"--{name}" in argv]
+    if "--TABLE_NAMES" in argv:
+        return BATCH_JOB_ARGUMENTS + optional
+    if "--STREAMING_TRIGGER" in argv:
+        return STREAM_JOB_ARGUMENTS + optional
+    return JOB_ARGUMENTS + optional
+
+
+def iceberg_spark_conf(warehouse_uri: str) -> Dict[str, str]:
+    """The Spark config of the Iceberg catalog, which Glue does not allow to be passed as --conf by the stack."""
+    catalog = f"spark.sql.catalog.{ICEBERG_CATALOG}"
+    return {
+        "spark.sql.extensions": "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions",
+        catalog: "org.apache.iceberg.spark.SparkCatalog",
+        f"{catalog}.warehouse": warehouse_uri,
+        f"{catalog}.catalog-impl": "org.apache.iceberg.aws.glue.GlueCatalog",
+        f"{catalog}.io-impl": "org.apache.iceberg.aws.s3.S3FileIO",
+    }
+
+
+def run(args: Dict[str, str], backend: Backend) -> List[str]:
+    """Runs the conversion of the arguments, returns the tables which were skipped (see etl_tables())."""
+    if "TABLE_NAMES" in args:
+        return etl_tables(args, backend)
+    if "STREAMING_TRIGGER" in args:
+        etl_stream(args, backend)
+    else:
+        etl(args, backend)
+    return []
+
+
+def main():
+    from awsglue.context import GlueContext  # type: ignore
+    from awsglue.job import Job  # type: ignore
+    from awsglue.utils import getResolvedOptions  # type: ignore
+    from pyspark.conf import SparkConf
+    from pyspark.context import SparkContext
+
+    args = getResolvedOptions(sys.argv, ["JOB_NAME", *job_arguments(sys.argv)])
+
+    conf = SparkConf()
+    if "ICEBERG_WAREHOUSE_URI" in args:
+        conf.setAll(list(iceberg_spark_conf(args["ICEBERG_WAREHOUSE_URI"]).items()))
+    sc = SparkContext(conf=conf)
     glue_context = GlueContext(sc)
     job = Job(glue_context)
     job.init(args["JOB_NAME"], args)
 
-    etl(args, glue_context)
+    skipped = run(args, GlueBackend(glue_context))
+    if skipped:
+        # The bookmarks are per job: moving them would lose the data of the skipped tables
+        print(f"Skipped {', '.join(skipped)}, the bookmarks are not moved, the next run converts the same data again")
+        return
 
     job.commit()
 
 
+def main_local(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Runs the conversion on a local SparkSession, see the module docs")
+    parser.add_argument("--local", action="store_true", help="run locally instead of in a Glue job")
+    parser.add_argument("--root", default=".local", help="directory with the local s3 buckets and the catalog")
+    parser.add_argument("--catalog", choices=[LOCAL_CATALOG_HIVE, LOCAL_CATALOG_IN_MEMORY], default=LOCAL_CATALOG_HIVE)
+    defaults = {**LOCAL_BATCH_JOB_ARGUMENT_DEFAULTS, **LOCAL_STREAM_JOB_ARGUMENT_DEFAULTS}
+    for name in dict.fromkeys(JOB_ARGUMENTS + BATCH_JOB_ARGUMENTS + STREAM_JOB_ARGUMENTS + OPTIONAL_JOB_ARGUMENTS):
+        parser.add_argument(f"--{name}", default=defaults.get(name))
+    argv = sys.argv[1:] if argv is None else argv
+    options = vars(parser.parse_args(argv))
+    args = {name: options[name] for name in job_arguments(argv)}
+    missing = [name for name, value in args.items() if value is None]
+    if missing:
+        parser.error(f"the following arguments are required: {', '.join(f'--{name}' for name in missing)}")
+
+    backend = LocalBackend(options["root"], catalog_implementation=options["catalog"])
+    # In AWS, the database is part of the stack
+    backend.spark_session.sql(f"CREATE DATABASE IF NOT EXISTS `{args['TARGET_DB_NAME']}`")
+    try:
+        run(args, backend)
+    finally:
+        backend.spark_session.stop()
+
+
 if __name__ == "__main__":
-    main()
+    # Glue starts the script without --local
+    if "--local" in sys.argv:
+        main_local()
+    else:
+        main()
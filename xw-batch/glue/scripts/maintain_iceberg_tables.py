@@ -0,0 +1,88 @@
+"""
+Compacts the Iceberg tables of the conversion (LOAD_MODE iceberg_merge) and expires their old snapshots.
+
+Every conversion run commits a snapshot with a few small files per touched day. Readers (Athena, dbt) have to open
+all of them, so this job regularly rewrites the small files of a table into files of about TARGET_FILE_SIZE_MB and
+rewrites its manifests. Snapshots older than SNAPSHOT_RETENTION_DAYS (but at least the last RETAIN_LAST_SNAPSHOTS) are
+expired afterwards, which deletes the files only they reference.
+
+Needs Glue 4.0 with --datalake-formats iceberg and the same ICEBERG_WAREHOUSE_URI as the conversion.
+"""
+import datetime
+import sys
+from typing import Dict, List
+
+from pyspark.sql import SparkSession
+
+# See convert_to_parquet.py
+ICEBERG_CATALOG = "glue_catalog"
+
+JOB_ARGUMENTS = [
+    # Comma separated
+    "TABLE_NAMES",
+    "DATABASE_NAME",
+    "ICEBERG_WAREHOUSE_URI",
+    "TARGET_FILE_SIZE_MB",
+    "SNAPSHOT_RETENTION_DAYS",
+    "RETAIN_LAST_SNAPSHOTS",
+]
+
+
+def iceberg_spark_conf(warehouse_uri: str) -> Dict[str, str]:
+    """The same as iceberg_spark_conf() of convert_to_parquet.py (the scripts are deployed as single files)."""
+    catalog = f"spark.sql.catalog.{ICEBERG_CATALOG}"
+    return {
+        "spark.sql.extensions": "org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions",
+        catalog: "org.apache.iceberg.spark.SparkCatalog",
+        f"{catalog}.warehouse": warehouse_uri,
+        f"{catalog}.catalog-impl": "org.apache.iceberg.aws.glue.GlueCatalog",
+        f"{catalog}.io-impl": "org.apache.iceberg.aws.s3.S3FileIO",
+    }
+
+
+def maintenance_statements(table: str, args: Dict[str, str], now: datetime.datetime) -> List[str]:
+    """The Iceberg procedure calls which compact the table (database.table) and expire its old snapshots."""
+    target_file_size = int(args["TARGET_FILE_SIZE_MB"]) * 1024 * 1024
+    expire_before = now - datetime.timedelta(days=int(args["SNAPSHOT_RETENTION_DAYS"]))
+    procedures = f"{ICEBERG_CATALOG}.system"
+    return [
+        # Only files which are much smaller (or bigger) than the target are rewritten, so a compact table is cheap
+        f"CALL {procedures}.rewrite_data_files(table => '{table}', "
+        + f"options => map('target-file-size-bytes', '{target_file_size}', 'partial-progress.enabled', 'true'))",
+        f"CALL {procedures}.rewrite_manifests(table => '{table}')",
+        f"CALL {procedures}.expire_snapshots(table => '{table}', "
+        + f"older_than => TIMESTAMP '{expire_before:%Y-%m-%d %H:%M:%S}', "
+        + f"retain_last => {int(args['RETAIN_LAST_SNAPSHOTS'])})",
+    ]
+
+
+def maintain_tables(spark_session: SparkSession, args: Dict[str, str]) -> None:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for table_name in [name.strip() for name in args["TABLE_NAMES"].split(",") if name.strip()]:
+        for statement in maintenance_statements(f"{args['DATABASE_NAME']}.{table_name}", args, now):
+            print(statement)
+            for row in spark_session.sql(statement).collect():
+                print(row.asDict())
+
+
+def main():
+    from awsglue.context import GlueContext  # type: ignore
+    from awsglue.job import Job  # type: ignore
+    from awsglue.utils import getResolvedOptions  # type: ignore
+    from pyspark.conf import SparkConf
+    from pyspark.context import SparkContext
+
+    args = getResolvedOptions(sys.argv, ["JOB_NAME", *JOB_ARGUMENTS])
+
+    sc = SparkContext(conf=SparkConf().setAll(list(iceberg_spark_conf(args["ICEBERG_WAREHOUSE_URI"]).items())))
+    glue_context = GlueContext(sc)
+    job = Job(glue_context)
+    job.init(args["JOB_NAME"], args)
+
+    maintain_tables(glue_context.spark_session, args)
+
+    job.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+# Sharded backfills
+
+A backfill is too big for a single lambda run, so it's split up:
+
+1. plan_shards() partitions the source key space into shards of consecutive keys, using the (cheap) listing
+2. copy_shard() syncs one shard, many of these run in parallel, shard_result() is what they report
+3. summarize() combines the results of all shards into a report
+
+The orchestration is done by a step functions state machine, see CopyS3Data. Its payloads are limited to 256 KB, so
+the shards and their results are saved as objects below a directory per backfill run (save_shards(),
+save_shard_result()) and only the keys of the shards are passed through the state machine.
+"""
+import itertools
+import json
+import posixpath
+import typing
+
+from . import s3_copy
+
+DEFAULT_KEYS_PER_SHARD = 10000
+
+
+def plan_shards(
+    client,
+    source_bucket_uri: str,
+    *,
+    keys_per_shard: int = DEFAULT_KEYS_PER_SHARD,
+) -> typing.List[typing.Dict[str, typing.Optional[str]]]:
+    """Partitions all source keys into shards of (start_after, last_key] key ranges"""
+    source_bucket, source_prefix = s3_copy.parse_s3_uri(source_bucket_uri)
+    shards: typing.List[typing.Dict[str, typing.Optional[str]]] = []
+    start_after: typing.Optional[str] = None
+    last_key: typing.Optional[str] = None
+    for index, obj in enumerate(s3_copy.list_objects(client, source_bucket, source_prefix), start=1):
+        last_key = obj.key
+        if index % keys_per_shard == 0:
+            shards.append({"start_after": start_after, "last_key": last_key})
+            start_after = last_key
+    if last_key is not None and last_key != start_after:
+        shards.append({"start_after": start_after, "last_key": last_key})
+    return shards
+
+
+def _until(objects: typing.Iterable[s3_copy.S3Object], last_key: str) -> typing.Iterator[s3_copy.S3Object]:
+    return itertools.takewhile(lambda obj: obj.key <= last_key, objects)
+
+
+def copy_shard(
+    client,
+    source_bucket_uri: str,
+    target_bucket_uri: str,
+    shard: typing.Dict[str, typing.Optional[str]],
+    *,
+    max_concurrency: int = s3_copy.DEFAULT_MAX_CONCURRENCY,
+    should_stop: typing.Callable[[], bool] = lambda: False,
+    copier: typing.Optional[s3_copy.Copier] = None,
+) -> s3_copy.CopyResult:
+    """Syncs all objects of a shard"""
+    copier = copier or s3_copy.Copier()
+    source_bucket, source_prefix = s3_copy.parse_s3_uri(source_bucket_uri)
+    target_bucket, target_prefix = s3_copy.parse_s3_uri(target_bucket_uri)
+    start_after = shard["start_after"]
+    last_key = typing.cast(str, shard["last_key"])
+
+    def to_target_key(key: str) -> str:
+        return s3_copy.target_key_for(key, source_prefix=source_prefix, target_prefix=target_prefix)
+
+    source_listing = s3_copy.Listing(
+        _until(s3_copy.list_objects(client, source_bucket, source_prefix, start_after=start_after), last_key)
+    )
+    target_listing = s3_copy.Listing(
+        _until(
+            copier.list_targets(
+                client, target_bucket, target_prefix, start_after=to_target_key(start_after) if start_after else None
+            ),
+            to_target_key(last_key),
+        )
+    )
+    tasks = s3_copy.plan_sync(source_listing, target_listing, source_prefix=source_prefix, target_prefix=target_prefix)
+    result = s3_copy.copy_objects(
+        client,
+        tasks,
+        source_bucket=source_bucket,
+        target_bucket=target_bucket,
+        max_concurrency=max_concurrency,
+        should_stop=should_stop,
+        copier=copier,
+    )
+    result.listed = source_listing.count
+    result.skipped = source_listing.count - len(tasks)
+    result.listing_seconds = source_listing.seconds + target_listing.seconds
+    return result
+
+
+def shard_result(
+    shard: typing.Dict[str, typing.Optional[str]], result: s3_copy.CopyResult
+) -> typing.Dict[str, typing.Any]:
+    """The (json serializable) result of a shard, which is passed on to summarize()"""
+    return {
+        **shard,
+        "planned": result.listed - result.skipped,
+        "copied": len(result.copied),
+        "copied_bytes": result.copied_bytes,
+        "failed": {task.source.key: repr(error) for task, error in result.failed.items()},
+        "stopped_early": result.stopped_early,
+    }
+
+
+def summarize(shard_results: typing.List[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """Combines the results of all shards, incomplete shards have to be copied again by another backfill"""
+    incomplete = [result for result in shard_results if result["failed"] or result["stopped_early"]]
+    return {
+        "shards": len(shard_results),
+        "copied": sum(result["copied"] for result in shard_results),
+        "copied_bytes": sum(result["copied_bytes"] for result in shard_results),
+        "failed": sum(len(result["failed"]) for result in shard_results),
+        "incomplete_shards": incomplete,
+    }
+
+
+def save_shards(client, run_uri: str, shards: typing.List[typing.Dict[str, typing.Optional[str]]]) -> typing.List[str]:
+    """Saves every shard as an object below the run directory and returns their keys"""
+    bucket, prefix = s3_copy.parse_s3_uri(run_uri)
+    keys = []
+    for index, shard in enumerate(shards):
+        key = f"{prefix}shards/{index:06}.json"
+        _put_json(client, bucket, key, shard)
+        keys.append(key)
+    return keys
+
+
+def load_shard(client, bucket: str, shard_key: str) -> typing.Dict[str, typing.Optional[str]]:
+    return _get_json(client, bucket, shard_key)
+
+
+def result_key(shard_key: str) -> str:
+    """The result of a shard is saved next to the shards, `<run>/shards/x.json` -> `<run>/results/x.json`"""
+    shards_directory, name = posixpath.split(shard_key)
+    return posixpath.join(posixpath.dirname(shards_directory), "results", name)
+
+
+def save_shard_result(client, bucket: str, shard_key: str, result: typing.Dict[str, typing.Any]) -> None:
+    _put_json(client, bucket, result_key(shard_key), result)
+
+
+def load_shard_results(client, run_uri: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """The results of all shards of a run, a shard without a result crashed and is reported like a failed copy"""
+    bucket, prefix = s3_copy.parse_s3_uri(run_uri)
+    results = {obj.key for obj in s3_copy.list_objects(client, bucket, f"{prefix}results/")}
+    shard_results = []
+    for obj in s3_copy.list_objects(client, bucket, f"{prefix}shards/"):
+        if result_key(obj.key) in results:
+            shard_results.append(_get_json(client, bucket, result_key(obj.key)))
+            continue
+        shard = load_shard(client, bucket, obj.key)
+        shard_results.append(
+            {
+                **shard,
+                "planned": 0,
+                "copied": 0,
+                "copied_bytes": 0,
+                "failed": {"shard": "The shard has no result, see the execution history for why it crashed"},
+                "stopped_early": False,
+            }
+        )
+    return shard_results
+
+
+def _put_json(client, bucket: str, key: str, data: typing.Any) -> None:
+    client.put_object(Bucket=bucket, Key=key, Body=json.dumps(data).encode("utf-8"), ContentType="application/json")
+
+
+def _get_json(client, bucket: str, key: str) -> typing.Any:
+    return json.loads(client.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
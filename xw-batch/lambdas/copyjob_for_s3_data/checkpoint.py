@@ -0,0 +1,209 @@
+"""
+# Checkpointed, incremental sync
+
+Instead of listing the whole source and target prefix on every run (like `aws s3 sync`), the state of the last run is
+kept in a small checkpoint object:
+
+- a watermark: the last source key which was listed and handled
+- the in-flight objects: objects up to the watermark which are not yet copied (failed or not started before the lambda
+  had to stop)
+
+The next run first copies the current versions of the in-flight objects (an object which was overwritten while it was
+in flight would never match its old ETag again, a deleted one is dropped) and then only lists keys after the watermark
+(`StartAfter`). This assumes that new source objects sort after the already existing ones (e.g. because the key contains
+a timestamp). Objects which sort before the watermark are only picked up by a full sync, which happens when there is no
+checkpoint (e.g. by deleting it).
+
+The target is listed after the watermark as well, incl. the coalesce indexes, and objects which are already there are
+skipped. With event driven copies, the scheduled sync is only a sweep for missed notifications and would otherwise copy
+every object again. Coalescing is not combined with event driven copies (the stack refuses it): the groups of a batch
+of notifications hold keys which are not next to each other, and their indexes can sort before the watermark.
+"""
+import dataclasses
+import datetime
+import itertools
+import json
+import typing
+
+from botocore.exceptions import ClientError
+
+from . import s3_copy
+
+
+@dataclasses.dataclass()
+class Checkpoint:
+    last_key: typing.Optional[str] = None
+    in_flight: typing.List[s3_copy.S3Object] = dataclasses.field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "last_key": self.last_key,
+                "in_flight": [
+                    {"key": obj.key, "size": obj.size, "etag": obj.etag, "last_modified": obj.last_modified.isoformat()}
+                    for obj in self.in_flight
+                ],
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "Checkpoint":
+        raw = json.loads(data)
+        return cls(
+            last_key=raw["last_key"],
+            in_flight=[
+                s3_copy.S3Object(
+                    key=obj["key"],
+                    size=obj["size"],
+                    etag=obj["etag"],
+                    last_modified=datetime.datetime.fromisoformat(obj["last_modified"]),
+                )
+                for obj in raw["in_flight"]
+            ],
+        )
+
+
+def load_checkpoint(client, checkpoint_uri: str) -> typing.Optional[Checkpoint]:
+    """Returns the checkpoint or None if there is none yet"""
+    bucket, key = s3_copy.parse_s3_object_uri(checkpoint_uri)
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return None
+    return Checkpoint.from_json(response["Body"].read().decode("utf-8"))
+
+
+def current_version(client, bucket: str, obj: s3_copy.S3Object) -> typing.Optional[s3_copy.S3Object]:
+    """Returns the object as it is now in the bucket, or None if it was deleted"""
+    try:
+        head = client.head_object(Bucket=bucket, Key=obj.key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return s3_copy.S3Object(
+        key=obj.key, size=head["ContentLength"], etag=head["ETag"], last_modified=head["LastModified"]
+    )
+
+
+def _not_in_target(
+    tasks: typing.Iterable[s3_copy.CopyTask],
+    targets: typing.Iterable[s3_copy.S3Object],
+    skipped: typing.List[s3_copy.CopyTask],
+) -> typing.Iterator[s3_copy.CopyTask]:
+    """Drops (and collects in skipped) the tasks whose object is already in the target
+
+    The targets are looked up by key, as the sources of the coalesce indexes are not in key order across indexes (a
+    group of a retry holds keys which are not next to each other).
+    """
+    existing = {target.key: target for target in targets}
+    for task in tasks:
+        if not s3_copy.needs_copy(task.source, existing.get(task.target_key)):
+            skipped.append(task)
+            continue
+        yield task
+
+
+def save_checkpoint(client, checkpoint_uri: str, checkpoint: Checkpoint) -> None:
+    bucket, key = s3_copy.parse_s3_object_uri(checkpoint_uri)
+    client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=checkpoint.to_json().encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def sync_incremental(
+    client,
+    source_bucket_uri: str,
+    target_bucket_uri: str,
+    checkpoint_uri: str,
+    *,
+    max_concurrency: int = s3_copy.DEFAULT_MAX_CONCURRENCY,
+    should_stop: typing.Callable[[], bool] = lambda: False,
+    copier: typing.Optional[s3_copy.Copier] = None,
+) -> s3_copy.CopyResult:
+    """Syncs all new objects since the last checkpoint and saves a new checkpoint afterwards
+
+    Without a checkpoint, this is a full sync. When should_stop() returns True, no more copies are started and the
+    checkpoint is saved, so that the next run resumes from there.
+    """
+    copier = copier or s3_copy.Copier()
+    source_bucket, source_prefix = s3_copy.parse_s3_uri(source_bucket_uri)
+    target_bucket, target_prefix = s3_copy.parse_s3_uri(target_bucket_uri)
+
+    def to_task(obj: s3_copy.S3Object) -> s3_copy.CopyTask:
+        target_key = s3_copy.target_key_for(obj.key, source_prefix=source_prefix, target_prefix=target_prefix)
+        return s3_copy.CopyTask(source=obj, target_key=target_key)
+
+    checkpoint = load_checkpoint(client, checkpoint_uri)
+    full_sync = checkpoint is None
+    retries: typing.List[s3_copy.CopyTask] = []
+    skipped: typing.List[s3_copy.CopyTask] = []
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+        source_listing = s3_copy.Listing(s3_copy.list_objects(client, source_bucket, source_prefix))
+        target_listing = s3_copy.Listing(copier.list_targets(client, target_bucket, target_prefix))
+        # The full sync needs to know what is already in the target, so list everything upfront
+        tasks: typing.Iterable[s3_copy.CopyTask] = s3_copy.plan_sync(
+            source_listing,
+            target_listing,
+            source_prefix=source_prefix,
+            target_prefix=target_prefix,
+        )
+    else:
+        current = (current_version(client, source_bucket, obj) for obj in checkpoint.in_flight)
+        retries = [to_task(obj) for obj in current if obj is not None]
+        source_listing = s3_copy.Listing(
+            s3_copy.list_objects(client, source_bucket, source_prefix, start_after=checkpoint.last_key)
+        )
+        # Only the targets after the watermark are kept in memory, the source listing is consumed lazily
+        target_start_after = None
+        if checkpoint.last_key is not None:
+            target_start_after = s3_copy.target_key_for(
+                checkpoint.last_key, source_prefix=source_prefix, target_prefix=target_prefix
+            )
+        target_listing = s3_copy.Listing(
+            copier.list_targets(client, target_bucket, target_prefix, start_after=target_start_after)
+        )
+        tasks = _not_in_target((to_task(obj) for obj in source_listing), target_listing, skipped)
+
+    started: typing.List[s3_copy.CopyTask] = []
+
+    def track_started(all_tasks: typing.Iterable[s3_copy.CopyTask]) -> typing.Iterator[s3_copy.CopyTask]:
+        for task in all_tasks:
+            started.append(task)
+            yield task
+
+    result = s3_copy.copy_objects(
+        client,
+        track_started(itertools.chain(retries, tasks)),
+        source_bucket=source_bucket,
+        target_bucket=target_bucket,
+        max_concurrency=max_concurrency,
+        should_stop=should_stop,
+        copier=copier,
+    )
+    result.listed = source_listing.count
+    result.skipped = source_listing.count - len(typing.cast(list, tasks)) if full_sync else len(skipped)
+    result.listing_seconds = source_listing.seconds + target_listing.seconds
+
+    watermark: typing.Optional[s3_copy.S3Object]
+    if full_sync and result.stopped_early:
+        # The full sync listed everything upfront, so only the copies which were started are done
+        watermark = started[-1].source if started else None
+        if watermark is None:
+            # Nothing done, so the next run has to do the full sync again
+            return result
+    else:
+        # Only listed objects which were also started are taken from the listing
+        watermark = source_listing.last
+    new_checkpoint = Checkpoint(
+        last_key=checkpoint.last_key,
+        in_flight=[task.source for task in retries if task not in started] + [task.source for task in result.failed],
+    )
+    if watermark is not None:
+        new_checkpoint.last_key = watermark.key
+    save_checkpoint(client, checkpoint_uri, new_checkpoint)
+    return result
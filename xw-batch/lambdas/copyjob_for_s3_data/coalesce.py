@@ -0,0 +1,209 @@
+"""
+# Coalescing small gzip objects
+
+Every object is a task (and a few GETs) for Spark, so many small objects make reading slow and expensive. Instead of
+copying small gzip objects one by one, consecutive small objects of the same directory are concatenated into one
+object of about the target size. Concatenated gzip streams are a valid gzip stream (with multiple members), so the
+objects do not need to be recompressed. A gzip member with a single newline is put in between, so that the last line
+of an object never runs into the first line of the next one (empty lines are skipped by the json reader).
+
+The coalesced object of `x.json.gz` (its first source object) is named `x.coalesced.json.gz`. For every coalesced
+object, an index of its source objects is saved in the state of the copy job (not next to the object, as it would be
+read as data). The indexes tell the next (full) sync which objects are already copied, so copying stays idempotent:
+a group which is copied again ends up in the same coalesced object, which is simply overwritten.
+"""
+import concurrent.futures
+import dataclasses
+import gzip
+import heapq
+import io
+import json
+import os
+import posixpath
+import threading
+import typing
+
+from . import s3_copy
+
+DEFAULT_TARGET_SIZE = 128 * 1024 * 1024
+DEFAULT_MAX_SOURCE_SIZE = 8 * 1024 * 1024
+# A coalesced object is built in memory, so only a few are built at the same time
+DEFAULT_CONCURRENCY = 2
+# Small objects are dominated by the latency of the GET, so they are downloaded in parallel
+FETCH_CONCURRENCY = 16
+# mtime=0 keeps the coalesced objects byte for byte the same when they are built again
+_NEWLINE_MEMBER = gzip.compress(b"\n", mtime=0)
+
+
+@dataclasses.dataclass(frozen=True)
+class CoalesceConfig:
+    # Where the indexes are saved, a s3 uri outside of the target bucket uri
+    index_uri: str
+    target_size: int = DEFAULT_TARGET_SIZE
+    max_source_size: int = DEFAULT_MAX_SOURCE_SIZE
+    concurrency: int = DEFAULT_CONCURRENCY
+
+
+def coalesced_key(first_target_key: str) -> str:
+    root, extension = os.path.splitext(first_target_key.removesuffix(".gz"))
+    return f"{root}.coalesced{extension}.gz"
+
+
+def _from_last_up_to(objects: typing.Iterable[s3_copy.S3Object], key: str) -> typing.Iterator[s3_copy.S3Object]:
+    """Skips the objects before the last one with a key up to key
+
+    An index covers the keys from its first source object on, so the last index up to a key might cover later keys.
+    """
+    previous = None
+    for obj in objects:
+        if obj.key <= key:
+            previous = obj
+            continue
+        if previous is not None:
+            yield previous
+            previous = None
+        yield obj
+    if previous is not None:
+        yield previous
+
+
+class CoalescingCopier(s3_copy.Copier):
+    """Coalesces small gzip objects, see the module docs, all other objects are copied by the wrapped copier"""
+
+    def __init__(
+        self,
+        config: CoalesceConfig,
+        *,
+        target_bucket_uri: str,
+        copier: typing.Optional[s3_copy.Copier] = None,
+    ):
+        self.config = config
+        self.copier = copier or s3_copy.Copier()
+        _, self.target_prefix = s3_copy.parse_s3_uri(target_bucket_uri)
+        self.index_bucket, self.index_prefix = s3_copy.parse_s3_uri(config.index_uri)
+        self._slots = threading.BoundedSemaphore(config.concurrency)
+
+    def is_small(self, source: s3_copy.S3Object) -> bool:
+        return source.key.endswith(".gz") and source.size <= self.config.max_source_size
+
+    def index_key(self, target_key: str) -> str:
+        return f"{self.index_prefix}{target_key.removeprefix(self.target_prefix)}.json"
+
+    def group(self, tasks: typing.Iterable[s3_copy.CopyTask]) -> typing.Iterator[typing.List[s3_copy.CopyTask]]:
+        small: typing.List[s3_copy.CopyTask] = []
+        size = 0
+        for task in tasks:
+            if not self.is_small(task.source):
+                yield from self.copier.group([task])
+                continue
+            directory = posixpath.dirname(task.target_key)
+            if small and (
+                directory != posixpath.dirname(small[0].target_key) or size + task.source.size > self.config.target_size
+            ):
+                yield small
+                small = []
+                size = 0
+            small.append(task)
+            size += task.source.size
+        if small:
+            yield small
+
+    def copy_group(
+        self,
+        client,
+        tasks: typing.List[s3_copy.CopyTask],
+        *,
+        source_bucket: str,
+        target_bucket: str,
+    ) -> None:
+        if not self.is_small(tasks[0].source):
+            self.copier.copy_group(client, tasks, source_bucket=source_bucket, target_bucket=target_bucket)
+            return
+        with self._slots:
+            self.coalesce(client, tasks, source_bucket=source_bucket, target_bucket=target_bucket)
+
+    def coalesce(
+        self,
+        client,
+        tasks: typing.List[s3_copy.CopyTask],
+        *,
+        source_bucket: str,
+        target_bucket: str,
+    ) -> str:
+        """Concatenates the source objects of the tasks into one coalesced object and returns its key"""
+
+        def fetch(task: s3_copy.CopyTask) -> bytes:
+            # IfMatch makes sure that the index describes exactly what is in the coalesced object
+            response = client.get_object(Bucket=source_bucket, Key=task.source.key, IfMatch=task.source.etag)
+            return response["Body"].read()
+
+        body = io.BytesIO()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+            for data in executor.map(fetch, tasks):
+                body.write(data)
+                body.write(_NEWLINE_MEMBER)
+        key = coalesced_key(tasks[0].target_key)
+        client.put_object(Bucket=target_bucket, Key=key, Body=body.getvalue())
+
+        index = {
+            "target_key": key,
+            "sources": [
+                {
+                    "key": task.source.key,
+                    "target_key": task.target_key,
+                    "size": task.source.size,
+                    "etag": task.source.etag,
+                    "last_modified": task.source.last_modified.isoformat(),
+                }
+                for task in tasks
+            ],
+        }
+        client.put_object(
+            Bucket=self.index_bucket,
+            Key=self.index_key(key),
+            Body=json.dumps(index).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return key
+
+    def _coalesced_targets(
+        self,
+        client,
+        *,
+        start_after: typing.Optional[str],
+    ) -> typing.Iterator[s3_copy.S3Object]:
+        """The coalesced source objects as if they were copied one by one, according to the indexes"""
+        index_objects: typing.Iterable[s3_copy.S3Object] = s3_copy.list_objects(
+            client, self.index_bucket, self.index_prefix
+        )
+        if start_after:
+            index_objects = _from_last_up_to(index_objects, self.index_key(start_after))
+        for index_object in index_objects:
+            response = client.get_object(Bucket=self.index_bucket, Key=index_object.key)
+            index = json.loads(response["Body"].read().decode("utf-8"))
+            for source in sorted(index["sources"], key=lambda source: source["target_key"]):
+                if start_after and source["target_key"] <= start_after:
+                    continue
+                yield s3_copy.S3Object(
+                    key=source["target_key"],
+                    size=source["size"],
+                    etag=source["etag"],
+                    # The coalesced object was written after its source objects were modified
+                    last_modified=index_object.last_modified,
+                )
+
+    def list_targets(
+        self,
+        client,
+        bucket: str,
+        prefix: str,
+        *,
+        start_after: typing.Optional[str] = None,
+    ) -> typing.Iterator[s3_copy.S3Object]:
+        # Sorted by key as long as the sources of every index are next to each other, as ranges of the listing are used
+        # by the backfill (the incremental sync looks the targets up by key, so retried groups are found as well)
+        return heapq.merge(
+            self.copier.list_targets(client, bucket, prefix, start_after=start_after),
+            self._coalesced_targets(client, start_after=start_after),
+            key=lambda obj: obj.key,
+        )
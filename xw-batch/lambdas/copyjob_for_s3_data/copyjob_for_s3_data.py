@@ -1,20 +1,188 @@
 import json
 import os
-import subprocess
+
+from . import backfill, checkpoint, coalesce, metrics, notifications, rechunk, s3_copy
+
+# Time needed to finish the already started copies and to save the checkpoint before the lambda times out
+STOP_BEFORE_TIMEOUT_MILLIS = 60 * 1000
+
+
+def _copier() -> s3_copy.Copier:
+    """Big gzip objects are only split and small ones only coalesced if the copy job is configured to do so"""
+    copier = s3_copy.Copier()
+    if "RECHUNK_CODEC" in os.environ:
+        rechunk_config = rechunk.RechunkConfig(
+            manifest_uri=os.environ["RECHUNK_MANIFEST_URI"],
+            codec=os.environ["RECHUNK_CODEC"],
+            min_size=int(os.environ.get("RECHUNK_MIN_SIZE", rechunk.DEFAULT_MIN_SIZE)),
+            part_size=int(os.environ.get("RECHUNK_PART_SIZE", rechunk.DEFAULT_PART_SIZE)),
+        )
+        copier = rechunk.RechunkingCopier(rechunk_config, target_bucket_uri=os.environ["TARGET_BUCKET_URI"])
+    if "COALESCE_INDEX_URI" in os.environ:
+        coalesce_config = coalesce.CoalesceConfig(
+            index_uri=os.environ["COALESCE_INDEX_URI"],
+            target_size=int(os.environ.get("COALESCE_TARGET_SIZE", coalesce.DEFAULT_TARGET_SIZE)),
+            max_source_size=int(os.environ.get("COALESCE_MAX_SOURCE_SIZE", coalesce.DEFAULT_MAX_SOURCE_SIZE)),
+        )
+        copier = coalesce.CoalescingCopier(
+            coalesce_config, target_bucket_uri=os.environ["TARGET_BUCKET_URI"], copier=copier
+        )
+    return copier
 
 
 def sync_bucket_uri(event: dict, context):
-    """Syncs the content of s3 bucket URIs"""
+    """Syncs the content of s3 bucket URIs
+
+    Only objects which are new since the last run are copied, see checkpoint.sync_incremental().
+    """
     print(f"request: {json.dumps(event)}, context: {type(context)}")
 
     source_bucket_uri = os.environ["SOURCE_BUCKET_URI"]
     target_bucket_uri = os.environ["TARGET_BUCKET_URI"]
+    checkpoint_uri = os.environ["CHECKPOINT_URI"]
+    max_concurrency = int(os.environ.get("MAX_CONCURRENCY", s3_copy.DEFAULT_MAX_CONCURRENCY))
 
-    sync_command = f"/opt/awscli/aws s3 sync {source_bucket_uri} {target_bucket_uri}"
-    subprocess.check_call(sync_command, shell=True)
+    client = s3_copy.create_s3_client(max_concurrency)
+    result = checkpoint.sync_incremental(
+        client,
+        source_bucket_uri,
+        target_bucket_uri,
+        checkpoint_uri,
+        max_concurrency=max_concurrency,
+        should_stop=lambda: context.get_remaining_time_in_millis() < STOP_BEFORE_TIMEOUT_MILLIS,
+        copier=_copier(),
+    )
+    metrics.emit(result, mode="sync", context=context)
+    # An object which was overwritten while it was copied stays in flight and the next run copies its new version
+    failed = {
+        task.source.key: repr(error) for task, error in result.failed.items() if not notifications.is_superseded(error)
+    }
+    if failed:
+        raise RuntimeError(f"Failed to copy {len(failed)} objects: {json.dumps(failed)}")
 
     return {
         "statusCode": 200,
         "headers": {"Content-Type": "text/plain"},
-        "body": f"Successfully ran aws s3 sync {source_bucket_uri} {target_bucket_uri}\n",
+        "body": (
+            f"Successfully synced {source_bucket_uri} {target_bucket_uri}: "
+            + f"copied {len(result.copied)} objects ({result.copied_bytes} bytes)"
+            + (", stopped before the timeout, the next run resumes" if result.stopped_early else "")
+            + "\n"
+        ),
     }
+
+
+def copy_notified_objects(event: dict, context):
+    """Copies the objects from a batch of s3 object created notifications delivered via sqs
+
+    Returns the notifications which could not be copied, so that only these are retried.
+    """
+    print(f"request: {len(event['Records'])} notifications, context: {type(context)}")
+
+    source_bucket, source_prefix = s3_copy.parse_s3_uri(os.environ["SOURCE_BUCKET_URI"])
+    target_bucket, target_prefix = s3_copy.parse_s3_uri(os.environ["TARGET_BUCKET_URI"])
+    max_concurrency = int(os.environ.get("MAX_CONCURRENCY", s3_copy.DEFAULT_MAX_CONCURRENCY))
+
+    tasks_by_message_id = {
+        record["messageId"]: [
+            s3_copy.CopyTask(
+                source=obj,
+                target_key=s3_copy.target_key_for(obj.key, source_prefix=source_prefix, target_prefix=target_prefix),
+            )
+            for obj in notifications.created_objects(record, bucket=source_bucket, prefix=source_prefix)
+        ]
+        for record in event["Records"]
+    }
+
+    client = s3_copy.create_s3_client(max_concurrency)
+    result = s3_copy.copy_objects(
+        client,
+        [task for tasks in tasks_by_message_id.values() for task in tasks],
+        source_bucket=source_bucket,
+        target_bucket=target_bucket,
+        max_concurrency=max_concurrency,
+        copier=_copier(),
+    )
+    metrics.emit(result, mode="events", context=context)
+
+    failed_message_ids = [
+        message_id
+        for message_id, tasks in tasks_by_message_id.items()
+        if any(task in result.failed and not notifications.is_superseded(result.failed[task]) for task in tasks)
+    ]
+    for task, error in result.failed.items():
+        print(f"Failed to copy {task.source.key}: {error!r}")
+    print(f"Copied {len(result.copied)} objects ({result.copied_bytes} bytes)")
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]}
+
+
+def _backfill_run_uri(execution: str) -> str:
+    """The directory of the shards and their results of a backfill run"""
+    return f"{os.environ['BACKFILL_REPORT_URI'].rstrip('/')}/{execution}/"
+
+
+def plan_backfill_shards(event: dict, context):
+    """Splits all source objects into shards which can be copied in parallel by copy_backfill_shard()
+
+    The shards are saved below the run directory, only their keys are returned.
+    """
+    print(f"request: {json.dumps(event)}, context: {type(context)}")
+
+    source_bucket_uri = os.environ["SOURCE_BUCKET_URI"]
+    keys_per_shard = int(os.environ.get("KEYS_PER_SHARD", backfill.DEFAULT_KEYS_PER_SHARD))
+
+    client = s3_copy.create_s3_client()
+    shards = backfill.plan_shards(client, source_bucket_uri, keys_per_shard=keys_per_shard)
+    shard_keys = backfill.save_shards(client, _backfill_run_uri(event["execution"]), shards)
+    print(f"Planned {len(shards)} shards for {source_bucket_uri}")
+    return {"shards": shard_keys}
+
+
+def copy_backfill_shard(event: dict, context):
+    """Syncs a single shard, the event has the key of one of the shards from plan_backfill_shards()
+
+    The result is saved next to the shard, for summarize_backfill().
+    """
+    print(f"request: {json.dumps(event)}, context: {type(context)}")
+
+    source_bucket_uri = os.environ["SOURCE_BUCKET_URI"]
+    target_bucket_uri = os.environ["TARGET_BUCKET_URI"]
+    max_concurrency = int(os.environ.get("MAX_CONCURRENCY", s3_copy.DEFAULT_MAX_CONCURRENCY))
+    report_bucket, _ = s3_copy.parse_s3_uri(os.environ["BACKFILL_REPORT_URI"])
+
+    client = s3_copy.create_s3_client(max_concurrency)
+    shard = backfill.load_shard(client, report_bucket, event["shard_key"])
+    result = backfill.copy_shard(
+        client,
+        source_bucket_uri,
+        target_bucket_uri,
+        shard,
+        max_concurrency=max_concurrency,
+        should_stop=lambda: context.get_remaining_time_in_millis() < STOP_BEFORE_TIMEOUT_MILLIS,
+        copier=_copier(),
+    )
+    metrics.emit(result, mode="backfill", context=context)
+    backfill.save_shard_result(client, report_bucket, event["shard_key"], backfill.shard_result(shard, result))
+    return {"copied": len(result.copied), "failed": len(result.failed), "stopped_early": result.stopped_early}
+
+
+def summarize_backfill(event: dict, context):
+    """Saves a report of all shard results and fails if not all shards were copied completely"""
+    report_uri = f"{os.environ['BACKFILL_REPORT_URI'].rstrip('/')}/{event['execution']}.json"
+    client = s3_copy.create_s3_client()
+    results = backfill.load_shard_results(client, _backfill_run_uri(event["execution"]))
+    summary = backfill.summarize(results)
+
+    bucket, key = s3_copy.parse_s3_object_uri(report_uri)
+    client.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps({"summary": summary, "shards": results}).encode("utf-8"),
+        ContentType="application/json",
+    )
+    print(f"Backfill summary (full report in {report_uri}): {json.dumps(summary)}")
+    if summary["incomplete_shards"]:
+        raise RuntimeError(
+            f"{len(summary['incomplete_shards'])} of {summary['shards']} shards are incomplete, see {report_uri}"
+        )
+    return summary
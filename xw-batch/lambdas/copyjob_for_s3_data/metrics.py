@@ -0,0 +1,80 @@
+"""
+# Copy job metrics
+
+The metrics of a run are printed in the CloudWatch Embedded Metric Format (EMF), CloudWatch extracts them from the
+lambda logs, so no PutMetricData calls (and no extra permissions) are needed. See
+https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+"""
+import json
+import math
+import os
+import time
+import typing
+
+from . import s3_copy
+
+DEFAULT_NAMESPACE = "XwBatch/CopyS3Data"
+
+
+def percentile(values: typing.Sequence[float], percent: float) -> float:
+    """Nearest rank percentile, 0 if there are no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+
+def emf_record(
+    result: s3_copy.CopyResult,
+    *,
+    mode: str,
+    remaining_millis: typing.Optional[int] = None,
+    namespace: str = DEFAULT_NAMESPACE,
+    copy_job: str = "",
+) -> typing.Dict[str, typing.Any]:
+    """Returns the EMF log record for the result of a copy run"""
+    values: typing.Dict[str, typing.Tuple[float, str]] = {
+        "ObjectsListed": (result.listed, "Count"),
+        "ObjectsCopied": (len(result.copied), "Count"),
+        "ObjectsSkipped": (result.skipped, "Count"),
+        "ObjectsFailed": (len(result.failed), "Count"),
+        "BytesCopied": (result.copied_bytes, "Bytes"),
+        "ListingTime": (result.listing_seconds * 1000, "Milliseconds"),
+        "CopyTime": (result.copy_seconds * 1000, "Milliseconds"),
+        "CopyLatencyP50": (percentile(result.copy_latencies, 50) * 1000, "Milliseconds"),
+        "CopyLatencyP90": (percentile(result.copy_latencies, 90) * 1000, "Milliseconds"),
+        "CopyLatencyP99": (percentile(result.copy_latencies, 99) * 1000, "Milliseconds"),
+        "CopyLatencyMax": (max(result.copy_latencies, default=0.0) * 1000, "Milliseconds"),
+    }
+    if remaining_millis is not None:
+        values["TimeRemainingAtExit"] = (remaining_millis, "Milliseconds")
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [["CopyJob", "Mode"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()],
+                }
+            ],
+        },
+        "CopyJob": copy_job,
+        "Mode": mode,
+        **{name: value for name, (value, _) in values.items()},
+        # Not a metric, but helps to find the runs which did not copy everything
+        "StoppedEarly": result.stopped_early,
+    }
+
+
+def emit(result: s3_copy.CopyResult, *, mode: str, context=None) -> None:
+    """Prints the metrics of a copy run to the lambda log, namespace and job name are taken from the environment"""
+    record = emf_record(
+        result,
+        mode=mode,
+        remaining_millis=context.get_remaining_time_in_millis() if context is not None else None,
+        namespace=os.environ.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE),
+        copy_job=os.environ.get("COPY_JOB_NAME", ""),
+    )
+    print(json.dumps(record))
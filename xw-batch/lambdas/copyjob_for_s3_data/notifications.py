@@ -0,0 +1,45 @@
+"""
+# S3 object created notifications, delivered via sqs
+
+See https://docs.aws.amazon.com/AmazonS3/latest/userguide/notification-content-structure.html
+"""
+import datetime
+import json
+import typing
+import urllib.parse
+
+from botocore.exceptions import ClientError
+
+from . import s3_copy
+
+
+def created_objects(sqs_record: dict, *, bucket: str, prefix: str) -> typing.List[s3_copy.S3Object]:
+    """Returns the created objects below the prefix of the bucket from the notification in the sqs record"""
+    notification = json.loads(sqs_record["body"])
+    # s3 sends a s3:TestEvent without any records when the notification is set up
+    objects = []
+    for record in notification.get("Records", []):
+        if not record["eventName"].startswith("ObjectCreated:") or record["s3"]["bucket"]["name"] != bucket:
+            continue
+        # Keys are url encoded in notifications
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"])
+        if not key.startswith(prefix):
+            continue
+        objects.append(
+            s3_copy.S3Object(
+                key=key,
+                size=record["s3"]["object"]["size"],
+                # Notifications have the ETag without the quotes which listings and responses have
+                etag=f'"{record["s3"]["object"]["eTag"]}"',
+                last_modified=datetime.datetime.fromisoformat(record["eventTime"].replace("Z", "+00:00")),
+            )
+        )
+    return objects
+
+
+def is_superseded(error: BaseException) -> bool:
+    """True if the copy failed because the object was overwritten in the meantime
+
+    The newer version has its own notification, so this one can be dropped.
+    """
+    return isinstance(error, ClientError) and error.response["Error"]["Code"] == "PreconditionFailed"
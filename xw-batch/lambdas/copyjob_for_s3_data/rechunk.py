@@ -0,0 +1,199 @@
+"""
+# Splitting big gzip objects into parts
+
+Gzip is not splittable, so Spark (and Glue) decode every gzip object in a single task, no matter how many workers
+there are. Instead of copying big gzip objects of newline delimited json as they are, they are decompressed, split
+into parts of whole lines and each part is compressed again, with gzip or bzip2 (which Spark can even split itself).
+The parts of `x.json.gz` are named `x.part-00000.json.<ext>`, so they are still read as json.
+
+For every split object, a manifest with the source object and its parts is saved in the state of the copy job. The
+manifests are also what tells the next (full) sync that an object is already copied, as there is no target object
+with the name of the source object.
+"""
+import bz2
+import dataclasses
+import gzip
+import heapq
+import json
+import os
+import threading
+import typing
+
+from . import s3_copy
+
+DEFAULT_CODEC = "gzip"
+# Smaller gzip objects are not worth it, they are read in parallel with the other objects anyway
+DEFAULT_MIN_SIZE = 64 * 1024 * 1024
+# Uncompressed bytes per part, a part (and its compressed form) is kept in memory while it's uploaded
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+# Splitting is done in the lambda itself (and needs memory), so only a few objects are split at the same time
+DEFAULT_CONCURRENCY = 2
+
+
+CODECS: typing.Dict[str, typing.Tuple[str, typing.Callable[[bytes], bytes]]] = {
+    "gzip": (".gz", lambda data: gzip.compress(data, compresslevel=6)),
+    "bzip2": (".bz2", bz2.compress),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class RechunkConfig:
+    # Where the manifests are saved, a s3 uri outside of the target bucket uri
+    manifest_uri: str
+    codec: str = DEFAULT_CODEC
+    min_size: int = DEFAULT_MIN_SIZE
+    part_size: int = DEFAULT_PART_SIZE
+    concurrency: int = DEFAULT_CONCURRENCY
+
+    def __post_init__(self):
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown codec {self.codec}, use one of {', '.join(CODECS)}")
+
+
+def is_splittable_source(source: s3_copy.S3Object, config: RechunkConfig) -> bool:
+    """Only big gzip objects are split, everything else is copied as it is"""
+    return source.key.endswith(".gz") and source.size >= config.min_size
+
+
+def part_key(target_key: str, index: int, codec: str) -> str:
+    root, extension = os.path.splitext(target_key.removesuffix(".gz"))
+    return f"{root}.part-{index:05}{extension}{CODECS[codec][0]}"
+
+
+def split_lines(lines: typing.Iterable[bytes], part_size: int) -> typing.Iterator[typing.List[bytes]]:
+    """Groups lines into parts of about part_size bytes, a part only ends after a whole line"""
+    part: typing.List[bytes] = []
+    size = 0
+    for line in lines:
+        if part and size + len(line) > part_size:
+            yield part
+            part = []
+            size = 0
+        part.append(line)
+        size += len(line)
+    if part:
+        yield part
+
+
+class RechunkingCopier(s3_copy.Copier):
+    """Splits big gzip objects into parts, see the module docs, and copies all other objects as usual"""
+
+    def __init__(self, config: RechunkConfig, *, target_bucket_uri: str):
+        self.config = config
+        _, self.target_prefix = s3_copy.parse_s3_uri(target_bucket_uri)
+        self.manifest_bucket, self.manifest_prefix = s3_copy.parse_s3_uri(config.manifest_uri)
+        self._slots = threading.BoundedSemaphore(config.concurrency)
+
+    def manifest_key(self, target_key: str) -> str:
+        return f"{self.manifest_prefix}{target_key.removeprefix(self.target_prefix)}.json"
+
+    def copy(
+        self,
+        client,
+        *,
+        source_bucket: str,
+        source: s3_copy.S3Object,
+        target_bucket: str,
+        target_key: str,
+    ) -> None:
+        if not is_splittable_source(source, self.config):
+            super().copy(
+                client, source_bucket=source_bucket, source=source, target_bucket=target_bucket, target_key=target_key
+            )
+            return
+        with self._slots:
+            self.split(
+                client, source_bucket=source_bucket, source=source, target_bucket=target_bucket, target_key=target_key
+            )
+
+    def split(
+        self,
+        client,
+        *,
+        source_bucket: str,
+        source: s3_copy.S3Object,
+        target_bucket: str,
+        target_key: str,
+    ) -> typing.List[str]:
+        """Splits the source object into parts next to target_key and returns the keys of the parts"""
+        _, compress = CODECS[self.config.codec]
+        # IfMatch makes sure that all parts come from the listed version of the object
+        body = client.get_object(Bucket=source_bucket, Key=source.key, IfMatch=source.etag)["Body"]
+        parts: typing.List[typing.Dict[str, typing.Any]] = []
+        with gzip.GzipFile(fileobj=body) as lines:
+            for index, part in enumerate(split_lines(lines, self.config.part_size)):
+                key = part_key(target_key, index, self.config.codec)
+                client.put_object(Bucket=target_bucket, Key=key, Body=compress(b"".join(part)))
+                parts.append({"key": key, "lines": len(part), "bytes": sum(len(line) for line in part)})
+
+        previous = self._load_manifest(client, target_key)
+        part_keys = {part["key"] for part in parts}
+        # A previous version of the object might have had more parts, these must not be read together with the new ones
+        for stale_part in previous["parts"] if previous else []:
+            if stale_part["key"] not in part_keys:
+                client.delete_object(Bucket=target_bucket, Key=stale_part["key"])
+
+        manifest = {
+            "source": {
+                "bucket": source_bucket,
+                "key": source.key,
+                "size": source.size,
+                "etag": source.etag,
+                "last_modified": source.last_modified.isoformat(),
+            },
+            "target_key": target_key,
+            "codec": self.config.codec,
+            "parts": parts,
+        }
+        client.put_object(
+            Bucket=self.manifest_bucket,
+            Key=self.manifest_key(target_key),
+            Body=json.dumps(manifest).encode("utf-8"),
+            ContentType="application/json",
+        )
+        return [part["key"] for part in parts]
+
+    def _load_manifest(self, client, target_key: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        try:
+            response = client.get_object(Bucket=self.manifest_bucket, Key=self.manifest_key(target_key))
+        except client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read().decode("utf-8"))
+
+    def _split_targets(
+        self,
+        client,
+        *,
+        start_after: typing.Optional[str],
+    ) -> typing.Iterator[s3_copy.S3Object]:
+        """The split objects as if they were copied, according to their manifests"""
+        manifest_start_after = self.manifest_key(start_after).removesuffix(".json") if start_after else None
+        for manifest_object in s3_copy.list_objects(
+            client, self.manifest_bucket, self.manifest_prefix, start_after=manifest_start_after
+        ):
+            response = client.get_object(Bucket=self.manifest_bucket, Key=manifest_object.key)
+            manifest = json.loads(response["Body"].read().decode("utf-8"))
+            if start_after and manifest["target_key"] <= start_after:
+                continue
+            yield s3_copy.S3Object(
+                key=manifest["target_key"],
+                size=manifest["source"]["size"],
+                etag=manifest["source"]["etag"],
+                # The parts were written after the manifest's source object was modified
+                last_modified=manifest_object.last_modified,
+            )
+
+    def list_targets(
+        self,
+        client,
+        bucket: str,
+        prefix: str,
+        *,
+        start_after: typing.Optional[str] = None,
+    ) -> typing.Iterator[s3_copy.S3Object]:
+        # Still sorted by key, as ranges of the listing are used by the backfill
+        return heapq.merge(
+            super().list_targets(client, bucket, prefix, start_after=start_after),
+            self._split_targets(client, start_after=start_after),
+            key=lambda obj: obj.key,
+        )
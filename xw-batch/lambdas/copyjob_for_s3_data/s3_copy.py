@@ -0,0 +1,399 @@
+"""
+# In-process copy engine for s3 objects
+
+All copies are done server side (CopyObject or, for big objects, UploadPartCopy), so the data never passes through the
+lambda. Objects are copied in parallel in a bounded thread pool and throttling by s3 (503 SlowDown) is handled by
+botocore's adaptive retry mode, which slows down all threads sharing the client instead of hammering s3 with retries.
+"""
+import concurrent.futures
+import dataclasses
+import datetime
+import time
+import typing
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_CONCURRENCY = 64
+# CopyObject works up to 5GB, but big objects are copied faster if their parts are copied in parallel
+MULTIPART_THRESHOLD = 256 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+# The headers which CopyObject copies along with the object, but which a multipart upload has to be created with
+COPIED_HEADERS = (
+    "CacheControl",
+    "ContentDisposition",
+    "ContentEncoding",
+    "ContentLanguage",
+    "ContentType",
+    "Expires",
+    "Metadata",
+)
+# adaptive mode needs a few attempts to find the request rate s3 is willing to serve
+MAX_ATTEMPTS = 10
+
+
+@dataclasses.dataclass(frozen=True)
+class S3Object:
+    key: str
+    size: int
+    etag: str
+    last_modified: datetime.datetime
+
+
+@dataclasses.dataclass(frozen=True)
+class CopyTask:
+    source: S3Object
+    target_key: str
+
+
+@dataclasses.dataclass()
+class CopyResult:
+    copied: typing.List[CopyTask] = dataclasses.field(default_factory=list)
+    # The failed copies with the error
+    failed: typing.Dict[CopyTask, BaseException] = dataclasses.field(default_factory=dict)
+    # True if the copy was stopped before all tasks were started
+    stopped_early: bool = False
+    # Seconds per successful copy (of a group of objects, if the copier copies them together)
+    copy_latencies: typing.List[float] = dataclasses.field(default_factory=list)
+    # Listed objects (only known if the tasks came from a listing) and how many of them needed no copy
+    listed: int = 0
+    skipped: int = 0
+    listing_seconds: float = 0.0
+    # Wall clock time of all copies (includes the listing if the tasks are listed lazily)
+    copy_seconds: float = 0.0
+
+    @property
+    def copied_bytes(self) -> int:
+        return sum(task.source.size for task in self.copied)
+
+
+def parse_s3_uri(uri: str) -> typing.Tuple[str, str]:
+    """Splits a s3 uri into bucket and key prefix
+
+    The prefix is treated as a directory like `aws s3 sync` does: it never starts with a slash and always ends with
+    one (unless it's empty).
+    """
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not a s3 uri: {uri}")
+    bucket, _, prefix = uri.removeprefix("s3://").partition("/")
+    prefix = prefix.strip("/")
+    return bucket, f"{prefix}/" if prefix else ""
+
+
+def parse_s3_object_uri(uri: str) -> typing.Tuple[str, str]:
+    """Splits a s3 uri of a single object into bucket and key"""
+    bucket, prefix = parse_s3_uri(uri)
+    return bucket, prefix.rstrip("/")
+
+
+def target_key_for(source_key: str, *, source_prefix: str, target_prefix: str) -> str:
+    """Returns the key of the copy of a source object (same relative path below the target prefix)"""
+    return target_prefix + source_key.removeprefix(source_prefix)
+
+
+def create_s3_client(max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+    """Creates a s3 client which can be shared by all copy threads"""
+    return boto3.client(
+        "s3",
+        config=Config(
+            # Every copy thread (and every part copy of a big object) needs its own connection
+            max_pool_connections=max_concurrency + MULTIPART_CONCURRENCY,
+            retries={"mode": "adaptive", "max_attempts": MAX_ATTEMPTS},
+        ),
+    )
+
+
+def list_objects(
+    client,
+    bucket: str,
+    prefix: str,
+    *,
+    start_after: typing.Optional[str] = None,
+) -> typing.Iterator[S3Object]:
+    """Lists all objects below the prefix in lexicographical key order"""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    for page in client.get_paginator("list_objects_v2").paginate(**kwargs):
+        for item in page.get("Contents", []):
+            yield S3Object(
+                key=item["Key"],
+                size=item["Size"],
+                etag=item["ETag"],
+                last_modified=item["LastModified"],
+            )
+
+
+class Listing:
+    """Wraps a listing and keeps track of what was taken from it and how long the listing took"""
+
+    def __init__(self, objects: typing.Iterable[S3Object]):
+        self._objects = objects
+        self.last: typing.Optional[S3Object] = None
+        self.count = 0
+        self.seconds = 0.0
+
+    def __iter__(self) -> typing.Iterator[S3Object]:
+        objects = iter(self._objects)
+        while True:
+            started = time.monotonic()
+            obj = next(objects, None)
+            self.seconds += time.monotonic() - started
+            if obj is None:
+                return
+            self.last = obj
+            self.count += 1
+            yield obj
+
+
+def plan_sync(
+    source_objects: typing.Iterable[S3Object],
+    target_objects: typing.Iterable[S3Object],
+    *,
+    source_prefix: str,
+    target_prefix: str,
+) -> typing.List[CopyTask]:
+    """Returns the copies needed to sync the target with the source
+
+    Same rules as `aws s3 sync`: an object is copied if it's missing in the target, has a different size or
+    the source is newer than the copy in the target.
+    """
+    existing = {obj.key: obj for obj in target_objects}
+    tasks = []
+    for source in source_objects:
+        target_key = target_key_for(source.key, source_prefix=source_prefix, target_prefix=target_prefix)
+        if needs_copy(source, existing.get(target_key)):
+            tasks.append(CopyTask(source=source, target_key=target_key))
+    return tasks
+
+
+def needs_copy(source: S3Object, target: typing.Optional[S3Object]) -> bool:
+    """The `aws s3 sync` rule of plan_sync() for a single object"""
+    return target is None or target.size != source.size or target.last_modified < source.last_modified
+
+
+def copy_object(
+    client,
+    *,
+    source_bucket: str,
+    source: S3Object,
+    target_bucket: str,
+    target_key: str,
+) -> None:
+    """Copies a single object server side"""
+    if source.size <= MULTIPART_THRESHOLD:
+        client.copy_object(
+            Bucket=target_bucket,
+            Key=target_key,
+            CopySource={"Bucket": source_bucket, "Key": source.key},
+            CopySourceIfMatch=source.etag,
+        )
+    else:
+        _copy_object_multipart(
+            client,
+            source_bucket=source_bucket,
+            source=source,
+            target_bucket=target_bucket,
+            target_key=target_key,
+        )
+
+
+def _copy_object_multipart(
+    client,
+    *,
+    source_bucket: str,
+    source: S3Object,
+    target_bucket: str,
+    target_key: str,
+) -> None:
+    head = client.head_object(Bucket=source_bucket, Key=source.key, IfMatch=source.etag)
+    headers = {name: head[name] for name in COPIED_HEADERS if head.get(name)}
+    upload_id = client.create_multipart_upload(Bucket=target_bucket, Key=target_key, **headers)["UploadId"]
+
+    def copy_part(part: typing.Tuple[int, int]) -> typing.Dict[str, typing.Any]:
+        part_number, start = part
+        end = min(start + MULTIPART_CHUNKSIZE, source.size) - 1
+        response = client.upload_part_copy(
+            Bucket=target_bucket,
+            Key=target_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={"Bucket": source_bucket, "Key": source.key},
+            # Makes sure that all parts come from the same version of the object
+            CopySourceIfMatch=source.etag,
+            CopySourceRange=f"bytes={start}-{end}",
+        )
+        return {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": part_number}
+
+    parts = list(enumerate(range(0, source.size, MULTIPART_CHUNKSIZE), start=1))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY) as executor:
+            completed_parts = list(executor.map(copy_part, parts))
+        client.complete_multipart_upload(
+            Bucket=target_bucket,
+            Key=target_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": completed_parts},
+        )
+    except Exception:
+        # Otherwise the already copied parts are kept (and billed) until a lifecycle rule removes them
+        client.abort_multipart_upload(Bucket=target_bucket, Key=target_key, UploadId=upload_id)
+        raise
+
+
+class Copier:
+    """Decides how source objects end up in the target, per default every object is copied server side on its own"""
+
+    def group(self, tasks: typing.Iterable[CopyTask]) -> typing.Iterator[typing.List[CopyTask]]:
+        """Groups the tasks which are copied together (and succeed or fail together)"""
+        return ([task] for task in tasks)
+
+    def copy_group(
+        self,
+        client,
+        tasks: typing.List[CopyTask],
+        *,
+        source_bucket: str,
+        target_bucket: str,
+    ) -> None:
+        for task in tasks:
+            self.copy(
+                client,
+                source_bucket=source_bucket,
+                source=task.source,
+                target_bucket=target_bucket,
+                target_key=task.target_key,
+            )
+
+    def copy(
+        self,
+        client,
+        *,
+        source_bucket: str,
+        source: S3Object,
+        target_bucket: str,
+        target_key: str,
+    ) -> None:
+        copy_object(
+            client, source_bucket=source_bucket, source=source, target_bucket=target_bucket, target_key=target_key
+        )
+
+    def list_targets(
+        self,
+        client,
+        bucket: str,
+        prefix: str,
+        *,
+        start_after: typing.Optional[str] = None,
+    ) -> typing.Iterator[S3Object]:
+        """Lists the copies in the target, as plan_sync() needs them to decide what is already copied"""
+        return list_objects(client, bucket, prefix, start_after=start_after)
+
+
+def _timed_copy_group(copier: Copier, client, tasks: typing.List[CopyTask], **kwargs) -> float:
+    started = time.monotonic()
+    copier.copy_group(client, tasks, **kwargs)
+    return time.monotonic() - started
+
+
+def copy_objects(
+    client,
+    tasks: typing.Iterable[CopyTask],
+    *,
+    source_bucket: str,
+    target_bucket: str,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    should_stop: typing.Callable[[], bool] = lambda: False,
+    copier: typing.Optional[Copier] = None,
+) -> CopyResult:
+    """Copies all objects in parallel, with at most max_concurrency copies in flight
+
+    Failed copies do not stop the others, they are collected in the result instead. Tasks are only taken from the
+    iterable while should_stop() returns False, already started copies are always finished.
+    """
+    copier = copier or Copier()
+    result = CopyResult()
+    started = time.monotonic()
+    # Tasks which were taken from the iterable, but are still waiting for their group to fill up
+    ungrouped: typing.Dict[CopyTask, None] = {}
+
+    def take(all_tasks: typing.Iterable[CopyTask]) -> typing.Iterator[CopyTask]:
+        for task in all_tasks:
+            ungrouped[task] = None
+            yield task
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight: typing.Dict[concurrent.futures.Future, typing.List[CopyTask]] = {}
+
+        def collect(done: typing.Iterable[concurrent.futures.Future]) -> None:
+            for future in done:
+                group = in_flight.pop(future)
+                exception = future.exception()
+                if exception is None:
+                    result.copied.extend(group)
+                    result.copy_latencies.append(future.result())
+                else:
+                    result.failed.update((task, exception) for task in group)
+
+        def submit(group: typing.List[CopyTask]) -> None:
+            # Do not queue up the whole listing, it might be huge
+            if len(in_flight) >= 2 * max_concurrency:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            for task in group:
+                ungrouped.pop(task, None)
+            future = executor.submit(
+                _timed_copy_group,
+                copier,
+                client,
+                group,
+                source_bucket=source_bucket,
+                target_bucket=target_bucket,
+            )
+            in_flight[future] = group
+
+        groups = copier.group(take(tasks))
+        while True:
+            if should_stop():
+                result.stopped_early = True
+                # Everything which was taken has to be copied, even if its group is not full yet
+                for group in copier.group(list(ungrouped)):
+                    submit(group)
+                break
+            group = next(groups, None)
+            if group is None:
+                break
+            submit(group)
+        collect(concurrent.futures.wait(in_flight).done)
+    result.copy_seconds = time.monotonic() - started
+    return result
+
+
+def sync(
+    client,
+    source_bucket_uri: str,
+    target_bucket_uri: str,
+    *,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    copier: typing.Optional[Copier] = None,
+) -> CopyResult:
+    """Syncs all objects below the source uri to the target uri (like `aws s3 sync`)"""
+    copier = copier or Copier()
+    source_bucket, source_prefix = parse_s3_uri(source_bucket_uri)
+    target_bucket, target_prefix = parse_s3_uri(target_bucket_uri)
+    source_listing = Listing(list_objects(client, source_bucket, source_prefix))
+    target_listing = Listing(copier.list_targets(client, target_bucket, target_prefix))
+    tasks = plan_sync(source_listing, target_listing, source_prefix=source_prefix, target_prefix=target_prefix)
+    result = copy_objects(
+        client,
+        tasks,
+        source_bucket=source_bucket,
+        target_bucket=target_bucket,
+        max_concurrency=max_concurrency,
+        copier=copier,
+    )
+    result.listed = source_listing.count
+    result.skipped = source_listing.count - len(tasks)
+    result.listing_seconds = source_listing.seconds + target_listing.seconds
+    return result
@@ -0,0 +1 @@
+"""Purely to make tests and linter find the modules within this folder"""
@@ -0,0 +1,226 @@
+"""
+# Input-size-aware sizing of the conversion runs
+
+Before a run of a conversion job is started, the source objects which are new since the last successful run are
+measured and the run gets the workers of the first sizing of the table which fits their size (see
+glue/business_logic/tables.py). What was measured and chosen is saved per run, so that the sizings can be tuned.
+
+The new objects are the ones modified after the watermark of the last successful run (like the Glue bookmarks do).
+Only the keys after the last key of that run are listed (`StartAfter`, like the checkpointed sync of the copy job),
+which assumes that new source objects sort after the existing ones (the raw data is laid out by date). Objects which
+sort before are converted by the bookmarks, but not measured. The state of the last run is kept in a small state
+object: if that run (incl. its retries) failed, its input is measured again for the next run, as the bookmark was not
+moved either.
+
+The sizings are the WorkerSizing of the table registry (glue/business_logic/tables.py), which the stack passes as json.
+"""
+import dataclasses
+import datetime
+import json
+import typing
+
+# The states of a job run which still runs, a new run has to wait for it
+RUNNING_STATES = ("STARTING", "RUNNING", "STOPPING", "WAITING")
+
+
+# The fields of a WorkerSizing of glue/business_logic/tables.py, which this lambda cannot import
+SIZING_FIELDS = ("max_input_mb", "worker_type", "workers")
+Sizing = typing.Dict[str, typing.Any]
+
+
+@dataclasses.dataclass()
+class PendingInput:
+    objects: int = 0
+    bytes: int = 0
+    # The last modification and the last key of the measured objects, the watermarks of the next run if this one
+    # succeeds
+    last_modified: typing.Optional[datetime.datetime] = None
+    last_key: typing.Optional[str] = None
+
+
+@dataclasses.dataclass()
+class RunState:
+    job_run_id: str
+    # The input of the run are the objects modified after since (everything if None) and up to until
+    since: typing.Optional[datetime.datetime]
+    until: typing.Optional[datetime.datetime]
+    # The same by key: the keys after start_after (everything if None) and up to last_key
+    start_after: typing.Optional[str] = None
+    last_key: typing.Optional[str] = None
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "job_run_id": self.job_run_id,
+                "since": self.since.isoformat() if self.since else None,
+                "until": self.until.isoformat() if self.until else None,
+                "start_after": self.start_after,
+                "last_key": self.last_key,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "RunState":
+        raw = json.loads(data)
+        return cls(
+            job_run_id=raw["job_run_id"],
+            since=datetime.datetime.fromisoformat(raw["since"]) if raw["since"] else None,
+            until=datetime.datetime.fromisoformat(raw["until"]) if raw["until"] else None,
+            # Not in the states of older versions
+            start_after=raw.get("start_after"),
+            last_key=raw.get("last_key"),
+        )
+
+
+def parse_s3_uri(uri: str) -> typing.Tuple[str, str]:
+    """Splits a s3 uri into bucket and key (prefix)"""
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not a s3 uri: {uri}")
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return bucket, key.lstrip("/")
+
+
+def parse_sizing_policy(data: str) -> typing.List[Sizing]:
+    """The sizing policy from its json (a list of objects with the fields of a WorkerSizing)"""
+    policy = json.loads(data)
+    for sizing in policy:
+        if sorted(sizing) != sorted(SIZING_FIELDS):
+            raise ValueError(f"Expected a sizing with {', '.join(SIZING_FIELDS)}, got {sizing}")
+    return policy
+
+
+def choose_sizing(policy: typing.List[Sizing], input_bytes: int) -> Sizing:
+    for sizing in policy:
+        if sizing["max_input_mb"] is None or input_bytes <= sizing["max_input_mb"] * 1024 * 1024:
+            return sizing
+    raise ValueError(f"No sizing fits {input_bytes} bytes, the last one must have no max_input_mb")
+
+
+def measure_pending_input(
+    client,
+    source_bucket_uri: str,
+    since: typing.Optional[datetime.datetime] = None,
+    start_after: typing.Optional[str] = None,
+) -> PendingInput:
+    """Sums up the objects below the source uri which sort after start_after and were modified after since"""
+    bucket, prefix = parse_s3_uri(source_bucket_uri)
+    pending = PendingInput()
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=start_after or ""):
+        for item in page.get("Contents", []):
+            # Listed in key order
+            pending.last_key = item["Key"]
+            if since is not None and item["LastModified"] <= since:
+                continue
+            pending.objects += 1
+            pending.bytes += item["Size"]
+            if pending.last_modified is None or item["LastModified"] > pending.last_modified:
+                pending.last_modified = item["LastModified"]
+    return pending
+
+
+def load_state(client, state_uri: str) -> typing.Optional[RunState]:
+    """Returns the state of the last started run or None if no run was started yet"""
+    bucket, key = parse_s3_uri(state_uri)
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except client.exceptions.NoSuchKey:
+        return None
+    return RunState.from_json(response["Body"].read().decode("utf-8"))
+
+
+def _put_json(client, uri: str, body: str) -> None:
+    bucket, key = parse_s3_uri(uri)
+    client.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"), ContentType="application/json")
+
+
+def job_runs_since(glue_client, job_name: str, job_run_id: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """The run and all runs of the job which were started after it, e.g. its retries (which get ids of their own).
+
+    All runs of the job if the run is not found (Glue only keeps the runs of the last 90 days).
+    """
+    runs = []
+    # The newest runs come first
+    for page in glue_client.get_paginator("get_job_runs").paginate(JobName=job_name):
+        for run in page["JobRuns"]:
+            runs.append(run)
+            if run["Id"] == job_run_id:
+                return runs
+    return runs
+
+
+def last_attempt(
+    runs: typing.List[typing.Dict[str, typing.Any]], job_run_id: str
+) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """The last retry of the run (or the run itself without retries), None if it is not in runs"""
+    by_id = {run["Id"]: run for run in runs}
+    # A retry is a run of its own, whose PreviousRunId is the run (or retry) which failed
+    retries = {run["PreviousRunId"]: run for run in runs if run.get("PreviousRunId")}
+    attempt = by_id.get(job_run_id)
+    while attempt is not None and attempt["Id"] in retries:
+        attempt = retries[attempt["Id"]]
+    return attempt
+
+
+def start_sized_run(
+    s3_client,
+    glue_client,
+    *,
+    job_name: str,
+    source_bucket_uri: str,
+    policy: typing.List[Sizing],
+    state_uri: str,
+    report_uri: str,
+) -> typing.Dict[str, typing.Any]:
+    """Measures the pending input of the job and starts a run with the workers of the policy which fit it
+
+    No run is started while another run of the job (e.g. the retry of the last one) still runs or if there is no new
+    input. Returns what was measured and chosen, which is also saved below report_uri (per job run id) for started runs.
+    """
+    state = load_state(s3_client, state_uri)
+    since = None
+    start_after = None
+    if state is not None:
+        runs = job_runs_since(glue_client, job_name, state.job_run_id)
+        for run in runs:
+            if run["JobRunState"] in RUNNING_STATES:
+                return {"started": False, "reason": f"run {run['Id']} is still {run['JobRunState']}"}
+        last_run = last_attempt(runs, state.job_run_id)
+        # Its input is pending again if it did not succeed
+        if last_run is not None and last_run["JobRunState"] == "SUCCEEDED":
+            since, start_after = state.until, state.last_key
+        else:
+            since, start_after = state.since, state.start_after
+
+    pending = measure_pending_input(s3_client, source_bucket_uri, since, start_after)
+    if not pending.objects:
+        return {"started": False, "reason": f"no input modified after {since}"}
+    sizing = choose_sizing(policy, pending.bytes)
+    try:
+        job_run_id = glue_client.start_job_run(
+            JobName=job_name, WorkerType=sizing["worker_type"], NumberOfWorkers=sizing["workers"]
+        )["JobRunId"]
+    except glue_client.exceptions.ConcurrentRunsExceededException:
+        # e.g. a run which was started manually after the runs were checked, the next invocation starts this one
+        return {"started": False, "reason": f"{job_name} already runs"}
+    _put_json(
+        s3_client,
+        state_uri,
+        RunState(
+            job_run_id, since=since, until=pending.last_modified, start_after=start_after, last_key=pending.last_key
+        ).to_json(),
+    )
+
+    report = {
+        "started": True,
+        "job_name": job_name,
+        "job_run_id": job_run_id,
+        "input_since": since.isoformat() if since else None,
+        "input_objects": pending.objects,
+        "input_bytes": pending.bytes,
+        "worker_type": sizing["worker_type"],
+        "workers": sizing["workers"],
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    _put_json(s3_client, f"{report_uri.rstrip('/')}/{job_run_id}.json", json.dumps(report))
+    return report
@@ -0,0 +1,23 @@
+import json
+import os
+
+import boto3
+
+from . import sizing
+
+
+def start_conversion_run(event: dict, context):
+    """Starts a run of the conversion job which is sized for its pending input, see sizing.start_sized_run()"""
+    print(f"request: {json.dumps(event)}, context: {type(context)}")
+
+    result = sizing.start_sized_run(
+        boto3.client("s3"),
+        boto3.client("glue"),
+        job_name=os.environ["JOB_NAME"],
+        source_bucket_uri=os.environ["SOURCE_BUCKET_URI"],
+        policy=sizing.parse_sizing_policy(os.environ["SIZING_POLICY"]),
+        state_uri=os.environ["STATE_URI"],
+        report_uri=os.environ["SIZING_REPORT_URI"],
+    )
+    print(json.dumps(result))
+    return result
@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.fixture(name="spark_session", scope="session")
+def spark_session_fixture(tmp_path_factory):
+    """A local SparkSession like the one of LocalBackend, shared by the tests of the glue code (which need pyspark)"""
+    pytest.importorskip("pyspark")
+    from glue.business_logic import backends
+
+    root = str(tmp_path_factory.mktemp("spark"))
+    spark_session = backends.LocalBackend.create_spark_session(root, backends.LOCAL_CATALOG_IN_MEMORY)
+    yield spark_session
+    spark_session.stop()
+
+
+@pytest.fixture(name="local_backend")
+def local_backend_fixture(spark_session, tmp_path):
+    """A LocalBackend with s3 uris below tmp_path and an empty converted database"""
+    from glue.business_logic import backends
+
+    spark_session.sql("DROP DATABASE IF EXISTS converted CASCADE")
+    spark_session.sql("CREATE DATABASE converted")
+    return backends.LocalBackend(str(tmp_path), spark_session=spark_session)
@@ -0,0 +1,153 @@
+"""In-memory stand-in for the parts of a boto3 s3 client which are used by the copy job"""
+import dataclasses
+import datetime
+import hashlib
+import io
+import typing
+
+from botocore.exceptions import ClientError
+
+
+class _NoSuchKey(Exception):
+    pass
+
+
+def _error(code: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+@dataclasses.dataclass()
+class _FakeObject:
+    body: bytes
+    last_modified: datetime.datetime
+    # e.g. ContentType or Metadata, like head_object returns them
+    headers: typing.Dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    @property
+    def etag(self) -> str:
+        return f'"{hashlib.md5(self.body).hexdigest()}"'
+
+
+class FakeS3Client:
+    class exceptions:
+        NoSuchKey = _NoSuchKey
+
+    def __init__(self, page_size: int = 2):
+        self.buckets: typing.Dict[str, typing.Dict[str, _FakeObject]] = {}
+        # (operation name, kwargs) of all calls, for asserting on them
+        self.calls: typing.List[typing.Tuple[str, typing.Dict[str, typing.Any]]] = []
+        # Small pages to make sure that pagination is handled
+        self.page_size = page_size
+        # The parts of the multipart uploads which are not completed yet
+        self.uploads: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+    def add(self, bucket: str, key: str, body: bytes = b"", day: int = 1, **headers) -> None:
+        self.buckets.setdefault(bucket, {})[key] = _FakeObject(body, datetime.datetime(2022, 10, day), headers)
+
+    def headers(self, bucket: str, key: str) -> typing.Dict[str, typing.Any]:
+        return self.buckets[bucket][key].headers
+
+    def keys(self, bucket: str) -> typing.List[str]:
+        return sorted(self.buckets.get(bucket, {}))
+
+    def body(self, bucket: str, key: str) -> bytes:
+        return self.buckets[bucket][key].body
+
+    def calls_of(self, operation: str) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [kwargs for name, kwargs in self.calls if name == operation]
+
+    # boto3 api
+
+    def get_paginator(self, operation: str) -> "FakeS3Client":
+        assert operation == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str = "", StartAfter: str = "") -> typing.Iterator[dict]:
+        self.calls.append(("list_objects_v2", {"Bucket": Bucket, "Prefix": Prefix, "StartAfter": StartAfter}))
+        keys = [key for key in self.keys(Bucket) if key.startswith(Prefix) and key > StartAfter]
+        for start in range(0, max(len(keys), 1), self.page_size):
+            end = start + self.page_size
+            yield {
+                "Contents": [
+                    {
+                        "Key": key,
+                        "Size": len(self.buckets[Bucket][key].body),
+                        "ETag": self.buckets[Bucket][key].etag,
+                        "LastModified": self.buckets[Bucket][key].last_modified,
+                    }
+                    for key in keys[start:end]
+                ]
+            }
+
+    def get_object(self, Bucket: str, Key: str, IfMatch: str = None) -> dict:
+        self.calls.append(("get_object", {"Bucket": Bucket, "Key": Key}))
+        try:
+            obj = self.buckets[Bucket][Key]
+        except KeyError:
+            raise _NoSuchKey(Key)
+        assert IfMatch in (None, obj.etag)
+        return {"Body": io.BytesIO(obj.body), "ContentLength": len(obj.body), "ETag": obj.etag}
+
+    def head_object(self, Bucket: str, Key: str, IfMatch: str = None) -> dict:
+        self.calls.append(("head_object", {"Bucket": Bucket, "Key": Key}))
+        try:
+            obj = self.buckets[Bucket][Key]
+        except KeyError:
+            raise _error("404", "HeadObject")
+        assert IfMatch in (None, obj.etag)
+        return {"ContentLength": len(obj.body), "ETag": obj.etag, "LastModified": obj.last_modified, **obj.headers}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **headers) -> dict:
+        self.calls.append(("create_multipart_upload", {"Bucket": Bucket, "Key": Key, **headers}))
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {"Bucket": Bucket, "Key": Key, "headers": headers, "parts": {}}
+        return {"UploadId": upload_id}
+
+    def upload_part_copy(
+        self,
+        Bucket: str,
+        Key: str,
+        UploadId: str,
+        PartNumber: int,
+        CopySource: dict,
+        CopySourceRange: str,
+        CopySourceIfMatch: str = None,
+    ) -> dict:
+        self.calls.append(("upload_part_copy", {"Key": Key, "PartNumber": PartNumber, "Range": CopySourceRange}))
+        source = self.buckets[CopySource["Bucket"]][CopySource["Key"]]
+        assert CopySourceIfMatch in (None, source.etag)
+        start, end = (int(value) for value in CopySourceRange.removeprefix("bytes=").split("-"))
+        part = source.body[start : end + 1]  # noqa: E203
+        self.uploads[UploadId]["parts"][PartNumber] = part
+        return {"CopyPartResult": {"ETag": f'"{hashlib.md5(part).hexdigest()}"'}}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict) -> dict:
+        self.calls.append(("complete_multipart_upload", {"Bucket": Bucket, "Key": Key}))
+        upload = self.uploads.pop(UploadId)
+        parts = upload["parts"]
+        body = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.add(Bucket, Key, body, **upload["headers"])
+        return {}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> dict:
+        self.calls.append(("abort_multipart_upload", {"Bucket": Bucket, "Key": Key}))
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs) -> dict:
+        self.calls.append(("put_object", {"Bucket": Bucket, "Key": Key, **kwargs}))
+        self.add(Bucket, Key, Body if isinstance(Body, bytes) else Body.read())
+        return {}
+
+    def delete_object(self, Bucket: str, Key: str) -> dict:
+        self.calls.append(("delete_object", {"Bucket": Bucket, "Key": Key}))
+        self.buckets.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    def copy_object(self, Bucket: str, Key: str, CopySource: dict, CopySourceIfMatch: str = None) -> dict:
+        self.calls.append(("copy_object", {"Bucket": Bucket, "Key": Key, "CopySource": CopySource}))
+        source = self.buckets[CopySource["Bucket"]][CopySource["Key"]]
+        if CopySourceIfMatch not in (None, source.etag):
+            raise _error("PreconditionFailed", "CopyObject")
+        self.buckets.setdefault(Bucket, {})[Key] = source
+        return {}
@@ -0,0 +1,20 @@
+import pytest
+
+# The backends import pyspark (pyspark is in requirements-dev.txt)
+pytest.importorskip("pyspark")
+
+from glue.business_logic import backends  # noqa: E402
+
+
+def test_split_s3_uri():
+    assert backends.split_s3_uri("s3://raw/converted/journeys/") == ("raw", "converted/journeys/")
+    assert backends.split_s3_uri("s3://raw") == ("raw", "")
+    with pytest.raises(ValueError, match="Not a s3 uri"):
+        backends.split_s3_uri("/tmp/raw")
+
+
+def test_local_backend_maps_s3_uris_below_its_root(tmp_path, spark_session):
+    backend = backends.LocalBackend(str(tmp_path), spark_session=spark_session)
+
+    assert backend.path("s3://raw/converted/journeys") == str(tmp_path / "raw" / "converted" / "journeys")
+    assert backend.path("/tmp/raw") == "/tmp/raw"
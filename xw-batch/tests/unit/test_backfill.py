@@ -0,0 +1,87 @@
+from lambdas.copyjob_for_s3_data import backfill
+from tests.unit.fake_s3 import FakeS3Client
+
+
+def _client_with_source_objects(count: int) -> FakeS3Client:
+    client = FakeS3Client()
+    for i in range(count):
+        client.add("source", f"a/{i:02}", str(i).encode())
+    return client
+
+
+def test_plan_shards():
+    client = _client_with_source_objects(5)
+
+    assert backfill.plan_shards(client, "s3://source/a", keys_per_shard=2) == [
+        {"start_after": None, "last_key": "a/01"},
+        {"start_after": "a/01", "last_key": "a/03"},
+        {"start_after": "a/03", "last_key": "a/04"},
+    ]
+    assert backfill.plan_shards(client, "s3://source/a", keys_per_shard=5) == [
+        {"start_after": None, "last_key": "a/04"},
+    ]
+    assert backfill.plan_shards(FakeS3Client(), "s3://source/a") == []
+
+
+def test_copy_shard_copies_only_the_keys_in_the_shard():
+    client = _client_with_source_objects(6)
+    client.add("target", "b/03", b"3")
+
+    result = backfill.copy_shard(
+        client, "s3://source/a", "s3://target/b", {"start_after": "a/01", "last_key": "a/04"}, max_concurrency=2
+    )
+
+    assert backfill.shard_result({"start_after": "a/01", "last_key": "a/04"}, result) == {
+        "start_after": "a/01",
+        "last_key": "a/04",
+        "planned": 2,
+        "copied": 2,
+        "copied_bytes": 2,
+        "failed": {},
+        "stopped_early": False,
+    }
+    assert client.keys("target") == ["b/02", "b/03", "b/04"]
+    assert (result.listed, result.skipped) == (3, 1)
+
+
+def test_all_shards_copy_everything():
+    client = _client_with_source_objects(7)
+
+    for shard in backfill.plan_shards(client, "s3://source/a", keys_per_shard=3):
+        backfill.copy_shard(client, "s3://source/a", "s3://target/b", shard)
+
+    assert client.keys("target") == [f"b/{i:02}" for i in range(7)]
+
+
+def test_summarize():
+    shard_results = [
+        {"copied": 2, "copied_bytes": 20, "failed": {}, "stopped_early": False},
+        {"copied": 1, "copied_bytes": 10, "failed": {"a/1": "error"}, "stopped_early": False},
+        {"copied": 3, "copied_bytes": 30, "failed": {}, "stopped_early": True},
+    ]
+
+    summary = backfill.summarize(shard_results)
+
+    assert summary == {
+        "shards": 3,
+        "copied": 6,
+        "copied_bytes": 60,
+        "failed": 1,
+        "incomplete_shards": shard_results[1:],
+    }
+
+
+def test_shards_and_results_are_saved_per_run():
+    client = FakeS3Client()
+    shards = [{"start_after": None, "last_key": "a/01"}, {"start_after": "a/01", "last_key": "a/03"}]
+
+    keys = backfill.save_shards(client, "s3://target/_state/backfills/run", shards)
+    backfill.save_shard_result(client, "target", keys[0], {**shards[0], "copied": 2})
+
+    assert keys == ["_state/backfills/run/shards/000000.json", "_state/backfills/run/shards/000001.json"]
+    assert backfill.load_shard(client, "target", keys[1]) == shards[1]
+    results = backfill.load_shard_results(client, "s3://target/_state/backfills/run/")
+    assert results[0] == {**shards[0], "copied": 2}
+    # without a result, the shard crashed
+    assert results[1]["last_key"] == "a/03"
+    assert results[1]["failed"] and results[1]["copied"] == 0
@@ -0,0 +1,153 @@
+import datetime
+from unittest import mock
+
+from lambdas.copyjob_for_s3_data import checkpoint, notifications, s3_copy
+from tests.unit.fake_s3 import FakeS3Client
+
+_CHECKPOINT_URI = "s3://target/_state/checkpoint.json"
+
+
+def _sync(client: FakeS3Client, **kwargs) -> s3_copy.CopyResult:
+    return checkpoint.sync_incremental(client, "s3://source/a", "s3://target/b", _CHECKPOINT_URI, **kwargs)
+
+
+def test_checkpoint_roundtrip():
+    cp = checkpoint.Checkpoint(
+        last_key="a/2",
+        in_flight=[
+            s3_copy.S3Object("a/1", 10, '"etag1"', datetime.datetime(2022, 10, 1, tzinfo=datetime.timezone.utc))
+        ],
+    )
+    assert checkpoint.Checkpoint.from_json(cp.to_json()) == cp
+
+
+def test_load_checkpoint_without_checkpoint():
+    assert checkpoint.load_checkpoint(FakeS3Client(), _CHECKPOINT_URI) is None
+
+
+def test_sync_incremental_first_run_is_a_full_sync():
+    client = FakeS3Client()
+    client.add("source", "a/1", b"1")
+    client.add("source", "a/2", b"2")
+    client.add("target", "b/1", b"1")
+
+    result = _sync(client)
+
+    assert [task.target_key for task in result.copied] == ["b/2"]
+    # target was listed to find what is already there
+    assert {call["Bucket"] for call in client.calls_of("list_objects_v2")} == {"source", "target"}
+    cp = checkpoint.load_checkpoint(client, _CHECKPOINT_URI)
+    assert cp.last_key == "a/2"
+    assert cp.in_flight == []
+
+
+def test_sync_incremental_only_lists_after_the_watermark():
+    client = FakeS3Client()
+    client.add("source", "a/1", b"1")
+    _sync(client)
+    client.add("source", "a/2", b"2")
+    client.calls.clear()
+
+    result = _sync(client)
+
+    assert [task.target_key for task in result.copied] == ["b/2"]
+    # The target is only listed after the watermark as well, to skip what is already copied
+    assert sorted(client.calls_of("list_objects_v2"), key=lambda call: call["Bucket"]) == [
+        {"Bucket": "source", "Prefix": "a/", "StartAfter": "a/1"},
+        {"Bucket": "target", "Prefix": "b/", "StartAfter": "b/1"},
+    ]
+
+
+def test_sync_incremental_resumes_after_stopping():
+    client = FakeS3Client()
+    client.add("source", "a/0", b"0")
+    _sync(client)
+    for i in range(1, 6):
+        client.add("source", f"a/{i}", str(i).encode())
+    started = []
+
+    def stop_after_two() -> bool:
+        started.append(True)
+        return len(started) > 2
+
+    result = _sync(client, max_concurrency=1, should_stop=stop_after_two)
+
+    assert result.stopped_early
+    assert len(result.copied) == 2
+    assert checkpoint.load_checkpoint(client, _CHECKPOINT_URI).last_key == "a/2"
+
+    _sync(client)
+
+    assert client.keys("target")[1:] == [f"b/{i}" for i in range(6)]
+    assert checkpoint.load_checkpoint(client, _CHECKPOINT_URI).last_key == "a/5"
+
+
+def test_sync_incremental_retries_failed_copies():
+    client = FakeS3Client()
+    client.add("source", "a/0", b"0")
+    _sync(client)
+    client.add("source", "a/1", b"1")
+    client.add("source", "a/2", b"2")
+    copy_object = client.copy_object
+
+    def fail_on_first(**kwargs):
+        if kwargs["Key"] == "b/1":
+            raise ValueError("broken")
+        return copy_object(**kwargs)
+
+    client.copy_object = fail_on_first  # type: ignore
+
+    result = _sync(client)
+
+    assert [task.target_key for task in result.failed] == ["b/1"]
+    cp = checkpoint.load_checkpoint(client, _CHECKPOINT_URI)
+    assert cp.last_key == "a/2"
+    assert [obj.key for obj in cp.in_flight] == ["a/1"]
+
+    client.copy_object = copy_object  # type: ignore
+    result = _sync(client)
+
+    assert [task.target_key for task in result.copied] == ["b/1"]
+    assert checkpoint.load_checkpoint(client, _CHECKPOINT_URI).in_flight == []
+
+
+def test_sync_incremental_retries_the_current_version_of_overwritten_objects():
+    client = FakeS3Client()
+    client.add("source", "a/0", b"0")
+    _sync(client)
+    client.add("source", "a/1", b"old")
+    client.add("source", "a/2", b"2")
+    copy_object = client.copy_object
+
+    def overwrite_while_copying(**kwargs):
+        if kwargs["Key"] == "b/1":
+            client.add("source", "a/1", b"new")
+        return copy_object(**kwargs)
+
+    with mock.patch.object(client, "copy_object", overwrite_while_copying):
+        result = _sync(client)
+
+    assert [task.target_key for task in result.failed] == ["b/1"]
+    assert notifications.is_superseded(next(iter(result.failed.values())))
+    assert [obj.key for obj in checkpoint.load_checkpoint(client, _CHECKPOINT_URI).in_flight] == ["a/1"]
+
+    result = _sync(client)
+
+    assert [task.target_key for task in result.copied] == ["b/1"]
+    assert client.body("target", "b/1") == b"new"
+    assert checkpoint.load_checkpoint(client, _CHECKPOINT_URI).in_flight == []
+
+
+def test_sync_incremental_drops_deleted_objects_in_flight():
+    client = FakeS3Client()
+    client.add("source", "a/0", b"0")
+    _sync(client)
+    client.add("source", "a/1", b"1")
+
+    with mock.patch.object(client, "copy_object", side_effect=ValueError("broken")):
+        _sync(client)
+    client.delete_object(Bucket="source", Key="a/1")
+    result = _sync(client)
+
+    assert result.copied == [] and result.failed == {}
+    assert checkpoint.load_checkpoint(client, _CHECKPOINT_URI).in_flight == []
@@ -0,0 +1,140 @@
+import datetime
+import gzip
+import json
+from unittest import mock
+
+from lambdas.copyjob_for_s3_data import backfill, checkpoint, coalesce, s3_copy
+from tests.unit.fake_s3 import FakeS3Client
+
+
+def _gzip_lines(*lines: str, newline: bool = True) -> bytes:
+    return gzip.compress("\n".join(lines).encode() + (b"\n" if newline else b""))
+
+
+def _copier(**kwargs) -> coalesce.CoalescingCopier:
+    config = coalesce.CoalesceConfig(index_uri="s3://target/_state/b/coalesce", **kwargs)
+    return coalesce.CoalescingCopier(config, target_bucket_uri="s3://target/b")
+
+
+def _sync(client: FakeS3Client, copier: coalesce.CoalescingCopier) -> s3_copy.CopyResult:
+    return s3_copy.sync(client, "s3://source/a", "s3://target/b", max_concurrency=2, copier=copier)
+
+
+def _data_keys(client: FakeS3Client) -> list:
+    return [key for key in client.keys("target") if key.startswith("b/")]
+
+
+def test_small_objects_are_coalesced_per_directory():
+    client = FakeS3Client()
+    client.add("source", "a/1/x.json.gz", _gzip_lines('{"id": 1}', '{"id": 2}'))
+    # Without a newline at the end, the next object must not continue its last line
+    client.add("source", "a/1/y.json.gz", _gzip_lines('{"id": 3}', newline=False))
+    client.add("source", "a/2/z.json.gz", _gzip_lines('{"id": 4}'))
+    client.add("source", "a/2/big.json.gz", b"x" * 1000)
+
+    result = _sync(client, _copier(max_source_size=100))
+
+    assert len(result.copied) == 4
+    assert _data_keys(client) == ["b/1/x.coalesced.json.gz", "b/2/big.json.gz", "b/2/z.coalesced.json.gz"]
+    lines = gzip.decompress(client.body("target", "b/1/x.coalesced.json.gz")).splitlines()
+    assert [line for line in lines if line] == [b'{"id": 1}', b'{"id": 2}', b'{"id": 3}']
+    index = json.loads(client.body("target", "_state/b/coalesce/1/x.coalesced.json.gz.json"))
+    assert index["target_key"] == "b/1/x.coalesced.json.gz"
+    assert [source["key"] for source in index["sources"]] == ["a/1/x.json.gz", "a/1/y.json.gz"]
+
+
+def test_coalesced_objects_have_about_the_target_size():
+    client = FakeS3Client()
+    for i in range(5):
+        client.add("source", f"a/{i}.json.gz", _gzip_lines(f'{{"id": {i}}}'))
+    size = len(client.body("source", "a/0.json.gz"))
+
+    _sync(client, _copier(target_size=2 * size))
+
+    assert _data_keys(client) == ["b/0.coalesced.json.gz", "b/2.coalesced.json.gz", "b/4.coalesced.json.gz"]
+
+
+def test_coalesced_objects_are_not_copied_again():
+    client = FakeS3Client()
+    for i in range(3):
+        client.add("source", f"a/{i}.json.gz", _gzip_lines(f'{{"id": {i}}}'))
+    _sync(client, _copier())
+    client.add("source", "a/3.json.gz", _gzip_lines('{"id": 3}'))
+
+    result = _sync(client, _copier())
+
+    assert [task.source.key for task in result.copied] == ["a/3.json.gz"]
+    assert _data_keys(client) == ["b/0.coalesced.json.gz", "b/3.coalesced.json.gz"]
+
+
+def test_incremental_sync_knows_the_sources_of_interleaved_indexes():
+    client = FakeS3Client()
+    for i in range(5):
+        client.add("source", f"a/{i}.json.gz", _gzip_lines(f'{{"id": {i}}}'))
+    tasks = [
+        s3_copy.CopyTask(obj, f"b/{obj.key.removeprefix('a/')}") for obj in s3_copy.list_objects(client, "source", "a/")
+    ]
+    copier = _copier()
+    # e.g. a retry of failed copies, the sources of the indexes are not in key order one index after the other
+    copier.coalesce(client, [tasks[0], tasks[2], tasks[4]], source_bucket="source", target_bucket="target")
+    copier.coalesce(client, [tasks[1], tasks[3]], source_bucket="source", target_bucket="target")
+    checkpoint_uri = "s3://target/_state/b/checkpoint.json"
+    checkpoint.save_checkpoint(client, checkpoint_uri, checkpoint.Checkpoint())
+
+    result = checkpoint.sync_incremental(client, "s3://source/a", "s3://target/b", checkpoint_uri, copier=copier)
+
+    assert result.copied == []
+    assert result.skipped == 5
+    assert _data_keys(client) == ["b/0.coalesced.json.gz", "b/1.coalesced.json.gz"]
+
+
+def test_backfill_shards_know_the_coalesced_objects():
+    client = FakeS3Client()
+    for i in range(6):
+        client.add("source", f"a/{i}.json.gz", _gzip_lines(f'{{"id": {i}}}'))
+    # One coalesced object spans the shards
+    _sync(client, _copier())
+    client.add("source", "a/6.json.gz", _gzip_lines('{"id": 6}'))
+
+    results = [
+        backfill.copy_shard(client, "s3://source/a", "s3://target/b", shard, copier=_copier())
+        for shard in backfill.plan_shards(client, "s3://source/a", keys_per_shard=3)
+    ]
+
+    assert [task.source.key for result in results for task in result.copied] == ["a/6.json.gz"]
+
+
+def test_groups_which_are_not_full_are_copied_when_stopping():
+    sizes = [10, 1000, 10, 10]
+    tasks = [
+        s3_copy.CopyTask(
+            s3_copy.S3Object(f"a/{i}.json.gz", size, '"e"', datetime.datetime(2022, 10, 1)), f"b/{i}.json.gz"
+        )
+        for i, size in enumerate(sizes)
+    ]
+    copier = _copier(max_source_size=100)
+    copied = []
+    taken = []
+
+    def tracked_tasks():
+        for task in tasks:
+            taken.append(task)
+            yield task
+
+    def copy_group(client, tasks, **kwargs):
+        copied.append([task.source.key for task in tasks])
+
+    with mock.patch.object(copier, "copy_group", copy_group):
+        result = s3_copy.copy_objects(
+            FakeS3Client(),
+            tracked_tasks(),
+            source_bucket="source",
+            target_bucket="target",
+            should_stop=lambda: len(taken) >= 2,
+            copier=copier,
+        )
+
+    assert result.stopped_early
+    # The big object is copied on its own, the small one before it is still waiting for its group to fill up
+    assert sorted(copied) == [["a/0.json.gz"], ["a/1.json.gz"]]
+    assert sorted(task.source.key for task in result.copied) == ["a/0.json.gz", "a/1.json.gz"]
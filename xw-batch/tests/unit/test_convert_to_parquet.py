@@ -0,0 +1,149 @@
+import dataclasses
+import glob
+import gzip
+import importlib
+import json
+import os
+import types
+
+import pytest
+
+# The conversion runs on Spark, like in the Glue jobs (pyspark is in requirements-dev.txt, and needs java)
+pytest.importorskip("pyspark")
+
+from glue.scripts import convert_to_parquet  # noqa: E402
+
+JOURNEYS = [
+    {
+        "journey_id": f"j{index}",
+        "customer_id": f"c{index % 2}",
+        "scooter_id": "s1",
+        "start_dt": f"2022-10-0{day}T10:00:00",
+        "end_dt": f"2022-10-0{day}T10:20:00",
+        "amount_cents": str(100 + index),
+    }
+    for index, day in enumerate([1, 1, 2])
+]
+
+
+def _write_source(backend, key: str, lines) -> None:
+    path = backend.path(f"s3://raw/scoofy/journeys/{key}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def _args(**args: str):
+    return {
+        **convert_to_parquet.LOCAL_JOB_ARGUMENT_DEFAULTS,
+        "SOURCE_BUCKET_URI": "s3://raw/scoofy/journeys/",
+        "TARGET_BUCKET_URI": "s3://raw/converted/journeys/",
+        "TARGET_DB_NAME": "converted",
+        "TARGET_TABLE_NAME": "journeys",
+        **args,
+    }
+
+
+@pytest.fixture(name="backend")
+def backend_fixture(local_backend):
+    _write_source(local_backend, "2022/10/01/journeys.json.gz", [json.dumps(journey) for journey in JOURNEYS])
+    return local_backend
+
+
+def test_overwrite_partitions_converts_the_same_source_only_once(backend):
+    convert_to_parquet.etl(_args(), backend)
+    # e.g. a retry, or a reset bookmark
+    convert_to_parquet.etl(_args(), backend)
+
+    converted = backend.spark_session.table("converted.journeys")
+    assert sorted((row.journey_id, str(row._created_at)) for row in converted.collect()) == [
+        ("j0", "2022-10-01"),
+        ("j1", "2022-10-01"),
+        ("j2", "2022-10-02"),
+    ]
+
+
+def test_append_converts_the_same_source_again(backend):
+    convert_to_parquet.etl(_args(LOAD_MODE=convert_to_parquet.LOAD_MODE_APPEND), backend)
+    convert_to_parquet.etl(_args(LOAD_MODE=convert_to_parquet.LOAD_MODE_APPEND), backend)
+
+    assert backend.spark_session.table("converted.journeys").count() == 6
+
+
+def test_malformed_records_fail_the_run(backend):
+    _write_source(backend, "2022/10/02/broken.json.gz", ['{"journey_id": "j3", '])
+
+    with pytest.raises(ValueError, match="malformed"):
+        convert_to_parquet.etl(_args(), backend)
+    assert not convert_to_parquet.table_exists(backend.spark_session, "converted", "journeys")
+
+    convert_to_parquet.etl(_args(MALFORMED_RECORDS_POLICY=convert_to_parquet.MALFORMED_RECORDS_DROP), backend)
+    assert backend.spark_session.table("converted.journeys").count() == 3
+
+
+def test_run_report(backend):
+    convert_to_parquet.etl(_args(RUN_REPORT_URI="s3://raw/_reports/"), backend)
+
+    (report_path,) = glob.glob(os.path.join(backend.path("s3://raw/_reports/journeys"), "*.json"))
+    with open(report_path) as file:
+        report = json.load(file)
+    assert report["table"] == "journeys"
+    assert report["status"] == "succeeded"
+    assert report["output_files"] >= 2
+    assert {"extract", "load"} <= set(report["phases"])
+
+
+def test_rollup_is_seeded_with_the_days_converted_before(backend):
+    convert_to_parquet.etl(_args(), backend)
+    _write_source(backend, "2022/10/02/more.json.gz", [json.dumps({**JOURNEYS[2], "journey_id": "j3"})])
+
+    # Only the new day, like with bookmarks
+    convert_to_parquet.etl(
+        _args(
+            SOURCE_BUCKET_URI="s3://raw/scoofy/journeys/2022/10/02/", ROLLUP_TABLE_NAME="journeys_per_customer_daily"
+        ),
+        backend,
+    )
+
+    rollup = backend.spark_session.table("converted.journeys_per_customer_daily")
+    assert sorted((row.customer_id, str(row._created_at), row.journeys) for row in rollup.collect()) == [
+        ("c0", "2022-10-01", 1),
+        ("c0", "2022-10-02", 2),
+        ("c1", "2022-10-01", 1),
+    ]
+
+
+def _tables_args(**args: str):
+    return {
+        **convert_to_parquet.LOCAL_BATCH_JOB_ARGUMENT_DEFAULTS,
+        "TABLE_NAMES": "journeys",
+        "RAW_BUCKET_URI": "s3://raw",
+        "TARGET_DB_NAME": "converted",
+        **args,
+    }
+
+
+def test_several_tables_cannot_be_appended():
+    with pytest.raises(ValueError, match="append cannot convert several tables"):
+        convert_to_parquet.etl_tables(_tables_args(LOAD_MODE=convert_to_parquet.LOAD_MODE_APPEND), backend=None)
+
+
+@pytest.mark.parametrize("failure_policy", ["fail", "skip"])
+def test_failing_tables_are_not_committed(monkeypatch, failure_policy: str):
+    # The registry as the script imports it
+    tables = importlib.import_module("business_logic.tables")
+    journeys = dataclasses.replace(tables.get_table("journeys"), failure_policy=failure_policy)
+    monkeypatch.setattr(tables, "get_table", lambda name: journeys)
+
+    def fail(args, backend):
+        raise OSError("s3 is down")
+
+    monkeypatch.setattr(convert_to_parquet, "etl", fail)
+    backend = types.SimpleNamespace(for_table=lambda name: None)
+
+    if failure_policy == "fail":
+        with pytest.raises(RuntimeError, match="Converting journeys failed"):
+            convert_to_parquet.run(_tables_args(), backend)
+    else:
+        # main() does not commit the bookmarks of a run with skipped tables
+        assert convert_to_parquet.run(_tables_args(), backend) == ["journeys"]
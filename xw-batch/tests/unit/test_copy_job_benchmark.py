@@ -0,0 +1,13 @@
+from benchmarks import copy_job
+
+
+def test_benchmark_reports_every_run():
+    report = copy_job.run_benchmark(objects=5, object_size=1000, concurrencies=[1, 4])
+
+    assert report["parameters"]["objects"] == 5
+    assert [run["max_concurrency"] for run in report["runs"]] == [1, 4]
+    for run in report["runs"]:
+        assert run["objects"] == 5
+        assert run["bytes"] == report["parameters"]["source_bytes"]
+        assert run["s3_requests_by_operation"]["CopyObject"] == 5
+        assert run["peak_rss_mb"] > 0
@@ -1,11 +1,15 @@
+import hashlib
+import json
 from unittest.mock import MagicMock
 
 import aws_cdk
 import pytest
 from aws_cdk import aws_s3
 from aws_cdk.assertions import Match, Template
+from botocore.exceptions import ClientError
 
-import lambdas.copyjob_for_s3_data.copyjob_for_s3_data
+from lambdas.copyjob_for_s3_data import copyjob_for_s3_data, s3_copy
+from tests.unit.fake_s3 import FakeS3Client
 
 # In InteliJ, you have to mark the xw_batch folder as "source folder"
 from xw_batch.copy_s3_data import CopyS3Data
@@ -25,6 +29,40 @@ class _S3CopyStack(aws_cdk.Stack):
         )
 
 
+class _EventDrivenS3CopyStack(aws_cdk.Stack):
+    def __init__(self):
+        super().__init__()
+        self.bucket = aws_s3.Bucket(self, id="test-bucket", bucket_name="target-test")
+        self.copy_job = CopyS3Data(
+            self,
+            "s3-copy-job",
+            source_bucket_path="/source-path",
+            source_bucket_name="source-bucket",
+            target_bucket=self.bucket,
+            target_bucket_path="/target-path",
+            event_driven=True,
+            event_batch_size=500,
+            event_max_batching_window=aws_cdk.Duration.seconds(20),
+        )
+
+
+class _BackfillS3CopyStack(aws_cdk.Stack):
+    def __init__(self):
+        super().__init__()
+        self.bucket = aws_s3.Bucket(self, id="test-bucket", bucket_name="target-test")
+        self.copy_job = CopyS3Data(
+            self,
+            "s3-copy-job",
+            source_bucket_path="/source-path",
+            source_bucket_name="source-bucket",
+            target_bucket=self.bucket,
+            target_bucket_path="/target-path",
+            backfill=True,
+            backfill_max_concurrency=5,
+            backfill_keys_per_shard=1000,
+        )
+
+
 @pytest.fixture(name="stack", scope="module")
 def stack_fixture() -> _S3CopyStack:
     stack = _S3CopyStack()
@@ -41,14 +79,14 @@ def test_cron_lambda_created(template: Template):
     template.has_resource_properties(
         "AWS::Lambda::Function",
         props={
-            "Handler": "copyjob_for_s3_data.sync_bucket_uri",
+            "Handler": "copyjob_for_s3_data.copyjob_for_s3_data.sync_bucket_uri",
             "Runtime": "python3.9",
+            "MemorySize": 1024,
         },
     )
 
     # Needs to have:
     # - Lambda
-    #   - with an aws cli layer
     #   - with access to the source and target bucket
     #   - A role to be assumed
     # - synchron-rule to copy the stuff every hour
@@ -156,26 +194,26 @@ def test_copy_job_lambda_sets_env_variables(
                             ["s3://", resolved_target_bucket_name, "/target-path"],
                         ]
                     },
+                    "CHECKPOINT_URI": {
+                        "Fn::Join": [
+                            "",
+                            ["s3://", resolved_target_bucket_name, "/_copyjob_state/target-path/checkpoint.json"],
+                        ]
+                    },
+                    "MAX_CONCURRENCY": "64",
+                    "METRICS_NAMESPACE": "XwBatch/CopyS3Data",
+                    "COPY_JOB_NAME": "s3-copy-job",
                 }
             },
         },
     )
 
 
-def test_copy_job_lambda_has_aws_cli(
+def test_copy_job_lambda_has_no_aws_cli(
     template: Template,
 ):
-    # access to the aws cli
-    template.has_resource_properties(
-        "AWS::Lambda::LayerVersion",
-        {
-            "Content": {
-                "S3Bucket": {"Fn::Sub": Match.string_like_regexp(r"\${AWS::AccountId}-\${AWS::Region}")},
-                "S3Key": Match.string_like_regexp(r".*\.zip"),
-            },
-            "Description": "/opt/awscli/aws",
-        },
-    )
+    # The copy is done in process, so no aws cli layer is needed anymore
+    template.resource_count_is("AWS::Lambda::LayerVersion", 0)
 
 
 def test_copy_job_sync_rule(
@@ -212,44 +250,391 @@ def test_copy_job_sync_rule(
     )
 
 
-def test_copy_s3_data_lambda(monkeypatch):
-    #     sync_command = f"/opt/awscli/aws s3 sync {source_bucket_uri} {target_bucket_uri}"
-    #     subprocess.check_call(sync_command, shell=True)
+def test_event_driven_copy_job_is_not_created_per_default(template: Template):
+    template.resource_count_is("AWS::SQS::Queue", 0)
+    template.resource_count_is("AWS::Lambda::Function", 1)
+
+
+def test_event_driven_copy_job():
+    stack = _EventDrivenS3CopyStack()
+    template = Template.from_stack(stack)
+    resolved_queue_arn = stack.resolve(stack.copy_job.copy_events_queue.queue_arn)
+
+    # the scheduled sync stays as reconciliation
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "copyjob_for_s3_data.copyjob_for_s3_data.sync_bucket_uri"},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "copyjob_for_s3_data.copyjob_for_s3_data.copy_notified_objects", "Timeout": 300},
+    )
+    template.has_resource_properties(
+        "AWS::SQS::Queue",
+        {"VisibilityTimeout": 1800, "RedrivePolicy": {"maxReceiveCount": 5}},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::EventSourceMapping",
+        {
+            "EventSourceArn": resolved_queue_arn,
+            "BatchSize": 500,
+            "MaximumBatchingWindowInSeconds": 20,
+            "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        },
+    )
+    template.has_resource_properties(
+        "Custom::S3BucketNotifications",
+        {
+            "BucketName": "source-bucket",
+            "NotificationConfiguration": {
+                "QueueConfigurations": [
+                    {
+                        "Events": ["s3:ObjectCreated:*"],
+                        "Filter": {"Key": {"FilterRules": [{"Name": "prefix", "Value": "source-path/"}]}},
+                        "QueueArn": resolved_queue_arn,
+                    }
+                ]
+            },
+            "Managed": False,
+        },
+    )
+
+
+def test_backfill_copy_job():
+    stack = _BackfillS3CopyStack()
+    template = Template.from_stack(stack)
+
+    template.resource_count_is("AWS::StepFunctions::StateMachine", 1)
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "copyjob_for_s3_data.copyjob_for_s3_data.plan_backfill_shards",
+            "Environment": {"Variables": {"KEYS_PER_SHARD": "1000"}},
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "copyjob_for_s3_data.copyjob_for_s3_data.copy_backfill_shard"},
+    )
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {"Handler": "copyjob_for_s3_data.copyjob_for_s3_data.summarize_backfill"},
+    )
+    definition = json.dumps(
+        stack.resolve(next(iter(template.find_resources("AWS::StepFunctions::StateMachine").values())))
+    )
+    assert '\\"MaxConcurrency\\":5' in definition
+    assert '\\"ItemsPath\\":\\"$.shards\\"' in definition
+    # The shards and their results are not passed through the payloads
+    assert '\\"Parameters\\":{\\"shard_key.$\\":\\"$$.Map.Item.Value\\"}' in definition
+    assert '\\"ResultPath\\":null' in definition
+
+
+def test_rechunk_copy_job():
+    stack = aws_cdk.Stack()
+    CopyS3Data(
+        stack,
+        "s3-copy-job",
+        source_bucket_path="/source-path",
+        source_bucket_name="source-bucket",
+        target_bucket=aws_s3.Bucket(stack, id="test-bucket", bucket_name="target-test"),
+        target_bucket_path="/target-path",
+        rechunk=True,
+        rechunk_codec="bzip2",
+    )
+    template = Template.from_stack(stack)
+
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Environment": {
+                "Variables": Match.object_like(
+                    {
+                        "RECHUNK_CODEC": "bzip2",
+                        "RECHUNK_MIN_SIZE": str(64 * 1024 * 1024),
+                        "RECHUNK_PART_SIZE": str(64 * 1024 * 1024),
+                    }
+                )
+            },
+        },
+    )
+
+
+def test_coalesce_copy_job():
+    stack = aws_cdk.Stack()
+    CopyS3Data(
+        stack,
+        "s3-copy-job",
+        source_bucket_path="/source-path",
+        source_bucket_name="source-bucket",
+        target_bucket=aws_s3.Bucket(stack, id="test-bucket", bucket_name="target-test"),
+        target_bucket_path="/target-path",
+        coalesce=True,
+        coalesce_target_size=256 * 1024 * 1024,
+    )
+    template = Template.from_stack(stack)
 
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Environment": {
+                "Variables": Match.object_like(
+                    {
+                        "COALESCE_TARGET_SIZE": str(256 * 1024 * 1024),
+                        "COALESCE_MAX_SOURCE_SIZE": str(8 * 1024 * 1024),
+                        "COALESCE_INDEX_URI": Match.any_value(),
+                    }
+                )
+            },
+        },
+    )
+
+
+@pytest.mark.parametrize("codec", ["lz4", "zstd"])
+def test_rechunk_copy_job_needs_a_known_codec(codec: str):
+    stack = aws_cdk.Stack()
+    with pytest.raises(ValueError, match="Unknown rechunk codec"):
+        CopyS3Data(
+            stack,
+            "s3-copy-job",
+            source_bucket_path="/source-path",
+            source_bucket_name="source-bucket",
+            target_bucket=aws_s3.Bucket(stack, id="test-bucket", bucket_name="target-test"),
+            target_bucket_path="/target-path",
+            rechunk=True,
+            rechunk_codec=codec,
+        )
+
+
+def test_coalesce_copy_job_cannot_be_event_driven():
+    stack = aws_cdk.Stack()
+    with pytest.raises(ValueError, match="coalesce cannot be combined with event_driven"):
+        CopyS3Data(
+            stack,
+            "s3-copy-job",
+            source_bucket_path="/source-path",
+            source_bucket_name="source-bucket",
+            target_bucket=aws_s3.Bucket(stack, id="test-bucket", bucket_name="target-test"),
+            target_bucket_path="/target-path",
+            event_driven=True,
+            coalesce=True,
+        )
+
+
+def _lambda_context(remaining_millis: int = 15 * 60 * 1000) -> MagicMock:
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = remaining_millis
+    return context
+
+
+@pytest.fixture(name="lambda_env")
+def lambda_env_fixture(monkeypatch) -> FakeS3Client:
     monkeypatch.setenv("SOURCE_BUCKET_URI", "s3://source/a")
     monkeypatch.setenv("TARGET_BUCKET_URI", "s3://target/b")
+    monkeypatch.setenv("CHECKPOINT_URI", "s3://target/_state/b/checkpoint.json")
+    fake_client = FakeS3Client()
+    monkeypatch.setattr(s3_copy, "create_s3_client", lambda *args: fake_client)
+    return fake_client
 
-    fake_check_call = MagicMock()
-    monkeypatch.setattr(
-        lambdas.copyjob_for_s3_data.copyjob_for_s3_data.subprocess,
-        "check_call",
-        fake_check_call,
-    )
-    ret = lambdas.copyjob_for_s3_data.copyjob_for_s3_data.sync_bucket_uri({}, {})
 
-    fake_check_call.assert_called_with("/opt/awscli/aws s3 sync s3://source/a s3://target/b", shell=True)
+def test_copy_s3_data_lambda(lambda_env: FakeS3Client):
+    lambda_env.add("source", "a/new.json.gz", b"new")
+    lambda_env.add("source", "a/existing.json.gz", b"existing")
+    lambda_env.add("source", "ab/other-prefix.json.gz", b"other")
+    lambda_env.add("target", "b/existing.json.gz", b"existing")
+
+    ret = copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+
+    assert lambda_env.calls_of("copy_object") == [
+        {"Bucket": "target", "Key": "b/new.json.gz", "CopySource": {"Bucket": "source", "Key": "a/new.json.gz"}}
+    ]
     assert ret == {
         "statusCode": 200,
         "headers": {"Content-Type": "text/plain"},
-        "body": "Successfully ran aws s3 sync s3://source/a s3://target/b\n",
+        "body": "Successfully synced s3://source/a s3://target/b: copied 1 objects (3 bytes)\n",
     }
+    # The next run only lists the new objects
+    lambda_env.add("source", "a/newer.json.gz", b"newer")
+    copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+
+    assert lambda_env.calls_of("list_objects_v2")[-1] == {
+        "Bucket": "source",
+        "Prefix": "a/",
+        "StartAfter": "a/new.json.gz",
+    }
+    assert lambda_env.keys("target") == [
+        "_state/b/checkpoint.json",
+        "b/existing.json.gz",
+        "b/new.json.gz",
+        "b/newer.json.gz",
+    ]
+
+
+def test_copy_s3_data_lambda_emits_metrics(lambda_env: FakeS3Client, capsys):
+    lambda_env.add("source", "a/new.json.gz", b"new")
+    lambda_env.add("source", "a/existing.json.gz", b"existing")
+    lambda_env.add("target", "b/existing.json.gz", b"existing")
+
+    copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context(remaining_millis=120 * 1000))
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert len(records) == 1
+    assert records[0]["Mode"] == "sync"
+    assert (records[0]["ObjectsListed"], records[0]["ObjectsCopied"], records[0]["ObjectsSkipped"]) == (2, 1, 1)
+    assert records[0]["BytesCopied"] == 3
+    assert records[0]["TimeRemainingAtExit"] == 120 * 1000
+
+
+def test_copy_s3_data_lambda_stops_before_the_timeout(lambda_env: FakeS3Client):
+    lambda_env.add("source", "a/new.json.gz", b"new")
+
+    ret = copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context(remaining_millis=1000))
+
+    assert "stopped before the timeout" in ret["body"]
+    assert lambda_env.calls_of("copy_object") == []
+
+
+def test_copy_s3_data_lambda_fails_on_failed_copies(lambda_env: FakeS3Client, monkeypatch):
+    lambda_env.add("source", "a/broken.json.gz", b"broken")
+    monkeypatch.setattr(lambda_env, "copy_object", MagicMock(side_effect=ValueError("broken")))
+
+    with pytest.raises(RuntimeError, match="a/broken.json.gz"):
+        copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
 
 
 def test_copy_s3_data_lambda_without_env(monkeypatch):
-    #     sync_command = f"/opt/awscli/aws s3 sync {source_bucket_uri} {target_bucket_uri}"
-    #     subprocess.check_call(sync_command, shell=True)
-
-    fake_check_call = MagicMock()
-    monkeypatch.setattr(
-        lambdas.copyjob_for_s3_data.copyjob_for_s3_data.subprocess,
-        "check_call",
-        fake_check_call,
-    )
+    fake_create_s3_client = MagicMock()
+    monkeypatch.setattr(s3_copy, "create_s3_client", fake_create_s3_client)
     # Not checking for the full name as we do not care which one comes first and raises
-    with pytest.raises(KeyError, match="BUCKET_URI"):
-        lambdas.copyjob_for_s3_data.copyjob_for_s3_data.sync_bucket_uri({}, {})
+    with pytest.raises(KeyError, match="_URI"):
+        copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+
+    fake_create_s3_client.assert_not_called()
+
+
+def _sqs_record(message_id: str, *keys: str, bucket: str = "source") -> dict:
+    return {
+        "messageId": message_id,
+        "body": json.dumps(
+            {
+                "Records": [
+                    {
+                        "eventName": "ObjectCreated:Put",
+                        "eventTime": "2022-10-01T12:00:00.000Z",
+                        "s3": {
+                            "bucket": {"name": bucket},
+                            "object": {"key": key, "size": 1, "eTag": hashlib.md5(b"x").hexdigest()},
+                        },
+                    }
+                    for key in keys
+                ]
+            }
+        ),
+    }
+
+
+def test_copy_notified_objects_lambda(lambda_env: FakeS3Client, monkeypatch):
+    for key in ("a/new 1.json.gz", "a/new-2.json.gz", "a/broken.json.gz", "other/new.json.gz"):
+        lambda_env.add("source", key, b"x")
+    copy_object = lambda_env.copy_object
+
+    def fail_on_broken(**kwargs):
+        if "broken" in kwargs["Key"]:
+            raise ValueError("broken")
+        return copy_object(**kwargs)
+
+    monkeypatch.setattr(lambda_env, "copy_object", fail_on_broken)
+    event = {
+        "Records": [
+            # keys are url encoded
+            _sqs_record("message-1", "a/new+1.json.gz", "a/new-2.json.gz"),
+            _sqs_record("message-2", "a/broken.json.gz"),
+            # not our prefix or bucket
+            _sqs_record("message-3", "other/new.json.gz"),
+            _sqs_record("message-4", "a/new-2.json.gz", bucket="other"),
+            # sent when the notification is set up
+            {"messageId": "message-5", "body": json.dumps({"Service": "Amazon S3", "Event": "s3:TestEvent"})},
+        ]
+    }
 
-    fake_check_call.assert_not_called()
+    ret = copyjob_for_s3_data.copy_notified_objects(event, _lambda_context())
+
+    assert ret == {"batchItemFailures": [{"itemIdentifier": "message-2"}]}
+    assert lambda_env.keys("target") == ["b/new 1.json.gz", "b/new-2.json.gz"]
+    # no listing at all
+    assert lambda_env.calls_of("list_objects_v2") == []
+
+
+def test_copy_notified_objects_lambda_drops_overwritten_objects(lambda_env: FakeS3Client, monkeypatch):
+    error = ClientError({"Error": {"Code": "PreconditionFailed"}}, "CopyObject")
+    monkeypatch.setattr(lambda_env, "copy_object", MagicMock(side_effect=error))
+
+    ret = copyjob_for_s3_data.copy_notified_objects(
+        {"Records": [_sqs_record("message-1", "a/new.json.gz")]}, _lambda_context()
+    )
+
+    assert ret == {"batchItemFailures": []}
+
+
+def test_sync_lambda_skips_objects_copied_by_the_notified_objects_lambda(lambda_env: FakeS3Client):
+    lambda_env.add("source", "a/0.json.gz", b"x")
+    copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+    for key in ("a/1.json.gz", "a/2.json.gz"):
+        lambda_env.add("source", key, b"x")
+    copyjob_for_s3_data.copy_notified_objects(
+        {"Records": [_sqs_record("message-1", "a/1.json.gz", "a/2.json.gz")]}, _lambda_context()
+    )
+    copied_keys = lambda_env.keys("target")
+    lambda_env.calls.clear()
+
+    ret = copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+
+    assert "copied 0 objects" in ret["body"]
+    assert lambda_env.calls_of("copy_object") == []
+    assert [call["Key"] for call in lambda_env.calls_of("put_object")] == ["_state/b/checkpoint.json"]
+    assert lambda_env.keys("target") == copied_keys
+
+
+def test_sync_lambda_only_copies_the_objects_which_the_notifications_missed(lambda_env: FakeS3Client):
+    copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+    for i in range(5):
+        lambda_env.add("source", f"a/{i}.json.gz", b"x")
+    # Keys which are not next to each other, one message is delivered twice
+    records = [_sqs_record("message-1", "a/1.json.gz", "a/3.json.gz"), _sqs_record("message-2", "a/0.json.gz")]
+    for _ in range(2):
+        copyjob_for_s3_data.copy_notified_objects({"Records": records}, _lambda_context())
+    lambda_env.calls.clear()
+
+    copyjob_for_s3_data.sync_bucket_uri({}, _lambda_context())
+
+    assert sorted(call["Key"] for call in lambda_env.calls_of("copy_object")) == ["b/2.json.gz", "b/4.json.gz"]
+    assert lambda_env.keys("target") == ["_state/b/checkpoint.json"] + [f"b/{i}.json.gz" for i in range(5)]
+
+
+def test_backfill_lambdas(lambda_env: FakeS3Client, monkeypatch):
+    monkeypatch.setenv("BACKFILL_REPORT_URI", "s3://target/_state/b/backfills/")
+    monkeypatch.setenv("KEYS_PER_SHARD", "2")
+    for i in range(3):
+        lambda_env.add("source", f"a/{i}.json.gz", b"x")
+
+    planned = copyjob_for_s3_data.plan_backfill_shards({"execution": "exec-1"}, _lambda_context())
+
+    # Only the keys of the shards go through the state machine
+    assert planned == {
+        "shards": ["_state/b/backfills/exec-1/shards/000000.json", "_state/b/backfills/exec-1/shards/000001.json"]
+    }
+    copyjob_for_s3_data.copy_backfill_shard({"shard_key": planned["shards"][0]}, _lambda_context())
+    with pytest.raises(RuntimeError, match="1 of 2 shards are incomplete"):
+        # the second shard crashed
+        copyjob_for_s3_data.summarize_backfill({"execution": "exec-1"}, _lambda_context())
+    copyjob_for_s3_data.copy_backfill_shard({"shard_key": planned["shards"][1]}, _lambda_context())
+
+    ret = copyjob_for_s3_data.summarize_backfill({"execution": "exec-1"}, _lambda_context())
+
+    assert (ret["shards"], ret["copied"], ret["incomplete_shards"]) == (2, 3, [])
+    report = json.loads(lambda_env.body("target", "_state/b/backfills/exec-1.json"))
+    assert report["summary"] == ret
+    assert [shard["last_key"] for shard in report["shards"]] == ["a/1.json.gz", "a/2.json.gz"]
 
 
 def test_copy_s3_data_snapshot(snapshot, template: Template):
@@ -0,0 +1,64 @@
+import collections
+import gzip
+import json
+import os
+
+import pytest
+
+from benchmarks import journeys_data
+
+
+def _read(output: str) -> list:
+    lines = []
+    for directory, _, files in sorted(os.walk(output)):
+        for file in sorted(files):
+            if file.endswith(".json.gz"):
+                with gzip.open(os.path.join(directory, file)) as f:
+                    lines.extend(f.read().decode().splitlines())
+    return lines
+
+
+def test_journeys_are_spread_over_files_and_days(tmp_path):
+    spec = journeys_data.JourneysSpec(rows=1003, files=10, days=5)
+
+    journeys_data.generate(spec, str(tmp_path), processes=2)
+
+    assert sorted(os.listdir(tmp_path / "2022" / "10")) == ["01", "02", "03", "04", "05"]
+    assert len(os.listdir(tmp_path / "2022" / "10" / "01")) == 2
+    journeys = [json.loads(line) for line in _read(str(tmp_path))]
+    assert len(journeys) == 1003
+    assert len({journey["journey_id"] for journey in journeys}) == 1003
+    assert all(
+        journey["start_dt"][:10] in ("2022-10-01", "2022-10-02", "2022-10-03", "2022-10-04", "2022-10-05")
+        for journey in journeys
+    )
+
+
+def test_skew_late_journeys_and_malformed_records():
+    spec = journeys_data.JourneysSpec(
+        rows=2000, files=1, heavy_customer_share=0.5, late_share=0.2, malformed_share=0.1, first_day="2022-10-10"
+    )
+
+    lines = list(journeys_data.journey_lines(spec, 0))
+
+    journeys = []
+    for line in lines:
+        try:
+            journeys.append(json.loads(line))
+        except json.JSONDecodeError:
+            pass
+    assert 150 < len(lines) - len(journeys) < 250
+    customers = collections.Counter(int(journey["customer_id"]) for journey in journeys)
+    assert 0.4 < sum(customers[customer] for customer in range(spec.heavy_customers)) / len(journeys) < 0.6
+    late = [journey for journey in journeys if journey["start_dt"] < "2022-10-10"]
+    assert 0.15 < len(late) / len(journeys) < 0.25
+    assert min(journey["start_dt"] for journey in journeys) >= "2022-10-03"
+
+
+def test_existing_data_is_reused(tmp_path):
+    spec = journeys_data.JourneysSpec(rows=10, files=2)
+    size = journeys_data.generate(spec, str(tmp_path), processes=1)
+
+    assert journeys_data.generate(spec, str(tmp_path), processes=1) == size
+    with pytest.raises(ValueError, match="another spec"):
+        journeys_data.generate(journeys_data.JourneysSpec(rows=20, files=2), str(tmp_path), processes=1)
@@ -0,0 +1,51 @@
+import pytest
+
+# The keys are assigned on Spark, like in the Glue jobs (pyspark is in requirements-dev.txt, and needs java)
+pytest.importorskip("pyspark")
+
+from glue.business_logic import keys  # noqa: E402
+
+
+def test_parse_surrogate_keys():
+    assert keys.parse_surrogate_keys("customer_id:customer, scooter_id:scooter,") == [
+        ("customer_id", "customer"),
+        ("scooter_id", "scooter"),
+    ]
+    with pytest.raises(ValueError, match="Expected <id column>:<key mapping>"):
+        keys.parse_surrogate_keys("customer_id")
+
+
+def test_keys_stay_the_same_across_runs(local_backend):
+    spark_session = local_backend.spark_session
+    key_mapping_uri = local_backend.path("s3://raw/key_mappings")
+
+    def update(*ids: str):
+        df = spark_session.createDataFrame([(id_,) for id_ in ids], "id string")
+        mapping = keys.update_key_mapping(df, spark_session, key_mapping_uri, "converted", "customer")
+        return {row.id: row.key for row in mapping.collect()}
+
+    first = update("a", "b")
+    second = update("b", "c")
+
+    assert sorted(first.values()) == [1, 2]
+    assert second == {"b": first["b"], "c": 3}
+
+
+def test_add_surrogate_keys(local_backend):
+    spark_session = local_backend.spark_session
+    df = spark_session.createDataFrame(
+        [("j1", "a"), ("j2", "b"), ("j3", "a"), ("j4", None)], "journey_id string, customer_id string"
+    )
+
+    with_keys = keys.add_surrogate_keys(
+        df,
+        spark_session=spark_session,
+        surrogate_keys=[("customer_id", "customer")],
+        key_mapping_uri=local_backend.path("s3://raw/key_mappings"),
+        database_name="converted",
+    )
+
+    customer_keys = {row.journey_id: row.customer_key for row in with_keys.collect()}
+    assert customer_keys["j1"] == customer_keys["j3"]
+    assert sorted([customer_keys["j1"], customer_keys["j2"]]) == [1, 2]
+    assert customer_keys["j4"] is None
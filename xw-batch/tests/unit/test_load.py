@@ -0,0 +1,192 @@
+import datetime
+import os
+
+import pytest
+
+# The loads run on Spark, like in the Glue jobs (pyspark is in requirements-dev.txt, and needs java)
+pytest.importorskip("pyspark")
+
+from pyspark.sql import functions as F  # noqa: E402
+
+from glue.business_logic import load  # noqa: E402
+
+
+def _journeys(spark_session, *rows):
+    return spark_session.createDataFrame(
+        [(journey_id, datetime.date.fromisoformat(day), amount) for journey_id, day, amount in rows],
+        "journey_id string, _created_at date, amount_cents int",
+    )
+
+
+def _rows(df):
+    return sorted((row.journey_id, row._created_at.isoformat(), row.amount_cents) for row in df.collect())
+
+
+@pytest.mark.parametrize("register_partitions", [True, False])
+def test_load_overwrite_partitions_merges_the_rows_of_the_partitions(local_backend, register_partitions: bool):
+    spark_session = local_backend.spark_session
+    target_bucket_uri = local_backend.path("s3://raw/converted/journeys")
+    arguments = dict(
+        spark_session=spark_session,
+        target_bucket_uri=target_bucket_uri,
+        database_name="converted",
+        table_name="journeys",
+        compression="snappy",
+        deduplication_keys=["journey_id"],
+        target_file_size=1024,
+        register_partitions=register_partitions,
+    )
+
+    load.load_overwrite_partitions(
+        _journeys(spark_session, ("a", "2022-10-01", 1), ("b", "2022-10-02", 2)), **arguments
+    )
+    # a again (e.g. a retry, with a corrected amount) and a new journey on the same day
+    load.load_overwrite_partitions(
+        _journeys(spark_session, ("a", "2022-10-01", 10), ("c", "2022-10-01", 3), ("c", "2022-10-01", 3)), **arguments
+    )
+
+    if register_partitions:
+        converted = spark_session.table("converted.journeys")
+    else:
+        assert not load.table_exists(spark_session, "converted", "journeys")
+        converted = spark_session.read.parquet(target_bucket_uri)
+    assert _rows(converted) == [("a", "2022-10-01", 10), ("b", "2022-10-02", 2), ("c", "2022-10-01", 3)]
+
+
+def test_load_overwrite_partitions_adds_new_columns(local_backend):
+    spark_session = local_backend.spark_session
+    arguments = dict(
+        spark_session=spark_session,
+        target_bucket_uri=local_backend.path("s3://raw/converted/journeys"),
+        database_name="converted",
+        table_name="journeys",
+        compression="snappy",
+        deduplication_keys=["journey_id"],
+    )
+    load.load_overwrite_partitions(
+        _journeys(spark_session, ("a", "2022-10-01", 1), ("b", "2022-10-02", 2)), **arguments
+    )
+
+    # e.g. after surrogate keys were turned on
+    with_keys = _journeys(spark_session, ("c", "2022-10-01", 3)).withColumn("customer_key", F.lit(7).cast("long"))
+    load.load_overwrite_partitions(with_keys, **arguments)
+
+    converted = spark_session.table("converted.journeys")
+    assert sorted((row.journey_id, row.customer_key) for row in converted.collect()) == [
+        ("a", None),
+        ("b", None),
+        ("c", 7),
+    ]
+
+
+def test_merge_fills_the_missing_columns_with_null(spark_session):
+    new = _journeys(spark_session, ("a", "2022-10-01", 10))
+    existing = _journeys(spark_session, ("a", "2022-10-01", 1), ("b", "2022-10-01", 2)).withColumn(
+        "customer_key", F.lit(7)
+    )
+
+    merged = load.merge(new, existing, ["journey_id"])
+
+    assert sorted((row.journey_id, row.amount_cents, row.customer_key) for row in merged.collect()) == [
+        ("a", 10, None),
+        ("b", 2, 7),
+    ]
+
+
+def test_read_converted_days(local_backend):
+    spark_session = local_backend.spark_session
+    target_bucket_uri = local_backend.path("s3://raw/converted/journeys")
+    load.load_overwrite_partitions(
+        _journeys(spark_session, ("a", "2022-10-01", 1), ("b", "2022-10-02", 2)),
+        spark_session=spark_session,
+        target_bucket_uri=target_bucket_uri,
+        database_name="converted",
+        table_name="journeys",
+        compression="snappy",
+        deduplication_keys=["journey_id"],
+    )
+    arguments = dict(
+        spark_session=spark_session,
+        target_bucket_uri=target_bucket_uri,
+        database_name="converted",
+        table_name="journeys",
+        load_mode=load.LOAD_MODE_OVERWRITE_PARTITIONS,
+    )
+    new_rows = _journeys(spark_session, ("c", "2022-10-01", 3))
+
+    assert _rows(load.read_converted_days(new_rows, **arguments)) == [("a", "2022-10-01", 1)]
+    assert len(_rows(load.read_converted_days(new_rows, all_days=True, **arguments))) == 2
+
+
+def test_load_rollup_replaces_only_its_days(local_backend):
+    spark_session = local_backend.spark_session
+    arguments = dict(
+        spark_session=spark_session,
+        rollup_bucket_uri=local_backend.path("s3://raw/converted/journeys_per_day"),
+        database_name="converted",
+        rollup_table_name="journeys_per_day",
+        compression="snappy",
+    )
+
+    load.load_rollup(_journeys(spark_session, ("a", "2022-10-01", 1), ("b", "2022-10-02", 2)), **arguments)
+    load.load_rollup(_journeys(spark_session, ("c", "2022-10-01", 3)), **arguments)
+
+    assert _rows(spark_session.table("converted.journeys_per_day")) == [("b", "2022-10-02", 2), ("c", "2022-10-01", 3)]
+
+
+def test_partition_paths(spark_session):
+    df = spark_session.createDataFrame(
+        [(datetime.date(2022, 10, 1), 23), (datetime.date(2022, 10, 1), 23), (datetime.date(2022, 10, 2), 0)],
+        "_created_at date, _created_hour int",
+    )
+
+    assert load.partition_paths(df, ["_created_at", "_created_hour"]) == [
+        "_created_at=2022-10-01/_created_hour=23/",
+        "_created_at=2022-10-02/_created_hour=0/",
+    ]
+
+
+def test_size_output_files(spark_session):
+    df = _journeys(spark_session, *[(str(index), "2022-10-01", index) for index in range(10)])
+
+    # 10 rows of 100 bytes are 4 files of at most 300 bytes
+    sized = load.size_output_files(df, target_file_size=300, bytes_per_row=100)
+
+    assert sized.rdd.getNumPartitions() == 4
+    assert _rows(sized) == _rows(df)
+
+
+def test_deduplicate_keeps_the_first_row(spark_session):
+    df = _journeys(spark_session, ("a", "2022-10-01", 2), ("a", "2022-10-01", 1), ("b", "2022-10-01", 3))
+
+    deduplicated = load.deduplicate(df, ["journey_id"], order_by=df.amount_cents)
+
+    assert _rows(deduplicated) == [("a", "2022-10-01", 1), ("b", "2022-10-01", 3)]
+
+
+def test_table_exists(local_backend):
+    spark_session = local_backend.spark_session
+    assert not load.table_exists(spark_session, "converted", "journeys")
+    _journeys(spark_session, ("a", "2022-10-01", 1)).write.saveAsTable("converted.journeys")
+
+    assert load.table_exists(spark_session, "converted", "journeys")
+    # The name of the session catalog, like the ICEBERG_CATALOG of load_iceberg_merge() is the name of another one
+    assert load.table_exists(spark_session, "converted", "journeys", catalog="spark_catalog")
+    assert not load.table_exists(spark_session, "converted", "rides", catalog="spark_catalog")
+
+
+def test_path_exists(spark_session, tmp_path):
+    assert load.path_exists(spark_session, str(tmp_path))
+    assert not load.path_exists(spark_session, os.path.join(str(tmp_path), "missing"))
+
+
+@pytest.mark.parametrize("spark_version", ["3.1.1", "3.1.1-amzn-0"])
+def test_no_bloom_filter_options_before_spark_3_2(spark_version: str):
+    assert load.parquet_bloom_filter_options(["customer_id"], spark_version=spark_version) == {}
+
+
+def test_bloom_filter_options():
+    assert load.parquet_bloom_filter_options(["customer_id", "scooter_id"], spark_version="3.3.0-amzn-1") == {
+        "parquet.bloom.filter.enabled#customer_id": "true",
+        "parquet.bloom.filter.enabled#scooter_id": "true",
+    }
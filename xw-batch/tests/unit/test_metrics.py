@@ -0,0 +1,60 @@
+import datetime
+
+import pytest
+
+from lambdas.copyjob_for_s3_data import metrics, s3_copy
+
+
+def _task(key: str, size: int) -> s3_copy.CopyTask:
+    obj = s3_copy.S3Object(key=key, size=size, etag='"etag"', last_modified=datetime.datetime(2022, 10, 1))
+    return s3_copy.CopyTask(source=obj, target_key=key)
+
+
+@pytest.mark.parametrize(
+    "percent, expected",
+    [(50, 5.0), (90, 9.0), (99, 10.0), (100, 10.0), (0, 1.0)],
+)
+def test_percentile(percent: float, expected: float):
+    assert metrics.percentile([float(i) for i in range(10, 0, -1)], percent) == expected
+
+
+def test_percentile_without_values():
+    assert metrics.percentile([], 50) == 0.0
+
+
+def test_emf_record():
+    result = s3_copy.CopyResult(
+        copied=[_task("a", 10), _task("b", 20)],
+        failed={_task("c", 30): ValueError("broken")},
+        copy_latencies=[0.1, 0.3],
+        listed=4,
+        skipped=1,
+        listing_seconds=0.5,
+        copy_seconds=2.0,
+    )
+
+    record = metrics.emf_record(result, mode="sync", remaining_millis=1000, namespace="Test", copy_job="job")
+
+    metric_directive = record["_aws"]["CloudWatchMetrics"][0]
+    assert metric_directive["Namespace"] == "Test"
+    assert metric_directive["Dimensions"] == [["CopyJob", "Mode"]]
+    # Every declared metric needs a value in the record
+    assert all(metric["Name"] in record for metric in metric_directive["Metrics"])
+    assert {"Name": "BytesCopied", "Unit": "Bytes"} in metric_directive["Metrics"]
+    assert record["CopyJob"] == "job"
+    assert record["Mode"] == "sync"
+    assert (record["ObjectsListed"], record["ObjectsCopied"], record["ObjectsSkipped"]) == (4, 2, 1)
+    assert record["ObjectsFailed"] == 1
+    assert record["BytesCopied"] == 30
+    assert record["ListingTime"] == 500
+    assert record["CopyTime"] == 2000
+    assert record["CopyLatencyP50"] == 100
+    assert record["CopyLatencyMax"] == 300
+    assert record["TimeRemainingAtExit"] == 1000
+
+
+def test_emf_record_without_context():
+    record = metrics.emf_record(s3_copy.CopyResult(), mode="events")
+
+    assert "TimeRemainingAtExit" not in record
+    assert record["CopyLatencyP99"] == 0
@@ -0,0 +1,87 @@
+import datetime
+import types
+
+import pytest
+
+# The checks run on Spark, like in the Glue jobs (pyspark is in requirements-dev.txt, and needs java)
+pytest.importorskip("pyspark")
+
+from pyspark.sql import functions as F  # noqa: E402
+
+from glue.business_logic import quality  # noqa: E402
+
+STARTED = datetime.datetime(2022, 10, 3, 4, 5, 6)
+
+
+def _transform(df, spark_session):
+    return df.select("journey_id", F.col("start_dt").cast("timestamp"), F.col("amount_cents").cast("int"))
+
+
+TABLE_DEFINITION = types.SimpleNamespace(
+    transform=_transform, NOT_NULL_COLUMNS=["journey_id"], DEDUPLICATION_KEYS=["journey_id"]
+)
+
+
+def _args(**args: str):
+    return {
+        "TARGET_DB_NAME": "converted",
+        "TARGET_TABLE_NAME": "journeys",
+        "SOURCE_PARTITION_VAR": "start_dt",
+        "QUALITY_BUCKET_URI": "s3://raw/_quality/",
+        "QUARANTINE_BUCKET_URI": "",
+        **args,
+    }
+
+
+@pytest.fixture(name="source")
+def source_fixture(spark_session):
+    return spark_session.createDataFrame(
+        [
+            ("a", "2022-10-01 10:00:00", "1"),
+            # A duplicate, which is only reported
+            ("a", "2022-10-01 11:00:00", "2"),
+            # Without a key, but not duplicates of each other
+            (None, "2022-10-01 12:00:00", "3"),
+            (None, "2022-10-01 13:00:00", "4"),
+            ("b", "2022-10-02 10:00:00", "one"),
+            ("c", "yesterday", "5"),
+        ],
+        "journey_id string, start_dt string, amount_cents string",
+    )
+
+
+def test_check_quality_summarizes_the_failures(local_backend, source):
+    to_convert, checked = quality.check_quality(source, _args(), local_backend, TABLE_DEFINITION, started=STARTED)
+
+    assert to_convert.count() == 6
+    checked.unpersist()
+    summary = local_backend.spark_session.table(f"converted.{quality.QUALITY_TABLE_NAME}").where("failures > 0")
+    assert sorted(
+        (str(row._created_at), row.column_name, row.check_name, row.failures, row.rows) for row in summary.collect()
+    ) == [
+        ("2022-10-01", "journey_id", quality.QUALITY_CHECK_DUPLICATE_KEYS, 1, 4),
+        ("2022-10-01", "journey_id", quality.QUALITY_CHECK_NOT_NULL, 2, 4),
+        ("2022-10-02", "amount_cents", quality.QUALITY_CHECK_CAST, 1, 1),
+        ("None", "_created_at", quality.QUALITY_CHECK_NOT_NULL, 1, 1),
+        ("None", "start_dt", quality.QUALITY_CHECK_CAST, 1, 1),
+    ]
+
+
+def test_check_quality_quarantines_the_failed_rows(local_backend, source):
+    quarantine_uri = "s3://raw/_quarantine/"
+
+    to_convert, checked = quality.check_quality(
+        source, _args(QUARANTINE_BUCKET_URI=quarantine_uri), local_backend, TABLE_DEFINITION, started=STARTED
+    )
+
+    assert sorted((row.journey_id, row.amount_cents) for row in to_convert.collect()) == [("a", "1"), ("a", "2")]
+    checked.unpersist()
+    quarantined = local_backend.spark_session.read.json(
+        local_backend.path(f"{quarantine_uri}journeys/2022-10-03T040506.000000/")
+    )
+    assert sorted((row.amount_cents, row._failed_checks) for row in quarantined.collect()) == [
+        ("3", "not_null:journey_id"),
+        ("4", "not_null:journey_id"),
+        ("5", "cast:start_dt,not_null:_created_at"),
+        ("one", "cast:amount_cents"),
+    ]
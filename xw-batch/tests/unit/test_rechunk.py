@@ -0,0 +1,102 @@
+import bz2
+import gzip
+import json
+
+import pytest
+
+from lambdas.copyjob_for_s3_data import rechunk, s3_copy
+from tests.unit.fake_s3 import FakeS3Client
+
+
+def _lines(count: int) -> bytes:
+    return b"".join(json.dumps({"journey_id": i}).encode() + b"\n" for i in range(count))
+
+
+def _config(**kwargs) -> rechunk.RechunkConfig:
+    return rechunk.RechunkConfig(manifest_uri="s3://target/_state/b/rechunk", **{"min_size": 10, **kwargs})
+
+
+def _client_with_source(key: str, body: bytes) -> FakeS3Client:
+    client = FakeS3Client()
+    client.add("source", key, body)
+    return client
+
+
+def _sync(client: FakeS3Client, config: rechunk.RechunkConfig) -> s3_copy.CopyResult:
+    copier = rechunk.RechunkingCopier(config, target_bucket_uri="s3://target/b")
+    return s3_copy.sync(client, "s3://source/a", "s3://target/b", max_concurrency=2, copier=copier)
+
+
+@pytest.mark.parametrize(
+    "target_key, codec, expected",
+    [
+        ("b/x.json.gz", "gzip", "b/x.part-00001.json.gz"),
+        ("b/x.json.gz", "bzip2", "b/x.part-00001.json.bz2"),
+        ("b/2022/x.ndjson.gz", "bzip2", "b/2022/x.part-00001.ndjson.bz2"),
+    ],
+)
+def test_part_key(target_key: str, codec: str, expected: str):
+    assert rechunk.part_key(target_key, 1, codec) == expected
+
+
+def test_split_lines_keeps_lines_together():
+    lines = [b"aaaa\n", b"bb\n", b"cccccccccc\n", b"d\n"]
+
+    assert list(rechunk.split_lines(lines, part_size=8)) == [[b"aaaa\n", b"bb\n"], [b"cccccccccc\n"], [b"d\n"]]
+
+
+@pytest.mark.parametrize("codec", ["lz4", "zstd"])
+def test_unknown_codec(codec: str):
+    with pytest.raises(ValueError, match="Unknown codec"):
+        _config(codec=codec)
+
+
+def test_big_gzip_objects_are_split():
+    data = _lines(100)
+    client = _client_with_source("a/x.json.gz", gzip.compress(data))
+
+    result = _sync(client, _config(codec="bzip2", part_size=len(data) // 3))
+
+    assert len(result.copied) == 1
+    part_keys = [key for key in client.keys("target") if key.startswith("b/")]
+    assert part_keys == [f"b/x.part-{i:05}.json.bz2" for i in range(4)]
+    parts = [bz2.decompress(client.body("target", key)) for key in part_keys]
+    assert all(part.endswith(b"\n") for part in parts)
+    assert b"".join(parts) == data
+    manifest = json.loads(client.body("target", "_state/b/rechunk/x.json.gz.json"))
+    assert manifest["source"]["key"] == "a/x.json.gz"
+    assert manifest["target_key"] == "b/x.json.gz"
+    assert [part["key"] for part in manifest["parts"]] == part_keys
+    assert sum(part["lines"] for part in manifest["parts"]) == 100
+
+
+def test_small_and_other_objects_are_copied():
+    client = _client_with_source("a/small.json.gz", gzip.compress(b"{}\n"))
+    client.add("source", "a/big.json", _lines(100))
+
+    _sync(client, _config(min_size=50))
+
+    assert client.keys("target") == ["b/big.json", "b/small.json.gz"]
+
+
+def test_split_objects_are_not_copied_again():
+    client = _client_with_source("a/x.json.gz", gzip.compress(_lines(100)))
+    _sync(client, _config())
+
+    result = _sync(client, _config())
+
+    assert result.copied == []
+    assert (result.listed, result.skipped) == (1, 1)
+
+
+def test_stale_parts_are_deleted():
+    data = _lines(100)
+    client = _client_with_source("a/x.json.gz", gzip.compress(data))
+    _sync(client, _config(part_size=len(data) // 3))
+    # A new version of the object, with less parts
+    client.add("source", "a/x.json.gz", gzip.compress(data), day=2)
+
+    _sync(client, _config(part_size=len(data)))
+
+    assert [key for key in client.keys("target") if key.startswith("b/")] == ["b/x.part-00000.json.gz"]
+    assert gzip.decompress(client.body("target", "b/x.part-00000.json.gz")) == data
@@ -0,0 +1,34 @@
+import pytest
+
+# The metrics are read from Spark, like in the Glue jobs (pyspark is in requirements-dev.txt, and needs java)
+pytest.importorskip("pyspark")
+
+from glue.business_logic import metrics  # noqa: E402
+
+
+def test_phases_get_the_stages_of_their_actions(spark_session):
+    run_metrics = metrics.RunMetrics(spark_session, "journeys")
+    df = spark_session.range(100)
+    # Runs a stage before the phases, which they must not get
+    df.count()
+
+    with run_metrics.phase("plan"):
+        grouped = df.groupBy((df.id % 10).alias("group")).count()
+    with run_metrics.phase("collect"):
+        assert len(grouped.collect()) == 10
+
+    assert run_metrics.phases["plan"]["stages"] == []
+    stages = run_metrics.phases["collect"]["stages"]
+    assert stages
+    assert run_metrics.phases["collect"]["shuffle_write_bytes"] == sum(stage["shuffle_write_bytes"] for stage in stages)
+
+
+def test_a_phase_which_runs_again_is_added_up(spark_session):
+    run_metrics = metrics.RunMetrics(spark_session, "journeys")
+
+    for _ in range(2):
+        with run_metrics.phase("count"):
+            spark_session.range(10).count()
+
+    assert len(run_metrics.phases["count"]["stages"]) >= 2
+    assert [data["MetricName"] for data in run_metrics.metric_data()][:2] == ["output_files", "seconds"]
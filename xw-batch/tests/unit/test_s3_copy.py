@@ -0,0 +1,149 @@
+import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from lambdas.copyjob_for_s3_data import s3_copy
+from tests.unit.fake_s3 import FakeS3Client
+
+
+def _obj(key: str, size: int = 10, day: int = 1) -> s3_copy.S3Object:
+    return s3_copy.S3Object(key=key, size=size, etag=f'"{key}"', last_modified=datetime.datetime(2022, 10, day))
+
+
+@pytest.mark.parametrize(
+    "uri, expected",
+    [
+        ("s3://bucket/data/journeys", ("bucket", "data/journeys/")),
+        ("s3://bucket/raw/scoofy/journeys/", ("bucket", "raw/scoofy/journeys/")),
+        ("s3://bucket//raw/", ("bucket", "raw/")),
+        ("s3://bucket", ("bucket", "")),
+    ],
+)
+def test_parse_s3_uri(uri: str, expected: tuple):
+    assert s3_copy.parse_s3_uri(uri) == expected
+
+
+def test_parse_s3_uri_needs_s3_scheme():
+    with pytest.raises(ValueError, match="Not a s3 uri"):
+        s3_copy.parse_s3_uri("/bucket/path")
+
+
+def test_plan_sync_uses_aws_s3_sync_rules():
+    source = [
+        _obj("a/missing"),
+        _obj("a/same"),
+        _obj("a/other-size", size=20),
+        _obj("a/newer", day=2),
+        _obj("a/older", day=1),
+    ]
+    target = [
+        _obj("b/same"),
+        _obj("b/other-size"),
+        _obj("b/newer"),
+        _obj("b/older", day=2),
+    ]
+    tasks = s3_copy.plan_sync(source, target, source_prefix="a/", target_prefix="b/")
+    assert [(task.source.key, task.target_key) for task in tasks] == [
+        ("a/missing", "b/missing"),
+        ("a/other-size", "b/other-size"),
+        ("a/newer", "b/newer"),
+    ]
+
+
+def test_copy_object_uses_multipart_for_big_objects(monkeypatch):
+    monkeypatch.setattr(s3_copy, "MULTIPART_THRESHOLD", 10)
+    monkeypatch.setattr(s3_copy, "MULTIPART_CHUNKSIZE", 4)
+    client = MagicMock()
+    client.head_object.return_value = {}
+    client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    client.upload_part_copy.side_effect = lambda PartNumber, **kwargs: {"CopyPartResult": {"ETag": str(PartNumber)}}
+
+    s3_copy.copy_object(
+        client, source_bucket="source", source=_obj("a/big", size=11), target_bucket="t", target_key="b"
+    )
+
+    ranges = sorted(call.kwargs["CopySourceRange"] for call in client.upload_part_copy.call_args_list)
+    assert ranges == ["bytes=0-3", "bytes=4-7", "bytes=8-10"]
+    client.complete_multipart_upload.assert_called_once_with(
+        Bucket="t",
+        Key="b",
+        UploadId="upload",
+        MultipartUpload={
+            "Parts": [{"ETag": "1", "PartNumber": 1}, {"ETag": "2", "PartNumber": 2}, {"ETag": "3", "PartNumber": 3}]
+        },
+    )
+    client.copy_object.assert_not_called()
+
+
+def test_copy_object_keeps_the_headers_of_big_objects(monkeypatch):
+    monkeypatch.setattr(s3_copy, "MULTIPART_THRESHOLD", 10)
+    monkeypatch.setattr(s3_copy, "MULTIPART_CHUNKSIZE", 4)
+    client = FakeS3Client()
+    client.add(
+        "source",
+        "a/big",
+        b"0123456789ab",
+        ContentType="application/json",
+        ContentEncoding="gzip",
+        Metadata={"origin": "scoofy"},
+    )
+    source = next(s3_copy.list_objects(client, "source", "a/"))
+
+    s3_copy.copy_object(client, source_bucket="source", source=source, target_bucket="t", target_key="b/big")
+
+    assert client.body("t", "b/big") == b"0123456789ab"
+    assert client.headers("t", "b/big") == {
+        "ContentType": "application/json",
+        "ContentEncoding": "gzip",
+        "Metadata": {"origin": "scoofy"},
+    }
+    assert not client.calls_of("copy_object")
+
+
+def test_copy_object_aborts_failed_multipart_copies(monkeypatch):
+    monkeypatch.setattr(s3_copy, "MULTIPART_THRESHOLD", 10)
+    client = MagicMock()
+    client.head_object.return_value = {}
+    client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    client.upload_part_copy.side_effect = ValueError("broken")
+
+    with pytest.raises(ValueError, match="broken"):
+        s3_copy.copy_object(client, source_bucket="s", source=_obj("a/big", size=11), target_bucket="t", target_key="b")
+
+    client.abort_multipart_upload.assert_called_once_with(Bucket="t", Key="b", UploadId="upload")
+    client.complete_multipart_upload.assert_not_called()
+
+
+def test_copy_objects_collects_failures():
+    client = MagicMock()
+    client.copy_object.side_effect = lambda Key, **kwargs: (
+        (_ for _ in ()).throw(ValueError(Key)) if "bad" in Key else {}
+    )
+    tasks = [s3_copy.CopyTask(_obj(f"a/{name}"), f"b/{name}") for name in ("good-1", "bad", "good-2")]
+
+    result = s3_copy.copy_objects(client, tasks, source_bucket="s", target_bucket="t", max_concurrency=2)
+
+    assert sorted(task.target_key for task in result.copied) == ["b/good-1", "b/good-2"]
+    assert [task.source.key for task in result.failed] == ["a/bad"]
+    assert result.copied_bytes == 20
+    assert not result.stopped_early
+
+
+def test_copy_objects_stops_taking_new_tasks():
+    client = MagicMock()
+    tasks = [s3_copy.CopyTask(_obj(f"a/{i}"), f"b/{i}") for i in range(5)]
+    taken = []
+
+    def tracked_tasks():
+        for task in tasks:
+            taken.append(task)
+            yield task
+
+    result = s3_copy.copy_objects(
+        client, tracked_tasks(), source_bucket="s", target_bucket="t", should_stop=lambda: len(taken) >= 2
+    )
+
+    assert result.stopped_early
+    # Nothing was taken from the iterable which was not also copied
+    assert set(result.copied) == set(taken) == set(tasks[:2])
@@ -0,0 +1,162 @@
+import dataclasses
+import datetime
+import json
+import typing
+
+import pytest
+
+from glue.business_logic import tables
+from lambdas.start_conversion_run import sizing
+from tests.unit.fake_s3 import FakeS3Client
+
+# Like the stack passes the sizings of the table registry
+POLICY = sizing.parse_sizing_policy(
+    json.dumps(
+        [
+            dataclasses.asdict(tables.WorkerSizing(max_input_mb=1, worker_type="G.1X", workers=2)),
+            dataclasses.asdict(tables.WorkerSizing(max_input_mb=None, worker_type="G.2X", workers=10)),
+        ]
+    )
+)
+
+
+class _ConcurrentRunsExceededException(Exception):
+    pass
+
+
+class FakeGlueClient:
+    class exceptions:
+        ConcurrentRunsExceededException = _ConcurrentRunsExceededException
+
+    def __init__(self):
+        self.runs: typing.Dict[str, dict] = {}
+
+    def _add_run(self, run_id: str, **run) -> None:
+        if any(other["JobRunState"] in sizing.RUNNING_STATES for other in self.runs.values()):
+            # The job allows one run at a time
+            raise _ConcurrentRunsExceededException(run_id)
+        self.runs[run_id] = {"Id": run_id, "JobRunState": "RUNNING", **run}
+
+    def start_job_run(self, JobName: str, WorkerType: str, NumberOfWorkers: int) -> dict:
+        run_id = f"jr_{len(self.runs)}"
+        self._add_run(run_id, WorkerType=WorkerType, NumberOfWorkers=NumberOfWorkers)
+        return {"JobRunId": run_id}
+
+    def retry(self, run_id: str) -> str:
+        """Fails the run, which Glue retries as a new run"""
+        self.runs[run_id]["JobRunState"] = "FAILED"
+        retry_id = f"{run_id}_attempt_1"
+        self._add_run(retry_id, PreviousRunId=run_id)
+        return retry_id
+
+    def get_paginator(self, operation: str) -> "FakeGlueClient":
+        assert operation == "get_job_runs"
+        return self
+
+    def paginate(self, JobName: str) -> typing.Iterator[dict]:
+        # The newest runs first, in pages of 2
+        runs = list(reversed(self.runs.values()))
+        for start in range(0, len(runs), 2):
+            yield {"JobRuns": runs[start : start + 2]}  # noqa: E203
+
+
+def _start(s3: FakeS3Client, glue: FakeGlueClient) -> dict:
+    return sizing.start_sized_run(
+        s3,
+        glue,
+        job_name="convert",
+        source_bucket_uri="s3://raw/raw/journeys/",
+        policy=POLICY,
+        state_uri="s3://raw/_conversion_sizing/journeys/state.json",
+        report_uri="s3://raw/_reports/sizing/journeys/",
+    )
+
+
+def test_choose_sizing():
+    assert sizing.choose_sizing(POLICY, 1024 * 1024)["workers"] == 2
+    assert sizing.choose_sizing(POLICY, 1024 * 1024 + 1)["workers"] == 10
+    with pytest.raises(ValueError, match="No sizing fits"):
+        sizing.choose_sizing(POLICY[:1], 10 * 1024 * 1024)
+
+
+def test_parse_sizing_policy():
+    data = json.dumps([{"max_input_mb": None, "worker_type": "G.1X", "workers": 2}])
+    assert sizing.parse_sizing_policy(data) == [{"max_input_mb": None, "worker_type": "G.1X", "workers": 2}]
+    with pytest.raises(ValueError, match="Expected a sizing with"):
+        sizing.parse_sizing_policy(json.dumps([{"max_input_mb": None, "workers": 2}]))
+
+
+def test_the_policy_has_the_fields_of_the_registry_sizings():
+    assert sizing.SIZING_FIELDS == tuple(field.name for field in dataclasses.fields(tables.WorkerSizing))
+
+
+def test_runs_are_sized_for_the_input_since_the_last_successful_run():
+    s3 = FakeS3Client()
+    glue = FakeGlueClient()
+    s3.add("raw", "raw/journeys/1.json.gz", b"x" * 100, day=1)
+    s3.add("raw", "raw/journeys/2.json.gz", b"x" * 200, day=2)
+
+    report = _start(s3, glue)
+
+    assert report["input_objects"] == 2
+    assert report["input_bytes"] == 300
+    assert glue.runs["jr_0"]["NumberOfWorkers"] == 2
+    assert json.loads(s3.body("raw", "_reports/sizing/journeys/jr_0.json")) == report
+
+    # Only the new objects are measured after a successful run
+    glue.runs["jr_0"]["JobRunState"] = "SUCCEEDED"
+    s3.add("raw", "raw/journeys/3.json.gz", b"x" * 2 * 1024 * 1024, day=3)
+    report = _start(s3, glue)
+
+    assert report["input_objects"] == 1
+    assert report["input_since"] == datetime.datetime(2022, 10, 2).isoformat()
+    assert glue.runs["jr_1"]["WorkerType"] == "G.2X"
+    # Listed after the last key of the successful run
+    assert s3.calls_of("list_objects_v2")[-1]["StartAfter"] == "raw/journeys/2.json.gz"
+
+    # The input of a failed run is measured again
+    glue.runs["jr_1"]["JobRunState"] = "FAILED"
+    assert _start(s3, glue)["input_objects"] == 1
+
+
+def test_no_run_is_started_while_the_last_one_runs_or_without_input():
+    s3 = FakeS3Client()
+    glue = FakeGlueClient()
+
+    assert _start(s3, glue)["started"] is False
+
+    s3.add("raw", "raw/journeys/1.json.gz", b"x", day=1)
+    assert _start(s3, glue)["started"] is True
+    assert "still RUNNING" in _start(s3, glue)["reason"]
+
+    glue.runs["jr_0"]["JobRunState"] = "SUCCEEDED"
+    assert _start(s3, glue)["started"] is False
+    assert list(glue.runs) == ["jr_0"]
+
+
+def test_no_run_is_started_while_a_retry_runs():
+    s3 = FakeS3Client()
+    glue = FakeGlueClient()
+    s3.add("raw", "raw/journeys/1.json.gz", b"x", day=1)
+    assert _start(s3, glue)["started"] is True
+
+    retry_id = glue.retry("jr_0")
+    assert f"run {retry_id} is still RUNNING" in _start(s3, glue)["reason"]
+
+    # The retry succeeded, so only the new objects are pending
+    glue.runs[retry_id]["JobRunState"] = "SUCCEEDED"
+    s3.add("raw", "raw/journeys/2.json.gz", b"x" * 2, day=2)
+    report = _start(s3, glue)
+    assert report["input_objects"] == 1
+    assert report["input_bytes"] == 2
+
+
+def test_no_run_is_started_while_another_run_of_the_job_runs():
+    s3 = FakeS3Client()
+    glue = FakeGlueClient()
+    s3.add("raw", "raw/journeys/1.json.gz", b"x", day=1)
+    # e.g. started manually
+    glue.start_job_run(JobName="convert", WorkerType="G.1X", NumberOfWorkers=2)
+
+    assert _start(s3, glue) == {"started": False, "reason": "convert already runs"}
+    assert s3.keys("raw") == ["raw/journeys/1.json.gz"]
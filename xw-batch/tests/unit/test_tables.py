@@ -0,0 +1,95 @@
+import os
+
+import pytest
+import yaml  # type: ignore
+
+from glue.business_logic import tables
+
+DBT_SOURCES = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "dbt", "xw_batch", "models", "prep", "schema.yml"
+)
+
+
+def test_every_table_has_a_unique_name_and_source():
+    assert len({table.name for table in tables.TABLES}) == len(tables.TABLES)
+    assert len({table.source_path for table in tables.TABLES}) == len(tables.TABLES)
+
+
+def test_get_table():
+    assert tables.get_table("journeys").source_path == "/raw/scoofy/journeys/"
+    with pytest.raises(ValueError, match="Unknown table"):
+        tables.get_table("rides")
+
+
+def test_unknown_failure_policy():
+    with pytest.raises(ValueError, match="Unknown failure policy"):
+        tables.ConvertedTable("rides", source_path="/raw/rides/", failure_policy="retry")
+
+
+def test_sizing_must_fit_any_input():
+    with pytest.raises(ValueError, match="last sizing"):
+        tables.ConvertedTable(
+            "rides",
+            source_path="/raw/rides/",
+            sizing=(tables.WorkerSizing(max_input_mb=1024, worker_type="G.1X", workers=2),),
+        )
+
+
+def test_unknown_partition_scheme():
+    with pytest.raises(ValueError, match="Unknown partition scheme"):
+        tables.ConvertedTable("rides", source_path="/raw/rides/", partition_scheme="minute")
+
+
+def test_dbt_sources_match_the_partition_schemes():
+    with open(DBT_SOURCES) as f:
+        sources = yaml.safe_load(f)["sources"]
+    converted = next(source for source in sources if source["name"] == "data_lake_converted")
+    for source_table in converted["tables"]:
+        if source_table["name"] not in {table.name for table in tables.TABLES}:
+            continue
+        table = tables.get_table(source_table["name"])
+        assert source_table["loaded_at_field"] == table.loaded_at_expression
+        assert source_table["freshness"]["filter"] == table.recent_partitions_filter
+        documented = {column["name"] for column in source_table["columns"]}
+        assert {name for name, _ in table.partition_columns + table.data_columns} <= documented
+
+
+def test_dbt_sources_have_the_rollups():
+    with open(DBT_SOURCES) as f:
+        sources = yaml.safe_load(f)["sources"]
+    converted = next(source for source in sources if source["name"] == "data_lake_converted")
+    source_tables = {source_table["name"]: source_table for source_table in converted["tables"]}
+    for table in tables.TABLES:
+        if not table.rollup_name:
+            continue
+        documented = {column["name"] for column in source_tables[table.rollup_name]["columns"]}
+        assert {name for name, _ in table.rollup_columns} | {"_created_at"} <= documented
+
+
+def test_rollups_have_their_own_names():
+    names = [table.name for table in tables.TABLES] + [
+        table.rollup_name for table in tables.TABLES if table.rollup_name
+    ]
+    assert len(set(names)) == len(names)
+
+
+def test_surrogate_keys_need_their_own_key_mapping():
+    with pytest.raises(ValueError, match="own key mapping"):
+        tables.ConvertedTable(
+            "rides",
+            source_path="/raw/rides/",
+            surrogate_keys=(("from_customer_id", "customer"), ("to_customer_id", "customer")),
+        )
+
+
+def test_surrogate_keys_argument():
+    table = tables.get_table("journeys")
+    assert table.surrogate_keys_argument == "customer_id:customer,scooter_id:scooter"
+    assert table.surrogate_key_columns == (("customer_key", "bigint"), ("scooter_key", "bigint"))
+
+
+def test_key_mapping_tables():
+    journeys = tables.get_table("journeys")
+    rides = tables.ConvertedTable("rides", source_path="/raw/rides/", surrogate_keys=(("customer_id", "customer"),))
+
+    assert tables.key_mapping_tables([journeys, rides]) == {"customer": ["journeys", "rides"], "scooter": ["journeys"]}
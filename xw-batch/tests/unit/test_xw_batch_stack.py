@@ -1,3 +1,4 @@
+import dataclasses
 import json
 import typing
 
@@ -6,6 +7,7 @@ import pytest
 from aws_cdk.assertions import Capture, Match, Template
 from glom import glom  # type: ignore
 
+from glue.business_logic import tables
 from xw_batch.users_and_groups import (
     GROUP_DATA_LAKE_ATHENA_USER,
     GROUP_DATA_LAKE_DEBUGGING,
@@ -161,17 +163,35 @@ def test_glue_database_converted(template: Template):
     )
 
 
-def test_glue_raw_crawler_scoofy_example_data(template: Template):
-    # This checks the default removal policy if not explicitly set
-    targets = Capture()
+def test_glue_raw_table_scoofy_example_data(template: Template, stack: XwBatchStack):
+    template.resource_count_is("AWS::Glue::Crawler", 0)
     template.has_resource_properties(
-        "AWS::Glue::Crawler",
+        "AWS::Glue::Database",
+        {"DatabaseInput": {"Name": "data_lake_raw"}},
+    )
+    location = Capture()
+    template.has_resource_properties(
+        "AWS::Glue::Table",
         {
-            "Targets": targets,
-            "DatabaseName": "data_lake_raw",
+            "DatabaseName": stack.resolve(stack.raw_database.database_name),
+            "TableInput": Match.object_like(
+                {
+                    "Name": "journeys",
+                    "Parameters": {"classification": "json", "compressionType": "gzip"},
+                    "StorageDescriptor": Match.object_like(
+                        {
+                            "Columns": Match.array_with([{"Name": "amount_cents", "Type": "string"}]),
+                            "Location": location,
+                            "SerdeInfo": Match.object_like(
+                                {"SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe"}
+                            ),
+                        }
+                    ),
+                }
+            ),
         },
     )
-    assert "/raw/scoofy/journeys/" in json.dumps(targets.as_object())
+    assert "/raw/scoofy/journeys/" in json.dumps(location.as_object())
 
 
 def test_glue_convert_job_for_scoofy_example_data(
@@ -225,6 +245,19 @@ def test_glue_convert_job_for_scoofy_example_data(
                 "--TARGET_TABLE_NAME": "journeys",
                 "--TARGET_COMPRESSION_TYPE": "snappy",
                 "--TARGET_FORMAT": "glueparquet",
+                "--LOAD_MODE": "overwrite_partitions",
+                "--MALFORMED_RECORDS_POLICY": "fail",
+                "--TARGET_FILE_SIZE_MB": "128",
+                "--PARTITION_SCHEME": "date",
+                "--REGISTER_PARTITIONS": "true",
+                "--enable-glue-datacatalog": "true",
+                "--METRICS_NAMESPACE": "XwBatch/ConvertToParquet",
+                "--RUN_REPORT_URI": {
+                    "Fn::Join": ["", ["s3://", resolved_raw_bucket_name, "/_reports/convert_to_parquet/"]]
+                },
+                "--QUALITY_BUCKET_URI": {
+                    "Fn::Join": ["", ["s3://", resolved_raw_bucket_name, "/converted/data_quality"]]
+                },
             },
             "Description": Match.string_like_regexp("_created_at"),
             "GlueVersion": "3.0",
@@ -237,6 +270,322 @@ def test_glue_convert_job_for_scoofy_example_data(
     assert ".zip" in json.dumps(extra_py_files.as_object())
 
 
+def test_glue_convert_job_for_all_tables():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", convert_tables_in_one_job=True)
+    template = Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Glue::Job", 1)
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "DefaultArguments": Match.object_like(
+                {
+                    "--TABLE_NAMES": "journeys",
+                    "--RAW_BUCKET_URI": {"Fn::Join": ["", ["s3://", stack.resolve(stack.s3_raw_bucket.bucket_name)]]},
+                    "--MAX_CONCURRENT_TABLES": "4",
+                    "--TARGET_DB_NAME": "data_lake_converted",
+                    "--LOAD_MODE": "overwrite_partitions",
+                    "--SOURCE_BUCKET_URI": Match.absent(),
+                }
+            ),
+        },
+    )
+
+
+def test_glue_stream_convert_job():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", stream_conversion_schedule="cron(0/5 * * * ? *)")
+    template = Template.from_stack(stack)
+    resolved_raw_bucket_name = stack.resolve(stack.s3_raw_bucket.bucket_name)
+
+    template.resource_count_is("AWS::Glue::Job", 1)
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "DefaultArguments": Match.object_like(
+                {
+                    "--job-bookmark-option": "job-bookmark-disable",
+                    "--STREAMING_TRIGGER": "once",
+                    "--CHECKPOINT_URI": {
+                        "Fn::Join": [
+                            "",
+                            ["s3://", resolved_raw_bucket_name, "/_checkpoints/convert_to_parquet/journeys/"],
+                        ]
+                    },
+                    "--TARGET_TABLE_NAME": "journeys",
+                }
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Glue::Trigger",
+        {
+            "Type": "SCHEDULED",
+            "Schedule": "cron(0/5 * * * ? *)",
+            "StartOnCreation": True,
+            "Actions": [{"JobName": Match.any_value()}],
+        },
+    )
+
+
+def test_glue_stream_conversion_needs_one_job_per_table():
+    with pytest.raises(ValueError, match="cannot be converted as streams"):
+        XwBatchStack(
+            aws_cdk.App(), "xw-batch", convert_tables_in_one_job=True, stream_conversion_schedule="rate(5 minutes)"
+        )
+
+
+def test_sized_conversion_runs():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", conversion_schedule="cron(15 * * * ? *)")
+    template = Template.from_stack(stack)
+
+    environment = Capture()
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "start_conversion_run.start_conversion_run.start_conversion_run",
+            "Environment": {"Variables": environment},
+        },
+    )
+    assert json.loads(environment.as_object()["SIZING_POLICY"])[0] == {
+        "max_input_mb": 1024,
+        "worker_type": "G.1X",
+        "workers": 2,
+    }
+    template.has_resource_properties("AWS::Events::Rule", {"ScheduleExpression": "cron(15 * * * ? *)"})
+
+
+def test_converted_tables_with_partition_projection():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", partition_projection=True)
+    template = Template.from_stack(stack)
+
+    template.has_resource_properties(
+        "AWS::Glue::Table",
+        {
+            "TableInput": Match.object_like(
+                {
+                    "Name": "journeys",
+                    "PartitionKeys": [{"Name": "_created_at", "Type": "date"}],
+                    "Parameters": Match.object_like(
+                        {
+                            "projection.enabled": "true",
+                            "projection._created_at.type": "date",
+                            "projection._created_at.range": "2022-01-01,NOW",
+                        }
+                    ),
+                    "StorageDescriptor": Match.object_like(
+                        {"Columns": Match.array_with([{"Name": "amount_cents", "Type": "int"}])}
+                    ),
+                }
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {"DefaultArguments": Match.object_like({"--REGISTER_PARTITIONS": "false"})},
+    )
+
+
+def test_converted_table_partitioned_by_date_and_hour():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch")
+    table = tables.ConvertedTable(
+        "rides",
+        source_path="/raw/rides/",
+        columns=(("ride_id", "string"),),
+        partition_scheme=tables.PARTITION_SCHEME_DATE_HOUR,
+    )
+    table_input = stack.resolve(
+        stack.define_converted_table(
+            table, database=stack.raw_converted_database, location="s3://bucket/rides"
+        ).table_input
+    )
+
+    assert table_input["partitionKeys"] == [
+        {"name": "_created_at", "type": "date"},
+        {"name": "_created_hour", "type": "int"},
+    ]
+    assert table_input["parameters"]["projection._created_hour.type"] == "integer"
+    assert table_input["parameters"]["projection._created_hour.range"] == "0,23"
+    assert (
+        table_input["parameters"]["storage.location.template"]
+        == "s3://bucket/rides/_created_at=${_created_at}/_created_hour=${_created_hour}"
+    )
+
+
+def test_converted_table_partitioned_by_year_month_day_keeps_the_date_as_column():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch")
+    table = tables.ConvertedTable(
+        "rides",
+        source_path="/raw/rides/",
+        columns=(("ride_id", "string"),),
+        partition_scheme=tables.PARTITION_SCHEME_YEAR_MONTH_DAY,
+    )
+    table_input = stack.resolve(
+        stack.define_converted_table(
+            table, database=stack.raw_converted_database, location="s3://bucket/rides"
+        ).table_input
+    )
+
+    assert [key["name"] for key in table_input["partitionKeys"]] == ["_created_year", "_created_month", "_created_day"]
+    assert table_input["parameters"]["projection._created_year.range"] == "2022,2121"
+    assert table_input["storageDescriptor"]["columns"] == [
+        {"name": "ride_id", "type": "string"},
+        {"name": "_created_at", "type": "date"},
+    ]
+
+
+def test_rollup_table():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", partition_projection=True)
+    template = Template.from_stack(stack)
+
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "DefaultArguments": Match.object_like(
+                {"--TARGET_TABLE_NAME": "journeys", "--ROLLUP_TABLE_NAME": "journeys_per_customer_daily"}
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Glue::Table",
+        {
+            "TableInput": Match.object_like(
+                {
+                    "Name": "journeys_per_customer_daily",
+                    "PartitionKeys": [{"Name": "_created_at", "Type": "date"}],
+                    "StorageDescriptor": Match.object_like(
+                        {"Columns": Match.array_with([{"Name": "journeys", "Type": "bigint"}])}
+                    ),
+                }
+            ),
+        },
+    )
+
+
+def test_surrogate_keys():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", surrogate_keys=True, partition_projection=True)
+    template = Template.from_stack(stack)
+
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "DefaultArguments": Match.object_like(
+                {
+                    "--TARGET_TABLE_NAME": "journeys",
+                    "--SURROGATE_KEYS": "customer_id:customer,scooter_id:scooter",
+                    "--KEY_MAPPING_URI": Match.any_value(),
+                }
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Glue::Table",
+        {
+            "TableInput": Match.object_like(
+                {
+                    "Name": "journeys",
+                    "StorageDescriptor": Match.object_like(
+                        {"Columns": Match.array_with([{"Name": "customer_key", "Type": "bigint"}])}
+                    ),
+                }
+            ),
+        },
+    )
+
+
+def test_surrogate_keys_have_a_single_writer(monkeypatch):
+    journeys = tables.get_table("journeys")
+    monkeypatch.setattr(
+        tables, "TABLES", [journeys, dataclasses.replace(journeys, name="rentals", source_path="/raw/scoofy/rentals/")]
+    )
+
+    with pytest.raises(ValueError, match="customer key mapping of journeys, rentals can only be written by one job"):
+        XwBatchStack(aws_cdk.App(), "xw-batch", surrogate_keys=True)
+    # One job converts them one after another
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", surrogate_keys=True, convert_tables_in_one_job=True)
+    Template.from_stack(stack).has_resource_properties(
+        "AWS::Glue::Job", {"ExecutionProperty": {"MaxConcurrentRuns": 1}}
+    )
+
+
+def test_no_surrogate_keys_by_default(template: Template):
+    jobs = template.find_resources("AWS::Glue::Job")
+    assert jobs
+    for job in jobs.values():
+        assert "--KEY_MAPPING_URI" not in job["Properties"]["DefaultArguments"]
+        assert "--SURROGATE_KEYS" not in job["Properties"]["DefaultArguments"]
+
+
+def test_no_quarantine_by_default(template: Template):
+    jobs = template.find_resources("AWS::Glue::Job")
+    assert jobs
+    for job in jobs.values():
+        assert "--QUARANTINE_BUCKET_URI" not in job["Properties"]["DefaultArguments"]
+
+
+def test_quarantine():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", quarantine=True)
+
+    Template.from_stack(stack).has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "DefaultArguments": Match.object_like(
+                {
+                    "--QUALITY_BUCKET_URI": Match.any_value(),
+                    "--QUARANTINE_BUCKET_URI": {
+                        "Fn::Join": [
+                            "",
+                            [
+                                "s3://",
+                                stack.resolve(stack.s3_raw_bucket.bucket_name),
+                                "/_quarantine/convert_to_parquet/",
+                            ],
+                        ]
+                    },
+                }
+            )
+        },
+    )
+
+
+def test_iceberg_tables():
+    stack = XwBatchStack(aws_cdk.App(), "xw-batch", iceberg_tables=True)
+    template = Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Glue::Job", 2)
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "Command": Match.object_like({"Name": "glueetl"}),
+            "GlueVersion": "4.0",
+            "DefaultArguments": Match.object_like(
+                {
+                    "--LOAD_MODE": "iceberg_merge",
+                    "--datalake-formats": "iceberg",
+                    "--TARGET_TABLE_NAME": "journeys",
+                }
+            ),
+        },
+    )
+    template.has_resource_properties(
+        "AWS::Glue::Job",
+        {
+            "GlueVersion": "4.0",
+            "DefaultArguments": Match.object_like({"--TABLE_NAMES": "journeys", "--SNAPSHOT_RETENTION_DAYS": "7"}),
+        },
+    )
+    template.has_resource_properties("AWS::Glue::Trigger", {"Type": "SCHEDULED", "Schedule": "cron(30 0 * * ? *)"})
+
+
+def test_iceberg_tables_cannot_be_converted_as_streams():
+    with pytest.raises(ValueError, match="Iceberg"):
+        XwBatchStack(aws_cdk.App(), "xw-batch", iceberg_tables=True, stream_conversion_schedule="rate(5 minutes)")
+
+
+def test_conversion_schedule_needs_one_job_per_table():
+    with pytest.raises(ValueError, match="jobs of single tables"):
+        XwBatchStack(aws_cdk.App(), "xw-batch", convert_tables_in_one_job=True, conversion_schedule="rate(1 hour)")
+
+
 @pytest.mark.parametrize(
     "force_delete_flag, expected_policy, match_tags",
     [
@@ -5,14 +5,20 @@ Adjusted from
 https://gitlab.kreuzwerker.de/alican.kapusuz/cop-de-scoofy-alican/-/blob/master/scoofy_project/scoofy_project_stack.py
 
 """
+import typing
+
 import aws_cdk
 from aws_cdk import (
     aws_events,
     aws_events_targets,
     aws_iam,
     aws_lambda,
+    aws_lambda_event_sources,
     aws_s3,
-    lambda_layer_awscli,
+    aws_s3_notifications,
+    aws_sqs,
+    aws_stepfunctions,
+    aws_stepfunctions_tasks,
 )
 from constructs import Construct
 
@@ -29,68 +35,265 @@ class CopyS3Data(Construct):
         target_bucket_path: str,
         schedule_cron_minute: str = "10",
         schedule_cron_hour: str = "*",
+        max_concurrency: int = 64,
+        event_driven: bool = False,
+        event_batch_size: int = 100,
+        event_max_batching_window: aws_cdk.Duration = aws_cdk.Duration.seconds(30),
+        backfill: bool = False,
+        backfill_max_concurrency: int = 10,
+        backfill_keys_per_shard: int = 10000,
+        rechunk: bool = False,
+        rechunk_codec: str = "gzip",
+        rechunk_min_size: int = 64 * 1024 * 1024,
+        rechunk_part_size: int = 64 * 1024 * 1024,
+        coalesce: bool = False,
+        coalesce_target_size: int = 128 * 1024 * 1024,
+        coalesce_max_source_size: int = 8 * 1024 * 1024,
     ):
-        """Copies the s3 data from a source s3 bucket to the target s3 bucket"""
+        """Copies the s3 data from a source s3 bucket to the target s3 bucket
+
+        The copy is done server side by the lambda itself, with up to max_concurrency parallel copies. Each run only
+        copies new objects: the state of the last run is kept in a checkpoint in the target bucket (outside the
+        target bucket path, so that it does not end up in any table).
+
+        With event_driven, new objects are copied within seconds: object created notifications of the source bucket
+        are sent to a queue and a second lambda copies exactly these objects in batches of up to event_batch_size
+        notifications, waiting at most event_max_batching_window for a batch to fill up. The scheduled copy then only
+        acts as a reconciliation sweep for anything the notifications missed. This needs the permission to change the
+        notification configuration of the source bucket during the deployment.
+
+        With rechunk, gzip objects of at least rechunk_min_size bytes are not copied as they are, but split into parts
+        of rechunk_part_size uncompressed bytes (whole json lines) which are compressed with rechunk_codec (gzip or
+        bzip2). Spark can then read the parts in parallel.
+        Which parts belong to which source object is kept in manifests next to the checkpoint.
+
+        With coalesce, gzip objects of at most coalesce_max_source_size bytes are concatenated into objects of about
+        coalesce_target_size bytes in the same directory of the target bucket path, so that Spark does not have to open
+        every small object on its own. Which source objects are in which coalesced object is kept in indexes next to
+        the checkpoint. It cannot be combined with event_driven: the batches of notifications are coalesced into groups
+        of keys which are not next to each other, which the scheduled sweep (it only reads the indexes from its
+        watermark on) cannot match and would copy into a second coalesced object.
+        """
         super().__init__(scope, id)
+        if coalesce and event_driven:
+            raise ValueError("coalesce cannot be combined with event_driven, the sweep would copy objects twice")
         self.source_bucket_name = source_bucket_name
         self.source_bucket_path = source_bucket_path
         self.target_bucket = target_bucket
         self.target_bucket_path = target_bucket_path
         self.schedule_cron_minute = schedule_cron_minute
         self.schedule_cron_hour = schedule_cron_hour
+        self.max_concurrency = max_concurrency
+        # Everything the copy job needs to remember between runs
+        self.state_bucket_path = f"/_copyjob_state/{self.target_bucket_path.strip('/')}/"
+        # How objects are copied is the same for all copy modes
+        self.copier_environment: typing.Dict[str, str] = {}
+        if rechunk:
+            # zstd is not offered, the zstandard package is not part of the lambda runtime nor the lambda package
+            if rechunk_codec not in ("gzip", "bzip2"):
+                raise ValueError(f"Unknown rechunk codec {rechunk_codec}, use one of gzip, bzip2")
+            self.copier_environment |= {
+                "RECHUNK_CODEC": rechunk_codec,
+                "RECHUNK_MIN_SIZE": str(rechunk_min_size),
+                "RECHUNK_PART_SIZE": str(rechunk_part_size),
+                "RECHUNK_MANIFEST_URI": f"s3://{self.target_bucket.bucket_name}{self.state_bucket_path}rechunk/",
+            }
+        if coalesce:
+            self.copier_environment |= {
+                "COALESCE_TARGET_SIZE": str(coalesce_target_size),
+                "COALESCE_MAX_SOURCE_SIZE": str(coalesce_max_source_size),
+                "COALESCE_INDEX_URI": f"s3://{self.target_bucket.bucket_name}{self.state_bucket_path}coalesce/",
+            }
+
+        self.source_bucket_arn = f"arn:aws:s3:::{self.source_bucket_name}"
+
+        self.allow_read_access_to_source_bucket_statement = aws_iam.PolicyStatement(
+            effect=aws_iam.Effect.ALLOW,
+            actions=[
+                "s3:GetObject",
+                "s3:ListBucket",
+            ],
+            resources=[
+                self.source_bucket_arn + "/*",  # for s3:GetObject
+                self.source_bucket_arn,  # for s3:ListBucket
+            ],
+        )
 
         # Synchronize raw input bucket with duplicated data bucket
-        self.copy_data_lambda = aws_lambda.Function(
+        self.copy_data_lambda = self._create_copy_lambda(
+            "copy-data-lambda",
+            handler="copyjob_for_s3_data.copyjob_for_s3_data.sync_bucket_uri",
+            timeout=aws_cdk.Duration.minutes(15),
+        )
+
+        self.synchron_lambda_rule = aws_events.Rule(
             self,
-            id="copy-data-lambda",
+            id="synchron-rule",
+            schedule=aws_events.Schedule.cron(
+                minute=f"{self.schedule_cron_minute}",
+                hour=f"{self.schedule_cron_hour}",
+                month="*",
+                week_day="*",
+                year="*",
+            ),
+        )
+        self.synchron_lambda_rule.add_target(aws_events_targets.LambdaFunction(self.copy_data_lambda))
+
+        if event_driven:
+            self._add_event_driven_copy(
+                batch_size=event_batch_size,
+                max_batching_window=event_max_batching_window,
+            )
+        if backfill:
+            self._add_backfill(max_concurrency=backfill_max_concurrency, keys_per_shard=backfill_keys_per_shard)
+
+    def _create_copy_lambda(
+        self,
+        id: str,
+        *,
+        handler: str,
+        timeout: aws_cdk.Duration,
+        environment: typing.Dict[str, str] = None,
+    ) -> aws_lambda.Function:
+        copy_lambda = aws_lambda.Function(
+            self,
+            id=id,
             runtime=aws_lambda.Runtime.PYTHON_3_9,  # type: ignore
+            # The whole lambdas folder, so that the handler is a package and can import its sibling modules
             code=aws_lambda.Code.from_asset(
-                "lambdas/copyjob_for_s3_data",
+                "lambdas",
                 exclude=[
                     # Excluded to make repeatable builds in case these files get compiled by tests
                     "__pycache__",
                 ],
             ),
-            handler="copyjob_for_s3_data.sync_bucket_uri",
+            handler=handler,
             environment={
                 "SOURCE_BUCKET_URI": f"s3://{self.source_bucket_name}{self.source_bucket_path}",
                 "TARGET_BUCKET_URI": f"s3://{self.target_bucket.bucket_name}{self.target_bucket_path}",
+                "CHECKPOINT_URI": f"s3://{self.target_bucket.bucket_name}{self.state_bucket_path}checkpoint.json",
+                "MAX_CONCURRENCY": str(self.max_concurrency),
+                # The metrics of all copy jobs go into one namespace, the construct id tells them apart
+                "METRICS_NAMESPACE": "XwBatch/CopyS3Data",
+                "COPY_JOB_NAME": self.node.id,
+                **self.copier_environment,
+                **(environment or {}),
             },
-            timeout=aws_cdk.Duration.minutes(15),
+            # Lambda scales cpu and network with the memory and we need both for the parallel copies
+            memory_size=1024,
+            timeout=timeout,
         )
         # For some reason, this is needed to resolve the name in the environment variable
         # https://bobbyhadz.com/blog/aws-cdk-dependson-relation
-        self.copy_data_lambda.node.add_dependency(self.target_bucket)
+        copy_lambda.node.add_dependency(self.target_bucket)
 
-        self.synchron_lambda_rule = aws_events.Rule(
+        self.target_bucket.grant_read_write(copy_lambda)
+        copy_lambda.add_to_role_policy(self.allow_read_access_to_source_bucket_statement)
+        return copy_lambda
+
+    def _add_event_driven_copy(self, *, batch_size: int, max_batching_window: aws_cdk.Duration) -> None:
+        copy_events_timeout = aws_cdk.Duration.minutes(5)
+        # Notifications which could not be copied a few times end up here for debugging
+        self.copy_events_dead_letter_queue = aws_sqs.Queue(
             self,
-            id="synchron-rule",
-            schedule=aws_events.Schedule.cron(
-                minute=f"{self.schedule_cron_minute}",
-                hour=f"{self.schedule_cron_hour}",
-                month="*",
-                week_day="*",
-                year="*",
-            ),
+            "copy-events-dead-letter-queue",
+            retention_period=aws_cdk.Duration.days(14),
+        )
+        self.copy_events_queue = aws_sqs.Queue(
+            self,
+            "copy-events-queue",
+            # AWS recommends at least 6 times the timeout of the consuming lambda
+            visibility_timeout=aws_cdk.Duration.minutes(6 * copy_events_timeout.to_minutes()),
+            dead_letter_queue=aws_sqs.DeadLetterQueue(max_receive_count=5, queue=self.copy_events_dead_letter_queue),
         )
-        self.synchron_lambda_rule.add_target(aws_events_targets.LambdaFunction(self.copy_data_lambda))
-        # AWS CLI will be installed under /opt/awscli/aws
-        self.copy_data_lambda.add_layers(lambda_layer_awscli.AwsCliLayer(self, "AwsCliLayer"))
 
-        self.target_bucket.grant_read_write(self.copy_data_lambda)
+        self.copy_events_lambda = self._create_copy_lambda(
+            "copy-events-lambda",
+            handler="copyjob_for_s3_data.copyjob_for_s3_data.copy_notified_objects",
+            timeout=copy_events_timeout,
+        )
+        self.copy_events_lambda.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(
+                self.copy_events_queue,
+                batch_size=batch_size,
+                max_batching_window=max_batching_window,
+                # Only the notifications of failed copies are retried, not the whole batch
+                report_batch_item_failures=True,
+            )
+        )
 
-        self.source_bucket_arn = f"arn:aws:s3:::{self.source_bucket_name}"
+        # The source bucket is not part of our stack, so this only adds our notification to its existing ones
+        source_bucket = aws_s3.Bucket.from_bucket_name(self, "source-bucket", self.source_bucket_name)
+        source_bucket.add_event_notification(
+            aws_s3.EventType.OBJECT_CREATED,
+            aws_s3_notifications.SqsDestination(self.copy_events_queue),
+            aws_s3.NotificationKeyFilter(prefix=f"{self.source_bucket_path.strip('/')}/"),
+        )
 
-        self.allow_read_access_to_source_bucket_statement = aws_iam.PolicyStatement(
-            effect=aws_iam.Effect.ALLOW,
-            actions=[
-                "s3:GetObject",
-                "s3:ListBucket",
-            ],
-            resources=[
-                self.source_bucket_arn + "/*",  # for s3:GetObject
-                self.source_bucket_arn,  # for s3:ListBucket
-            ],
+    def _add_backfill(self, *, max_concurrency: int, keys_per_shard: int) -> None:
+        # The shards and their results are kept here instead of in the payloads, which are limited to 256 KB
+        report_environment = {
+            "BACKFILL_REPORT_URI": f"s3://{self.target_bucket.bucket_name}{self.state_bucket_path}backfills/",
+        }
+        plan_lambda = self._create_copy_lambda(
+            "plan-backfill-lambda",
+            handler="copyjob_for_s3_data.copyjob_for_s3_data.plan_backfill_shards",
+            timeout=aws_cdk.Duration.minutes(15),
+            environment={"KEYS_PER_SHARD": str(keys_per_shard), **report_environment},
+        )
+        copy_shard_lambda = self._create_copy_lambda(
+            "copy-backfill-shard-lambda",
+            handler="copyjob_for_s3_data.copyjob_for_s3_data.copy_backfill_shard",
+            timeout=aws_cdk.Duration.minutes(15),
+            environment=report_environment,
+        )
+        summarize_lambda = self._create_copy_lambda(
+            "summarize-backfill-lambda",
+            handler="copyjob_for_s3_data.copyjob_for_s3_data.summarize_backfill",
+            timeout=aws_cdk.Duration.minutes(1),
+            environment=report_environment,
         )
 
-        self.copy_data_lambda.add_to_role_policy(self.allow_read_access_to_source_bucket_statement)
+        execution_payload = aws_stepfunctions.TaskInput.from_object(
+            {"execution": aws_stepfunctions.JsonPath.string_at("$$.Execution.Name")}
+        )
+        plan_shards = aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            "plan-backfill-shards",
+            lambda_function=plan_lambda,
+            payload=execution_payload,
+            payload_response_only=True,
+        )
+        copy_shards = aws_stepfunctions.Map(
+            self,
+            "copy-backfill-shards",
+            items_path="$.shards",
+            parameters={"shard_key.$": "$$.Map.Item.Value"},
+            max_concurrency=max_concurrency,
+            # The results are saved by the shards
+            result_path=aws_stepfunctions.JsonPath.DISCARD,
+        )
+        copy_shard = aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            "copy-backfill-shard",
+            lambda_function=copy_shard_lambda,
+            payload_response_only=True,
+        )
+        # A crashed shard should not stop the others nor the report, the shard without a result is reported as failed
+        copy_shard.add_catch(
+            aws_stepfunctions.Pass(self, "report-crashed-backfill-shard"),
+            result_path=aws_stepfunctions.JsonPath.DISCARD,
+        )
+        copy_shards.iterator(copy_shard)
+        summarize = aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            "summarize-backfill",
+            lambda_function=summarize_lambda,
+            payload=execution_payload,
+            payload_response_only=True,
+        )
+        self.backfill_state_machine = aws_stepfunctions.StateMachine(
+            self,
+            "backfill-state-machine",
+            definition=plan_shards.next(copy_shards).next(summarize),
+        )
@@ -0,0 +1,72 @@
+"""
+# Conversion runs which are sized for their input
+
+A lambda which measures the pending input of a conversion job and starts a run of it with the workers of the sizing
+policy of its table, see lambdas/start_conversion_run/sizing.py.
+"""
+import dataclasses
+import json
+import typing
+
+import aws_cdk
+from aws_cdk import aws_events, aws_events_targets
+from aws_cdk import aws_glue_alpha as glue
+from aws_cdk import aws_iam, aws_lambda, aws_s3
+from constructs import Construct
+
+from glue.business_logic import tables
+
+
+class SizedConversionRuns(Construct):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        *,
+        job: glue.Job,
+        table: tables.ConvertedTable,
+        bucket: aws_s3.Bucket,
+        schedule: typing.Optional[str] = None,
+    ):
+        """Starts the runs of the conversion job of the table with the workers of its sizing policy
+
+        The lambda can be invoked instead of starting the job directly and (with a schedule, e.g. "cron(15 * * * ? *)")
+        is invoked on that schedule. Its state and the measured input and chosen sizing of every run are kept in the
+        bucket, next to the run reports of the conversion.
+        """
+        super().__init__(scope, id)
+        self.start_run_lambda = aws_lambda.Function(
+            self,
+            id="start-run-lambda",
+            runtime=aws_lambda.Runtime.PYTHON_3_9,  # type: ignore
+            # The whole lambdas folder, so that the handler is a package and can import its sibling modules
+            code=aws_lambda.Code.from_asset(
+                "lambdas",
+                exclude=[
+                    # Excluded to make repeatable builds in case these files get compiled by tests
+                    "__pycache__",
+                ],
+            ),
+            handler="start_conversion_run.start_conversion_run.start_conversion_run",
+            environment={
+                "JOB_NAME": job.job_name,
+                "SOURCE_BUCKET_URI": f"s3://{bucket.bucket_name}{table.source_path}",
+                "SIZING_POLICY": json.dumps([dataclasses.asdict(sizing) for sizing in table.sizing]),
+                "STATE_URI": f"s3://{bucket.bucket_name}/_conversion_sizing/{table.name}/state.json",
+                "SIZING_REPORT_URI": f"s3://{bucket.bucket_name}/_reports/convert_to_parquet_sizing/{table.name}/",
+            },
+            # Only lists the new source objects
+            memory_size=256,
+            timeout=aws_cdk.Duration.minutes(5),
+        )
+        bucket.grant_read_write(self.start_run_lambda)
+        self.start_run_lambda.add_to_role_policy(
+            aws_iam.PolicyStatement(
+                actions=["glue:StartJobRun", "glue:GetJobRuns"],
+                resources=[job.job_arn],
+            )
+        )
+
+        if schedule:
+            rule = aws_events.Rule(self, id="start-run-rule", schedule=aws_events.Schedule.expression(schedule))
+            rule.add_target(aws_events_targets.LambdaFunction(self.start_run_lambda))
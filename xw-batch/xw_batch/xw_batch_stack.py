@@ -1,4 +1,5 @@
 import dataclasses
+import typing
 
 import aws_cdk
 from aws_cdk import aws_applicationautoscaling, aws_athena
@@ -8,7 +9,10 @@ from aws_cdk import aws_glue_alpha as glue
 from aws_cdk import aws_iam, aws_s3, aws_s3_assets
 from constructs import Construct
 
+from glue.business_logic import tables
+
 from .copy_s3_data import CopyS3Data
+from .sized_conversion_runs import SizedConversionRuns
 from .users_and_groups import (
     GROUP_DATA_LAKE_ATHENA_USER,
     GROUP_DATA_LAKE_DEBUGGING,
@@ -25,8 +29,59 @@ class XwBatchStack(aws_cdk.Stack):
         construct_id: str,
         *,
         force_delete_flag: bool = False,
+        convert_tables_in_one_job: bool = False,
+        stream_conversion_schedule: typing.Optional[str] = None,
+        conversion_schedule: typing.Optional[str] = None,
+        partition_projection: bool = False,
+        iceberg_tables: bool = False,
+        surrogate_keys: bool = False,
+        quarantine: bool = False,
         **kwargs,
     ) -> None:
+        """convert_tables_in_one_job: one Glue job converts all tables of glue/business_logic/tables.py concurrently,
+        instead of one job per table (which pays the startup and the minimum of workers per table). The job starts
+        without bookmarks, so its first run converts the whole history once, see the README before switching.
+
+        stream_conversion_schedule: the job of a table converts the new files as a structured stream (with a checkpoint
+        instead of bookmarks) and is started on this schedule, e.g. "cron(0/5 * * * ? *)" for every 5 minutes
+
+        conversion_schedule: the job of a table is started on this schedule, e.g. "cron(15 * * * ? *)", with workers
+        which fit its pending input (see SizedConversionRuns). Otherwise, the lambda which starts such a run is only
+        invoked manually.
+
+        partition_projection: the converted tables are defined by the stack, with Athena partition projection on
+        the partition columns of their partition scheme (from the table registry, like the columns and the first
+        partition), and the jobs do not register any partitions. Queries then need no partition lookups in the
+        catalog. An existing table of the same name (e.g. from earlier job runs) has to be deleted before the
+        deployment.
+
+        iceberg_tables: the converted tables are Iceberg tables, which every run MERGEs into (on the de-duplication keys
+        of the table) with Glue 4.0. A daily maintenance job compacts their files and expires old snapshots.
+
+        surrogate_keys: the converted tables get an integer key next to each string id of their surrogate_keys in the
+        table registry, from key mapping tables which the conversion keeps up to date. Existing converted tables get the
+        new columns on their next run, with keys only in the new rows, so they have to be converted again for the keys
+        of the older rows.
+
+        quarantine: the source rows which fail the data quality checks (a cast or a missing value) are written to
+        _quarantine/ in the raw bucket instead of being converted. Otherwise, they are converted and only counted in the
+        data_quality table.
+        """
+        if convert_tables_in_one_job and stream_conversion_schedule:
+            raise ValueError("Tables converted in one job cannot be converted as streams")
+        if conversion_schedule and (convert_tables_in_one_job or stream_conversion_schedule):
+            raise ValueError("Only the jobs of single tables can be started with a conversion_schedule")
+        if iceberg_tables and (partition_projection or stream_conversion_schedule):
+            raise ValueError("Iceberg tables have their own partitioning and cannot be converted as streams")
+        if surrogate_keys and not convert_tables_in_one_job:
+            # New keys are only assigned by one Spark session at a time, see update_key_mapping() in
+            # glue/business_logic/keys.py
+            for mapping, table_names in tables.key_mapping_tables(tables.TABLES).items():
+                if len(table_names) > 1:
+                    raise ValueError(
+                        f"The {mapping} key mapping of {', '.join(table_names)} can only be written by one job, "
+                        + "use convert_tables_in_one_job"
+                    )
         super().__init__(scope, construct_id, **kwargs)
 
         region = aws_cdk.Stack.of(self).region
@@ -60,8 +115,8 @@ class XwBatchStack(aws_cdk.Stack):
         self.users_and_groups: OrgUsersAndGroups = create_org_groups(self)
 
         # Idea:
-        # 1. "something" puts (non-parquet) data into <bucket>/raw/source/table. There is an optional crawler defined,
-        #     which has to be manually triggered (to not incur costs)
+        # 1. "something" puts (non-parquet) data into <bucket>/raw/source/table. It's queryable as a table of a raw
+        #     database, which is defined from the table registry
         # 2. glue job (with some table specific config) to convert to parquet for new files (via bookmarks) and
         #    add it as a table into another glue database into the same bucekt under <bucket>/converted/table
 
@@ -70,39 +125,26 @@ class XwBatchStack(aws_cdk.Stack):
 
         @dataclasses.dataclass()
         class RawTableConfig:
-            raw_table_path: str
-            converted_table_name: str
+            table: tables.ConvertedTable
             raw_table_id: str = dataclasses.field(init=False)
             converted_table_id: str = dataclasses.field(init=False)
             raw_bucket_uri: str = dataclasses.field(init=False)
             converted_bucket_uri: str = dataclasses.field(init=False)
 
             def __post_init__(self):
-                self.raw_table_id = self.raw_table_path.replace("/", "-")
-                self.converted_table_id = self.converted_table_name.replace("/", "-")
-                self.raw_bucket_uri = f"s3://{_s3_raw_bucket.bucket_name}{self.raw_table_path}"
-                self.converted_bucket_uri = f"s3://{_s3_raw_bucket.bucket_name}/converted/{self.converted_table_name}"
-
-        raw_table_configs = [
-            # converted_table_name needs a transform() in glue/business_logic/convert/<converted_table_name>.py
-            RawTableConfig(self.scoofy_example_data.target_bucket_path, "journeys")
-        ]
+                self.raw_table_id = self.table.source_path.replace("/", "-")
+                self.converted_table_id = self.table.name.replace("/", "-")
+                self.raw_bucket_uri = f"s3://{_s3_raw_bucket.bucket_name}{self.table.source_path}"
+                self.converted_bucket_uri = f"s3://{_s3_raw_bucket.bucket_name}/converted/{self.table.name}"
+
+        # Every table needs a transform() in glue/business_logic/convert/<name>.py
+        raw_table_configs = [RawTableConfig(table) for table in tables.TABLES]
         # only [a-z0-9_]{1,255}, everything else beaks athena later on
         # https://docs.aws.amazon.com/athena/latest/ug/glue-best-practices.html#schema-crawlers-schedule
         raw_data_base_name = "data_lake_raw"
-        raw_glue_iam_role_name = "s3-raw-access-glue"
         raw_converted_database_name = "data_lake_converted"
         raw_converted_glue_iam_role_name = "s3-raw-converted-access-glue"
 
-        role = aws_iam.Role(
-            self,
-            id=raw_glue_iam_role_name,
-            assumed_by=aws_iam.ServicePrincipal("glue.amazonaws.com"),
-        )
-        glue_policy = aws_iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSGlueServiceRole")
-        role.add_managed_policy(glue_policy)
-        self.s3_raw_bucket.grant_read_write(role)
-
         # For debugging failing glue jobs and so on
         self.s3_raw_bucket.grant_read(self.users_and_groups.get_group(GROUP_DATA_LAKE_DEBUGGING))
 
@@ -150,34 +192,38 @@ class XwBatchStack(aws_cdk.Stack):
             key=_glue_additional_python_files_asset.s3_object_key,
         )
 
-        for table_config in raw_table_configs:
-            # Add a *MANUAL* crawler so that one could add these as tables to a raw database.
-            # Hourly crawling costs quite a lot of money for no gain as the schema never changes
-            # and all files are in the same prefix, so no additional partitions are added.
-            crawler_name = f"rawcrawler-{table_config.raw_table_id}"
-
-            aws_glue.CfnCrawler(
-                self,
-                id=crawler_name,
-                name=crawler_name,
-                role=role.role_arn,
-                database_name=raw_data_base_name,
-                targets=aws_glue.CfnCrawler.TargetsProperty(
-                    s3_targets=[aws_glue.CfnCrawler.S3TargetProperty(path=table_config.raw_bucket_uri)]
-                ),
-            )
-
-            # define parquet transformation job
-            glue.Job(
+        iceberg_arguments: typing.Dict[str, str] = {}
+        if iceberg_tables:
+            iceberg_arguments = {
+                "--datalake-formats": "iceberg",
+                # The scripts configure their Iceberg catalog (the Glue data catalog) with it
+                "--ICEBERG_WAREHOUSE_URI": f"s3://{self.s3_raw_bucket.bucket_name}/converted",
+            }
+        # Iceberg is only built into Glue >= 4.0
+        glue_version = glue.GlueVersion.of("4.0") if iceberg_tables else glue.GlueVersion.V3_0  # type: ignore
+
+        def surrogate_keys_arguments(table: tables.ConvertedTable) -> typing.Dict[str, str]:
+            if not surrogate_keys or not table.surrogate_keys:
+                return {}
+            return {"--SURROGATE_KEYS": table.surrogate_keys_argument}
+
+        def rollup_arguments(table: tables.ConvertedTable) -> typing.Dict[str, str]:
+            # The rollup is written next to the converted table, see load_rollup() in glue/business_logic/load.py
+            return {"--ROLLUP_TABLE_NAME": table.rollup_name} if table.rollup_name else {}
+
+        def convert_job(job_id: str, table_arguments: typing.Dict[str, str]) -> glue.Job:
+            """A parquet transformation job, for one table or (with --TABLE_NAMES) for several tables"""
+            return glue.Job(
                 self,
-                id=f"convert_to_parquet_{table_config.converted_table_id}",
+                id=job_id,
                 description=(
-                    "Converts raw data to snappy-compressed parquet files partitioned on _created_at and "
+                    "Converts raw data to snappy-compressed parquet files partitioned on _created_at (or the "
+                    + "partition scheme of the table) and "
                     + f"adds it as a new table into the '{raw_converted_database_name}' database "
                 ),
                 role=self.glue_converted_role,
                 executable=glue.JobExecutable.python_etl(
-                    glue_version=glue.GlueVersion.V3_0,  # type: ignore
+                    glue_version=glue_version,
                     python_version=glue.PythonVersion.THREE,
                     # Be aware that Code renames all files to the hash, so don't expect nice names in the s3 bucket...
                     # https://github.com/aws/aws-cdk/issues/20481
@@ -185,6 +231,8 @@ class XwBatchStack(aws_cdk.Stack):
                     extra_python_files=[glue_additional_python_files],
                 ),
                 max_retries=1,
+                # Never two runs at the same time, e.g. for the key mappings which a job has to be the only writer of
+                max_concurrent_runs=1,
                 # Min is 2...
                 worker_count=2,
                 worker_type=glue.WorkerType.G_1_X,  # type: ignore
@@ -193,18 +241,183 @@ class XwBatchStack(aws_cdk.Stack):
                     # bookmarks seems to have not yet any nice flags :-(
                     # https://github.com/aws/aws-cdk/issues/21954
                     "--job-bookmark-option": "job-bookmark-enable",
-                    "--SOURCE_BUCKET_URI": table_config.raw_bucket_uri,
-                    "--SOURCE_COMPRESSION_TYPE": "gzip",
-                    "--SOURCE_FORMAT": "json",
-                    "--SOURCE_PARTITION_VAR": "start_dt",
-                    "--TARGET_BUCKET_URI": table_config.converted_bucket_uri,
+                    # The table specific ones, which may also overwrite the ones above
+                    **table_arguments,
                     "--TARGET_DB_NAME": raw_converted_database_name,
-                    "--TARGET_TABLE_NAME": table_config.converted_table_name,
                     "--TARGET_COMPRESSION_TYPE": "snappy",
                     "--TARGET_FORMAT": "glueparquet",
+                    # Merges the rows into the partitions they belong to on the de-duplication keys of the table, so
+                    # a retry (or a run after a failed one) does not duplicate them like append would
+                    "--LOAD_MODE": "overwrite_partitions",
+                    # Fails the job (without moving the bookmark) on source records which do not match the schema
+                    "--MALFORMED_RECORDS_POLICY": "fail",
+                    # The loads read the existing tables and partitions via the catalog
+                    "--enable-glue-datacatalog": "true",
+                    # Wall time and Spark metrics per table and phase, see publish_run_metrics() in the script
+                    "--METRICS_NAMESPACE": "XwBatch/ConvertToParquet",
+                    "--RUN_REPORT_URI": f"s3://{self.s3_raw_bucket.bucket_name}/_reports/convert_to_parquet/",
+                    # With partition projection, the partitions are not in the catalog
+                    "--REGISTER_PARTITIONS": "false" if partition_projection else "true",
+                    # The data quality summary which dbt tests instead of the converted tables, and where the rows
+                    # which fail the checks go instead, see check_quality() in glue/business_logic/quality.py
+                    "--QUALITY_BUCKET_URI": f"s3://{self.s3_raw_bucket.bucket_name}/converted/data_quality",
+                    **(
+                        {
+                            "--QUARANTINE_BUCKET_URI": (
+                                f"s3://{self.s3_raw_bucket.bucket_name}/_quarantine/convert_to_parquet/"
+                            )
+                        }
+                        if quarantine
+                        else {}
+                    ),
+                    # The integer keys of the string ids, see add_surrogate_keys() in glue/business_logic/keys.py
+                    **(
+                        {"--KEY_MAPPING_URI": f"s3://{self.s3_raw_bucket.bucket_name}/converted/key_mappings"}
+                        if surrogate_keys
+                        else {}
+                    ),
+                    # MERGEs into Iceberg tables instead of overwriting partitions
+                    **({"--LOAD_MODE": "iceberg_merge", **iceberg_arguments} if iceberg_tables else {}),
                 },
             )
 
+        # The raw tables are defined from the table registry instead of being crawled (the schema never changes), so
+        # the raw data can be queried as soon as it lands
+        self.raw_database = glue.Database(self, id=raw_data_base_name, database_name=raw_data_base_name)
+
+        for table_config in raw_table_configs:
+            self.define_raw_table(
+                table_config.table,
+                id=f"raw_table-{table_config.raw_table_id}",
+                database=self.raw_database,
+                location=table_config.raw_bucket_uri,
+            )
+
+            if partition_projection:
+                self.define_converted_table(
+                    table_config.table,
+                    database=self.raw_converted_database,
+                    location=table_config.converted_bucket_uri,
+                    surrogate_keys=surrogate_keys,
+                )
+                if table_config.table.rollup_name:
+                    self.define_converted_table(
+                        # Always partitioned by day
+                        dataclasses.replace(
+                            table_config.table,
+                            name=table_config.table.rollup_name,
+                            columns=table_config.table.rollup_columns,
+                            partition_scheme=tables.PARTITION_SCHEME_DATE,
+                        ),
+                        database=self.raw_converted_database,
+                        location=f"s3://{self.s3_raw_bucket.bucket_name}/converted/{table_config.table.rollup_name}",
+                    )
+
+            if stream_conversion_schedule:
+                stream_job = convert_job(
+                    f"convert_to_parquet_stream_{table_config.converted_table_id}",
+                    {
+                        # The checkpoint keeps track of the converted files
+                        "--job-bookmark-option": "job-bookmark-disable",
+                        "--SOURCE_BUCKET_URI": table_config.raw_bucket_uri,
+                        "--SOURCE_COMPRESSION_TYPE": table_config.table.source_compression,
+                        "--SOURCE_FORMAT": table_config.table.source_format,
+                        "--SOURCE_PARTITION_VAR": table_config.table.source_partition_var,
+                        "--TARGET_BUCKET_URI": table_config.converted_bucket_uri,
+                        "--TARGET_TABLE_NAME": table_config.table.name,
+                        "--TARGET_FILE_SIZE_MB": str(table_config.table.target_file_size_mb),
+                        "--PARTITION_SCHEME": table_config.table.partition_scheme,
+                        **surrogate_keys_arguments(table_config.table),
+                        **rollup_arguments(table_config.table),
+                        # Converts all new files and stops, as Spark 3.1 (Glue 3.0) has no availableNow trigger
+                        "--STREAMING_TRIGGER": "once",
+                        "--CHECKPOINT_URI": (
+                            f"s3://{self.s3_raw_bucket.bucket_name}/_checkpoints/convert_to_parquet/"
+                            + f"{table_config.table.name}/"
+                        ),
+                        "--MAX_FILES_PER_TRIGGER": "0",
+                    },
+                )
+                aws_glue.CfnTrigger(
+                    self,
+                    id=f"convert_to_parquet_stream_schedule_{table_config.converted_table_id}",
+                    type="SCHEDULED",
+                    schedule=stream_conversion_schedule,
+                    start_on_creation=True,
+                    actions=[aws_glue.CfnTrigger.ActionProperty(job_name=stream_job.job_name)],
+                )
+            elif not convert_tables_in_one_job:
+                table_job = convert_job(
+                    f"convert_to_parquet_{table_config.converted_table_id}",
+                    {
+                        "--SOURCE_BUCKET_URI": table_config.raw_bucket_uri,
+                        "--SOURCE_COMPRESSION_TYPE": table_config.table.source_compression,
+                        "--SOURCE_FORMAT": table_config.table.source_format,
+                        "--SOURCE_PARTITION_VAR": table_config.table.source_partition_var,
+                        "--TARGET_BUCKET_URI": table_config.converted_bucket_uri,
+                        "--TARGET_TABLE_NAME": table_config.table.name,
+                        "--TARGET_FILE_SIZE_MB": str(table_config.table.target_file_size_mb),
+                        "--PARTITION_SCHEME": table_config.table.partition_scheme,
+                        **surrogate_keys_arguments(table_config.table),
+                        **rollup_arguments(table_config.table),
+                    },
+                )
+                # The job's own workers are only used when it's started directly
+                SizedConversionRuns(
+                    self,
+                    f"sized_convert_to_parquet_runs_{table_config.converted_table_id}",
+                    job=table_job,
+                    table=table_config.table,
+                    bucket=self.s3_raw_bucket,
+                    schedule=conversion_schedule,
+                )
+
+        if convert_tables_in_one_job:
+            convert_job(
+                "convert_to_parquet_tables",
+                {
+                    # The sources and targets of the tables come from the table registry
+                    "--TABLE_NAMES": ",".join(table_config.table.name for table_config in raw_table_configs),
+                    "--RAW_BUCKET_URI": f"s3://{self.s3_raw_bucket.bucket_name}",
+                    "--MAX_CONCURRENT_TABLES": "4",
+                },
+            )
+
+        if iceberg_tables:
+            maintenance_job = glue.Job(
+                self,
+                id="maintain_iceberg_tables",
+                description="Compacts the converted Iceberg tables and expires their old snapshots",
+                role=self.glue_converted_role,
+                executable=glue.JobExecutable.python_etl(
+                    glue_version=glue_version,
+                    python_version=glue.PythonVersion.THREE,
+                    script=glue.Code.from_asset("glue/scripts/maintain_iceberg_tables.py"),
+                ),
+                max_retries=1,
+                worker_count=2,
+                worker_type=glue.WorkerType.G_1_X,  # type: ignore
+                continuous_logging={"enabled": True},
+                default_arguments={
+                    "--TABLE_NAMES": ",".join(table_config.table.name for table_config in raw_table_configs),
+                    "--DATABASE_NAME": raw_converted_database_name,
+                    "--TARGET_FILE_SIZE_MB": "128",
+                    # Time travel and rollbacks for a week, but at least a day of hourly runs
+                    "--SNAPSHOT_RETENTION_DAYS": "7",
+                    "--RETAIN_LAST_SNAPSHOTS": "24",
+                    **iceberg_arguments,
+                },
+            )
+            aws_glue.CfnTrigger(
+                self,
+                id="maintain_iceberg_tables_schedule",
+                type="SCHEDULED",
+                # Before the daily dbt run (at 1:23)
+                schedule="cron(30 0 * * ? *)",
+                start_on_creation=True,
+                actions=[aws_glue.CfnTrigger.ActionProperty(job_name=maintenance_job.job_name)],
+            )
+
         # Give a debugging group access to the logs
         # TODO: maybe restrict to glue logs? But if we get rif of the crawler, there are no logs,
         #       so lets keep it broad for now
@@ -428,6 +641,119 @@ class XwBatchStack(aws_cdk.Stack):
 
         self.dbt_runner_task.task_definition.task_role.add_managed_policy(self.allow_prod_athena_access_managed_policy)
 
+    def define_raw_table(
+        self, table: tables.ConvertedTable, *, id: str, database: glue.Database, location: str
+    ) -> aws_glue.CfnTable:
+        """The raw json data of the table, with the source columns as strings like the conversion reads them
+
+        With a source_partition_format, the date directories are projected as a dt partition (Athena computes them
+        instead of looking them up in the catalog).
+        """
+        if table.source_format != "json":
+            raise ValueError(f"Only json raw tables can be defined, not {table.source_format} ones of {table.name}")
+        if not table.source_columns:
+            raise ValueError(f"Table {table.name} needs its source_columns in the table registry")
+        parameters = {"classification": "json", "compressionType": table.source_compression}
+        partition_keys = []
+        if table.source_partition_format:
+            partition_keys = [aws_glue.CfnTable.ColumnProperty(name="dt", type="date")]
+            parameters |= {
+                "projection.enabled": "true",
+                "projection.dt.type": "date",
+                "projection.dt.format": table.source_partition_format,
+                "projection.dt.range": f"{table.first_partition},NOW",
+                "projection.dt.interval": "1",
+                "projection.dt.interval.unit": "DAYS",
+                "storage.location.template": f"{location.rstrip('/')}/${{dt}}/",
+            }
+        return aws_glue.CfnTable(
+            self,
+            id=id,
+            catalog_id=self.account,
+            database_name=database.database_name,
+            table_input=aws_glue.CfnTable.TableInputProperty(
+                name=table.name,
+                table_type="EXTERNAL_TABLE",
+                partition_keys=partition_keys,
+                parameters=parameters,
+                storage_descriptor=aws_glue.CfnTable.StorageDescriptorProperty(
+                    columns=[
+                        aws_glue.CfnTable.ColumnProperty(name=name, type="string") for name in table.source_columns
+                    ],
+                    location=location,
+                    input_format="org.apache.hadoop.mapred.TextInputFormat",
+                    output_format="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+                    serde_info=aws_glue.CfnTable.SerdeInfoProperty(
+                        serialization_library="org.openx.data.jsonserde.JsonSerDe",
+                        # Lines which were cut off are read as nulls instead of failing the query
+                        parameters={"ignore.malformed.json": "true"},
+                    ),
+                ),
+            ),
+        )
+
+    def define_converted_table(
+        self, table: tables.ConvertedTable, *, database: glue.Database, location: str, surrogate_keys: bool = False
+    ) -> aws_glue.CfnTable:
+        """The converted table with partition projection on the partition columns of its partition scheme: Athena
+        computes the partitions of a query (every day or hour since the first partition) instead of looking them up in
+        the catalog"""
+        if not table.columns:
+            raise ValueError(f"Table {table.name} needs its columns in the table registry for partition projection")
+        first_year = int(table.first_partition[:4])
+        # The values of the integer partitions, the date is projected by day
+        integer_ranges = {
+            "_created_hour": "0,23",
+            "_created_year": f"{first_year},{first_year + 99}",
+            "_created_month": "1,12",
+            "_created_day": "1,31",
+        }
+        projection = {"projection.enabled": "true"}
+        for name, type in table.partition_columns:
+            if type == "date":
+                projection |= {
+                    f"projection.{name}.type": "date",
+                    f"projection.{name}.format": "yyyy-MM-dd",
+                    f"projection.{name}.range": f"{table.first_partition},NOW",
+                    f"projection.{name}.interval": "1",
+                    f"projection.{name}.interval.unit": "DAYS",
+                }
+            else:
+                # Spark writes the integers without leading zeros, which is what the projection computes as well
+                projection |= {f"projection.{name}.type": "integer", f"projection.{name}.range": integer_ranges[name]}
+        # The directories which Spark writes
+        template = "/".join(f"{name}=${{{name}}}" for name, _ in table.partition_columns)
+        return aws_glue.CfnTable(
+            self,
+            id=f"converted_table_{table.name}",
+            catalog_id=self.account,
+            database_name=database.database_name,
+            table_input=aws_glue.CfnTable.TableInputProperty(
+                name=table.name,
+                table_type="EXTERNAL_TABLE",
+                partition_keys=[
+                    aws_glue.CfnTable.ColumnProperty(name=name, type=type) for name, type in table.partition_columns
+                ],
+                parameters={
+                    "classification": "parquet",
+                    **projection,
+                    "storage.location.template": f"{location}/{template}",
+                },
+                storage_descriptor=aws_glue.CfnTable.StorageDescriptorProperty(
+                    columns=[
+                        aws_glue.CfnTable.ColumnProperty(name=name, type=type)
+                        for name, type in table.data_columns + (table.surrogate_key_columns if surrogate_keys else ())
+                    ],
+                    location=location,
+                    input_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    output_format="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    serde_info=aws_glue.CfnTable.SerdeInfoProperty(
+                        serialization_library="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    ),
+                ),
+            ),
+        )
+
 
 def create_policy_document_for_athena_principal(
     *,